@@ -23,6 +23,7 @@
 #
 
 import functools
+import inspect
 import logging
 
 from stoqlib.lib.component import provide_utility
@@ -34,6 +35,10 @@ from stoqlib.domain.person import LoginUser
 from stoqlib.domain.token import AccessToken
 from stoqlib.lib.configparser import get_config
 
+from stoqserver.lib.database import (cancel_on_disconnect, get_statement_timeout,
+                                     readonly_store, set_statement_timeout)
+from stoqserver.lib.overrides import cache_overrides
+
 log = logging.getLogger(__name__)
 
 
@@ -83,12 +88,30 @@ def b1food_login_required(f):
     return wrapper
 
 
+def _get_resource(f):
+    # flask-restful applies the method_decorators on the bound method, so the
+    # resource is the instance it is bound to
+    return getattr(inspect.unwrap(f), '__self__', None)
+
+
 def store_provider(f):
+    """Provide a store to the resource method as its first argument
+
+    If the resource has a statement timeout (see :func:`get_statement_timeout`), it will be
+    applied to the store, and the query will be cancelled if the client disconnects.
+    The branch overrides are resolved once during the request (see :func:`cache_overrides`)
+    """
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        with api.new_store() as store:
+        statement_timeout = get_statement_timeout(_get_resource(f))
+        with api.new_store() as store, cache_overrides(store):
             try:
-                return f(store, *args, **kwargs)
+                if not statement_timeout:
+                    return f(store, *args, **kwargs)
+
+                set_statement_timeout(store, statement_timeout)
+                with cancel_on_disconnect(store):
+                    return f(store, *args, **kwargs)
             except Exception as e:
                 store.retval = False
                 raise e
@@ -96,6 +119,22 @@ def store_provider(f):
     return wrapper
 
 
+def readonly_store_provider(f):
+    """Like store_provider, but the store is read only
+
+    Used by reporting resources, so their queries can be sent to a replica (or at least
+    to a separate connection pool). See :mod:`stoqserver.lib.database`
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        statement_timeout = get_statement_timeout(_get_resource(f))
+        with readonly_store(statement_timeout=statement_timeout) as store:
+            with cancel_on_disconnect(store):
+                return f(store, *args, **kwargs)
+
+    return wrapper
+
+
 def info_logger(f):
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
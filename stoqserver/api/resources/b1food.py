@@ -24,10 +24,11 @@
 
 import logging
 import datetime
+import re
 from uuid import UUID
 
 from flask import abort, make_response, jsonify, request
-from storm.expr import And, Join, LeftJoin, Ne, Or, Select
+from storm.expr import And, Eq, Join, LeftJoin, Ne, Or, Select
 from storm.info import ClassAlias
 
 from stoqlib.domain.fiscal import Invoice, CfopData
@@ -42,14 +43,15 @@ from stoqlib.domain.product import Product
 from stoqlib.domain.profile import UserProfile
 from stoqlib.domain.system import TransactionEntry
 from stoqlib.domain.sale import Sale, SaleItem
-from stoqlib.domain.sellable import Sellable, SellableCategory
+from stoqlib.domain.sellable import Sellable, SellableCategory, SellableUnit
 from stoqlib.domain.station import BranchStation
 from stoqlib.domain.taxes import InvoiceItemIcms
 from stoqlib.lib.configparser import get_config
 from stoqlib.lib.formatters import raw_document
 from stoqlib.lib.parameters import sysparam
 
-from stoqserver.api.decorators import store_provider, b1food_login_required, info_logger
+from stoqserver.api.decorators import (readonly_store_provider, b1food_login_required,
+                                       info_logger)
 from stoqserver.lib.baseresource import BaseResource
 
 log = logging.getLogger(__name__)
@@ -95,6 +97,28 @@ def _check_if_uuid(branch_ids):
             abort(400, message)
 
 
+def _get_changed_since(data):
+    """Get the optional 'dataAlteracao' filter from the request args
+
+    It accepts the same format used for 'dataAlteracao' on the responses (the utc offset
+    is ignored, as the one on the responses is fixed) or just a date.
+    """
+    changed_since = data.get('dataAlteracao')
+    if not changed_since:
+        return None
+
+    value = re.sub(r'\s*[+-]?\d{4}$', '', changed_since.strip())
+    for date_format in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+
+    message = "Invalid 'dataAlteracao' provided: %s" % changed_since
+    log.error(message)
+    abort(400, message)
+
+
 def _get_category_info(sellable):
     return {
         'idGrupo': sellable.category and sellable.category.id,
@@ -277,7 +301,8 @@ class IncomeCenterResource(BaseResource):
 
 
 class B1FoodSaleItemResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
+    statement_timeout = 300
     routes = ['/b1food/terceiros/restful/itemvenda']
 
     def get(self, store):
@@ -440,7 +465,8 @@ class B1FoodSaleItemResource(BaseResource):
 
 
 class B1FoodSellableResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
+    statement_timeout = 300
     routes = ['/b1food/terceiros/restful/material']
 
     def _get_response_item(self, sellable, branch_id):
@@ -461,16 +487,47 @@ class B1FoodSellableResource(BaseResource):
         }
         return res_item
 
+    def _get_sellables(self, store, query, branch_id=None, changed_since=None):
+        """Iterate over the sellables matching query
+
+        The unit, category and transaction entries are fetched in the same query, since
+        they are used by _get_response_item and would otherwise be lazy loaded row by row.
+
+        :param branch_id: if provided, only the sellables that have a
+          |productbranchoverride| for this branch will be returned
+        :param changed_since: if provided, only the sellables that were changed (or had
+          their category changed) since this date will be returned
+        """
+        CategoryEntry = ClassAlias(TransactionEntry, 'category_te')
+        tables = [
+            Sellable,
+            Join(TransactionEntry, Sellable.te_id == TransactionEntry.id),
+            LeftJoin(SellableUnit, Sellable.unit_id == SellableUnit.id),
+            LeftJoin(SellableCategory, Sellable.category_id == SellableCategory.id),
+            LeftJoin(CategoryEntry, SellableCategory.te_id == CategoryEntry.id),
+        ]
+        if branch_id:
+            tables.append(Join(ProductBranchOverride,
+                               And(ProductBranchOverride.product_id == Sellable.id,
+                                   ProductBranchOverride.branch_id == branch_id)))
+        if changed_since:
+            query = And(query, Or(TransactionEntry.te_server >= changed_since,
+                                  CategoryEntry.te_server >= changed_since))
+
+        result = store.using(*tables).find(
+            (Sellable, TransactionEntry, SellableUnit, SellableCategory, CategoryEntry), query)
+        for row in result:
+            yield row[0]
+
     def get(self, store):
         data = request.args
 
         request_available = data.get('ativo')
         request_branches = data.get('lojas')
         branch_ids = _parse_request_list(request_branches)
+        changed_since = _get_changed_since(data)
 
-        database_branches = store.find(Branch)
-        database_branch_ids = [branch.id for branch in database_branches]
-
+        database_branch_ids = set(store.find(Branch.id))
         not_found_ids = [branch_id for branch_id in branch_ids
                          if branch_id not in database_branch_ids]
 
@@ -481,41 +538,39 @@ class B1FoodSellableResource(BaseResource):
 
         delivery = sysparam.get_object(store, 'DELIVERY_SERVICE')
         if request_available == '1':
-            sellables = Sellable.get_available_sellables(store)
+            query = Sellable.get_available_sellables_query(store)
         elif request_available == '0':
             # We want to exclude not available sellables and the ones
             # that are not products, example "Entrega"
-            sellables = store.find(Sellable, And(Ne(Sellable.id, delivery.sellable.id),
-                                                 Ne(Sellable.description, 'Entrega'),
-                                                 Ne(Sellable.status, Sellable.STATUS_AVAILABLE)))
+            query = And(Ne(Sellable.id, delivery.sellable.id),
+                        Ne(Sellable.description, 'Entrega'),
+                        Ne(Sellable.status, Sellable.STATUS_AVAILABLE))
         else:
-            sellables = store.find(Sellable, And(Ne(Sellable.id, delivery.sellable.id),
-                                                 Ne(Sellable.description, 'Entrega')))
+            query = And(Ne(Sellable.id, delivery.sellable.id),
+                        Ne(Sellable.description, 'Entrega'))
 
         self.network = _get_network_info()
         response = []
 
         if not branch_ids:
-            for sellable in sellables:
+            for sellable in self._get_sellables(store, query, changed_since=changed_since):
                 res_item = self._get_response_item(sellable, branch_id=None)
                 response.append(res_item)
             return response
 
-        query = ProductBranchOverride.branch_id.is_in(branch_ids)
-        pbos = store.find(ProductBranchOverride, query)
-
-        branch_sellable_ids = {}
-        for pbo in pbos:
-            branch_sellable_ids.setdefault(pbo.branch_id, [])
-            branch_sellable_ids[pbo.branch_id].append(pbo.product_id)
+        # Branches without any override see the whole catalog, the others only
+        # see the products that were overridden for them
+        overridden_branch_ids = set(store.find(
+            ProductBranchOverride.branch_id,
+            ProductBranchOverride.branch_id.is_in(branch_ids)).config(distinct=True))
 
         for branch_id in branch_ids:
-            if not branch_sellable_ids.get(branch_id):
-                branch_sellables = sellables
+            if branch_id in overridden_branch_ids:
+                branch_sellables = self._get_sellables(store, query, branch_id=branch_id,
+                                                       changed_since=changed_since)
             else:
-                sellable_ids = branch_sellable_ids[branch_id]
-                branch_sellables = [sellable for sellable in sellables
-                                    if sellable.id in sellable_ids]
+                branch_sellables = self._get_sellables(store, query,
+                                                       changed_since=changed_since)
 
             for sellable in branch_sellables:
                 res_item = self._get_response_item(sellable, branch_id=branch_id)
@@ -525,7 +580,8 @@ class B1FoodSellableResource(BaseResource):
 
 
 class B1FoodPaymentsResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
+    statement_timeout = 300
     routes = ['/b1food/terceiros/restful/movimentocaixa']
 
     def _get_payments_sum(self, payments):
@@ -695,7 +751,7 @@ class B1FoodPaymentsResource(BaseResource):
 
 
 class B1FoodPaymentMethodResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
     routes = ['/b1food/terceiros/restful/meio-pagamento']
 
     def get(self, store):
@@ -758,7 +814,7 @@ class B1FoodPaymentMethodResource(BaseResource):
 
 
 class B1FoodStationResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
     routes = ['/b1food/terceiros/restful/terminais']
 
     def get(self, store):
@@ -766,12 +822,17 @@ class B1FoodStationResource(BaseResource):
 
         request_branches = data.get('lojas')
         active = data.get('ativo')
+        changed_since = _get_changed_since(data)
 
         branch_ids = _parse_request_list(request_branches)
         _check_if_uuid(branch_ids)
         tables = [BranchStation]
         clauses = []
 
+        if changed_since:
+            tables.append(Join(TransactionEntry, BranchStation.te_id == TransactionEntry.id))
+            clauses.append(TransactionEntry.te_server >= changed_since)
+
         if active is not None:
             is_active = active == '1'
             clauses.append(BranchStation.is_active == is_active)
@@ -806,7 +867,8 @@ class B1FoodStationResource(BaseResource):
 
 
 class B1FoodReceiptsResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
+    statement_timeout = 300
     routes = ['/b1food/terceiros/restful/comprovante']
 
     def get(self, store):
@@ -987,7 +1049,7 @@ class B1FoodReceiptsResource(BaseResource):
 
 
 class B1FoodTillResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
     routes = ['/b1food/terceiros/restful/periodos']
 
     def get(self, store):
@@ -995,7 +1057,7 @@ class B1FoodTillResource(BaseResource):
 
 
 class B1FoodRolesResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
     routes = ['/b1food/terceiros/restful/cargos']
 
     def get(self, store):
@@ -1006,7 +1068,13 @@ class B1FoodRolesResource(BaseResource):
         if request_is_active == '0':
             return []
 
-        profiles = store.find(UserProfile)
+        changed_since = _get_changed_since(data)
+        if changed_since:
+            tables = [UserProfile, Join(TransactionEntry, UserProfile.te_id == TransactionEntry.id)]
+            profiles = store.using(*tables).find(UserProfile,
+                                                 TransactionEntry.te_server >= changed_since)
+        else:
+            profiles = store.find(UserProfile)
 
         network = _get_network_info()
 
@@ -1027,23 +1095,35 @@ class B1FoodRolesResource(BaseResource):
 
 
 class B1FoodBranchResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
     routes = ['/b1food/terceiros/restful/rede-loja']
 
     def get(self, store):
         data = request.args
 
         tables = [Branch]
-        query = None
+        clauses = []
 
         active = data.get('ativo')
+        changed_since = _get_changed_since(data)
 
         if active is not None:
             is_active = active == '1'
-            query = Branch.is_active == is_active
-
-        if query:
-            branches = store.using(*tables).find(Branch, query)
+            clauses.append(Branch.is_active == is_active)
+
+        if changed_since:
+            # The branch name comes from its person
+            BranchPersonEntry = ClassAlias(TransactionEntry, 'branch_person_te')
+            tables.extend([
+                Join(TransactionEntry, Branch.te_id == TransactionEntry.id),
+                Join(Person, Branch.person_id == Person.id),
+                Join(BranchPersonEntry, Person.te_id == BranchPersonEntry.id),
+            ])
+            clauses.append(Or(TransactionEntry.te_server >= changed_since,
+                              BranchPersonEntry.te_server >= changed_since))
+
+        if clauses:
+            branches = store.using(*tables).find(Branch, And(*clauses))
         else:
             branches = store.using(*tables).find(Branch)
 
@@ -1067,7 +1147,7 @@ class B1FoodBranchResource(BaseResource):
 
 
 class B1FoodDiscountCategoryResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
     routes = ['/b1food/terceiros/restful/tiposdescontos']
 
     def get(self, store):
@@ -1078,7 +1158,14 @@ class B1FoodDiscountCategoryResource(BaseResource):
         if request_is_active == '0':
             return []
 
-        categories = store.find(ClientCategory)
+        changed_since = _get_changed_since(data)
+        if changed_since:
+            tables = [ClientCategory,
+                      Join(TransactionEntry, ClientCategory.te_id == TransactionEntry.id)]
+            categories = store.using(*tables).find(ClientCategory,
+                                                   TransactionEntry.te_server >= changed_since)
+        else:
+            categories = store.find(ClientCategory)
 
         network = _get_network_info()
 
@@ -1099,18 +1186,36 @@ class B1FoodDiscountCategoryResource(BaseResource):
 
 
 class B1FoodLoginUserResource(BaseResource):
-    method_decorators = [b1food_login_required, store_provider, info_logger]
+    method_decorators = [b1food_login_required, readonly_store_provider, info_logger]
     routes = ['/b1food/terceiros/restful/funcionarios']
 
     def get(self, store):
         data = request.args
         request_is_active = data.get('ativo')
+        changed_since = _get_changed_since(data)
 
-        users = store.find(LoginUser)
+        tables = [LoginUser]
+        clauses = []
         if request_is_active == '1':
-            users = LoginUser.get_active_users(store)
+            clauses.append(Eq(LoginUser.is_active, True))
         elif request_is_active == '0':
-            users = users.find(is_active=False)
+            clauses.append(Eq(LoginUser.is_active, False))
+
+        if changed_since:
+            # The user names come from its person
+            UserPersonEntry = ClassAlias(TransactionEntry, 'user_person_te')
+            tables.extend([
+                Join(TransactionEntry, LoginUser.te_id == TransactionEntry.id),
+                Join(Person, LoginUser.person_id == Person.id),
+                Join(UserPersonEntry, Person.te_id == UserPersonEntry.id),
+            ])
+            clauses.append(Or(TransactionEntry.te_server >= changed_since,
+                              UserPersonEntry.te_server >= changed_since))
+
+        if clauses:
+            users = store.using(*tables).find(LoginUser, And(*clauses))
+        else:
+            users = store.find(LoginUser)
 
         network = _get_network_info()
         response = []
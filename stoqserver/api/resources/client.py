@@ -22,22 +22,32 @@
 # Author(s): Stoq Team <dev@stoq.com.br>
 #
 
+import json
 import logging
+import urllib.parse
 
 from blinker import signal
-from flask import abort, request
+from flask import Response, abort, jsonify, make_response, request
 from storm.expr import Join, LeftJoin
 
 from stoqlib.domain.address import Address, CityLocation
 from stoqlib.domain.person import Person, Client, ClientCategory, Individual, Company
-from stoqlib.lib.formatters import raw_document, format_cpf
 from stoqlib.lib.validators import validate_cpf
 
 from stoqserver.lib.baseresource import BaseResource
+from stoqserver.lib.clientlookup import find_person_by_document
+from stoqserver.lib.database import readonly_store
+from stoqserver.utils import JsonEncoder, decode_cursor, encode_cursor
 from stoqserver.api.decorators import login_required, store_provider
 
 log = logging.getLogger(__name__)
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Number of clients fetched at a time when streaming a category
+EXPORT_BATCH_SIZE = 1000
+CLIENT_FIELDS = ['id', 'category', 'doc', 'last_items', 'name', 'birthdate', 'category_name']
+
 
 class ClientResource(BaseResource):
     """Client RESTful resource."""
@@ -123,10 +133,7 @@ class ClientResource(BaseResource):
         return data
 
     def _get_by_doc(self, store, data, doc):
-        # Extra precaution in case we ever send the cpf already formatted
-        document = format_cpf(raw_document(doc))
-
-        person = Person.get_by_document(store, document)
+        person = find_person_by_document(store, doc)
         if person and person.client:
             data = self._dump_client(person.client)
 
@@ -138,19 +145,129 @@ class ClientResource(BaseResource):
 
         return data
 
-    def _get_by_category(self, store, category_name):
-        # Pre-fetch person and Individual as they will be used down the line by _dump_client
+    def _find_by_category(self, store, category_name, last_te_id=None, limit=None):
+        # Only the columns used by the response are fetched, ordered by te_id so
+        # the pages can continue from the last client of the previous one
         tables = [Client,
                   Join(Person, Person.id == Client.person_id),
                   LeftJoin(Individual, Person.id == Individual.person_id),
                   LeftJoin(Company, Person.id == Company.person_id),
                   Join(ClientCategory, Client.category_id == ClientCategory.id)]
-        clients = store.using(*tables).find((Client, Person, Individual, ClientCategory),
-                                            ClientCategory.name == category_name)
-        retval = []
-        for data in clients:
-            retval.append(self._dump_client(data[0]))
-        return retval
+        columns = (Client.te_id, Client.id, Client.category_id, Company.id, Company.cnpj,
+                   Individual.cpf, Person.name, Individual.birth_date, ClientCategory.name)
+        clauses = [ClientCategory.name == category_name]
+        if last_te_id is not None:
+            clauses.append(Client.te_id > last_te_id)
+
+        result = store.using(*tables).find(columns, *clauses).order_by(Client.te_id)
+        if limit:
+            result = result.config(limit=limit)
+        return result
+
+    def _dump_row(self, row, fields):
+        (te_id, client_id, category_id, company_id, cnpj, cpf, name,
+         birthdate, category_name) = row
+        data = dict(
+            id=client_id,
+            category=category_id,
+            doc=cnpj if company_id else cpf,
+            # See _dump_client
+            last_items={},
+            name=name,
+            birthdate=birthdate,
+            category_name=category_name or "",
+        )
+        return te_id, {field: data[field] for field in fields}
+
+    def _get_by_category(self, store, category_name):
+        return [self._dump_row(row, CLIENT_FIELDS)[1]
+                for row in self._find_by_category(store, category_name)]
+
+    def _get_page_by_category(self, store, category_name, fields, limit, last_te_id):
+        clients = []
+        te_id = None
+        for row in self._find_by_category(store, category_name, last_te_id, limit):
+            te_id, data = self._dump_row(row, fields)
+            clients.append(data)
+
+        next_ = None
+        if len(clients) == limit:
+            args = {'category_name': category_name, 'limit': limit,
+                    'cursor': encode_cursor(te_id)}
+            if fields != CLIENT_FIELDS:
+                args['fields'] = ','.join(fields)
+            next_ = self.routes[0] + '?' + urllib.parse.urlencode(sorted(args.items()))
+
+        return make_response(jsonify({'data': clients, 'next': next_}), 200)
+
+    def _stream_by_category(self, category_name, fields, last_te_id):
+        # The store from store_provider is closed as soon as get() returns, so the
+        # stream uses its own one, fetching a batch of clients at a time
+        with readonly_store() as store:
+            while True:
+                rows = list(self._find_by_category(store, category_name, last_te_id,
+                                                   EXPORT_BATCH_SIZE))
+                for row in rows:
+                    last_te_id, data = self._dump_row(row, fields)
+                    yield json.dumps(data, cls=JsonEncoder) + '\n'
+
+                if len(rows) < EXPORT_BATCH_SIZE:
+                    return
+
+    def _export_by_category(self, store, category_name):
+        """Export the clients of a category, a page at a time or streamed as NDJSON
+
+        Without any of the limit, cursor, fields or format args, all the clients are
+        returned in a single list, like older versions did.
+        """
+        limit = self.get_arg('limit')
+        cursor = self.get_arg('cursor')
+        fields = self.get_arg('fields')
+        format_ = self.get_arg('format')
+        if not any([limit, cursor, fields, format_]):
+            return self._get_by_category(store, category_name)
+
+        if format_ not in [None, 'json', 'ndjson']:
+            message = "'format' must be json or ndjson"
+            log.error(message)
+            abort(400, message)
+
+        try:
+            limit = int(limit or DEFAULT_PAGE_SIZE)
+        except (TypeError, ValueError):
+            message = "'limit' must be a number"
+            log.error(message)
+            abort(400, message)
+
+        if limit > MAX_PAGE_SIZE:
+            message = "'limit' must be lower than %s" % MAX_PAGE_SIZE
+            log.error(message)
+            abort(400, message)
+
+        last_te_id = None
+        if cursor:
+            try:
+                last_te_id, = decode_cursor(cursor)
+                if not isinstance(last_te_id, int):
+                    raise ValueError(cursor)
+            except ValueError:
+                message = "Invalid 'cursor' provided"
+                log.error(message)
+                abort(400, message)
+
+        fields = fields.split(',') if fields else CLIENT_FIELDS
+        invalid_fields = set(fields) - set(CLIENT_FIELDS)
+        if invalid_fields:
+            message = 'Invalid fields: {}'.format(', '.join(sorted(invalid_fields)))
+            log.error(message)
+            abort(400, message)
+
+        if format_ == 'ndjson':
+            # The whole category (after the cursor) is streamed, the limit is ignored
+            return Response(self._stream_by_category(category_name, fields, last_te_id),
+                            mimetype='application/x-ndjson')
+
+        return self._get_page_by_category(store, category_name, fields, limit, last_te_id)
 
     def get(self, store):
         doc = request.args.get('doc')
@@ -160,7 +277,7 @@ class ClientResource(BaseResource):
         if doc:
             return self._get_by_doc(store, {'doc': doc, 'name': name}, doc)
         if category_name:
-            return self._get_by_category(store, category_name)
+            return self._export_by_category(store, category_name)
 
         return {'doc': doc, 'name': name}
 
@@ -25,31 +25,60 @@
 import logging
 
 from flask import abort, jsonify, make_response
-from storm.expr import And, Cast, Desc, Eq, Join
+from storm.expr import And, Desc, Eq, Join, LeftJoin, Select
 
 from stoqlib.lib.formatters import format_cnpj, raw_document
 from stoqlib.lib.validators import validate_cnpj
+from stoqlib.domain.nfe import NFePurchase
 from stoqlib.domain.person import Branch, Company, Person, UserBranchAccess
 
 from stoqserver.lib.baseresource import BaseResource
-from stoqserver.api.decorators import login_required, store_provider
+from stoqserver.api.decorators import login_required, readonly_store_provider
+from stoqserver.lib.database import estimate_count
+from stoqserver.lib.indexes import get_nfe_document_type, get_nfe_key, index_exists
+from stoqserver.utils import decode_cursor, encode_cursor
 
 log = logging.getLogger(__name__)
 
 MAX_PAGE_SIZE = 100
 NFEPROC_TYPE = '<nfeProc'
+COUNT_TYPES = ['exact', 'estimated']
+# See stoqserver.lib.indexes
+NFE_PURCHASE_KEY_INDEX = 'nfe_purchase_cnpj_key_idx'
+
+
+def _decode_cursor(cursor):
+    """Decode a cursor from the next/previous links
+
+    :returns: a (direction, te_id) tuple
+    :raises ValueError: if the cursor is not valid
+    """
+    values = decode_cursor(cursor)
+    if (len(values) != 2 or values[0] not in ['next', 'previous'] or
+            not isinstance(values[1], int)):
+        raise ValueError(cursor)
+    return tuple(values)
 
 
 class ImportedNfeResource(BaseResource):
-    method_decorators = [login_required, store_provider]
+    method_decorators = [login_required, readonly_store_provider]
+    statement_timeout = 60
     routes = ['/api/v1/imported_nfe']
 
+    def _find_nfe_purchase_id(self, store, imported_nfe):
+        query = "SELECT id FROM nfe_purchase WHERE cnpj = ? AND xml::text ILIKE ?"
+        nfe_purchase = store.execute(
+            query, (imported_nfe.cnpj, '%{}%'.format(imported_nfe.key))).get_one()
+        return nfe_purchase and nfe_purchase[0]
+
     def get(self, store):
         from stoqnfe.domain.distribution import ImportedNfe
 
         cnpj = self.get_arg('cnpj')
         limit = self.get_arg('limit')
         offset = self.get_arg('offset')
+        cursor = self.get_arg('cursor')
+        count_type = self.get_arg('count', 'exact')
 
         if not cnpj:
             message = "'cnpj' not provided"
@@ -82,6 +111,20 @@ class ImportedNfeResource(BaseResource):
                 log.error(message)
                 abort(400, message)
 
+        direction = None
+        if cursor:
+            try:
+                direction, cursor_te_id = _decode_cursor(cursor)
+            except ValueError:
+                message = "Invalid 'cursor' provided"
+                log.error(message)
+                abort(400, message)
+
+        if count_type not in COUNT_TYPES:
+            message = "'count' must be one of: %s" % ', '.join(COUNT_TYPES)
+            log.error(message)
+            abort(400, message)
+
         cnpj = format_cnpj(raw_document(cnpj))
         limit = limit or 20
         offset = offset or 0
@@ -108,18 +151,62 @@ class ImportedNfeResource(BaseResource):
             abort(403, message)
 
         query = And(ImportedNfe.cnpj == cnpj,
-                    Cast(ImportedNfe.xml, 'text').startswith(NFEPROC_TYPE))
-        result = store.find(ImportedNfe, query).order_by(Desc(ImportedNfe.te_id))
-        result_count = result.count()
-        imported_nfes = result.config(offset=offset, limit=limit)
+                    Eq(get_nfe_document_type('imported_nfe'), NFEPROC_TYPE))
+        if count_type == 'estimated':
+            result_count = estimate_count(store, Select(ImportedNfe.id, where=query,
+                                                        tables=[ImportedNfe]))
+        else:
+            result_count = store.find(ImportedNfe, query).count()
+
+        # Pages are fetched by the te_id of the first/last row of the page the cursor
+        # came from (keyset pagination), so deep pages are as fast as the first one.
+        # The offset is still accepted for backwards compatibility
+        order_by = [Desc(ImportedNfe.te_id), ImportedNfe.id]
+        if direction == 'next':
+            query = And(query, ImportedNfe.te_id < cursor_te_id)
+            offset = 0
+        elif direction == 'previous':
+            query = And(query, ImportedNfe.te_id > cursor_te_id)
+            order_by = [ImportedNfe.te_id, ImportedNfe.id]
+            offset = 0
+
+        # The purchase is found by the key extracted from its xml, which is indexed
+        # (see stoqserver.lib.indexes), and fetched in the same query as the nfes.
+        # Until the index is created, that would extract the key of every purchase,
+        # so they are looked up for each nfe of the page instead
+        join_purchases = index_exists(store, NFE_PURCHASE_KEY_INDEX)
+        if join_purchases:
+            tables = [ImportedNfe,
+                      LeftJoin(NFePurchase,
+                               And(NFePurchase.cnpj == ImportedNfe.cnpj,
+                                   Eq(get_nfe_key('nfe_purchase'), ImportedNfe.key)))]
+            result = store.using(*tables).find((ImportedNfe, NFePurchase.id), query)
+        else:
+            result = store.find(ImportedNfe, query)
+        result = result.order_by(*order_by)
+        # More than one purchase can be created from the same nfe. Keep one row per nfe.
+        # Also fetch one more row than needed, to know if there are more pages
+        imported_nfes = list(result.config(distinct=(ImportedNfe.te_id, ImportedNfe.id),
+                                           offset=offset, limit=limit + 1))
+        has_more = len(imported_nfes) > limit
+        imported_nfes = imported_nfes[:limit]
+
+        if direction == 'previous':
+            imported_nfes.reverse()
+            has_next, has_previous = True, has_more
+        elif direction == 'next':
+            has_next, has_previous = has_more, True
+        else:
+            has_next, has_previous = has_more, offset > 0
+
+        if join_purchases:
+            rows = imported_nfes
+        else:
+            rows = [(imported_nfe, self._find_nfe_purchase_id(store, imported_nfe))
+                    for imported_nfe in imported_nfes]
 
         records = []
-        for imported_nfe in imported_nfes:
-            # FIXME: Change it to a store.find() when NFePurchase.key had been implemented
-            query = "SELECT id FROM nfe_purchase WHERE cnpj='{}' AND xml::text ilike '%{}%'"
-            nfe_purchase = store.execute(query.format(imported_nfe.cnpj,
-                                                      imported_nfe.key)).get_one()
-
+        for imported_nfe, nfe_purchase_id in rows:
             process_date = imported_nfe.process_date
             record = {
                 'id': imported_nfe.id,
@@ -127,22 +214,22 @@ class ImportedNfeResource(BaseResource):
                 # Since process_date is a new column, we can't assure that
                 # all entries have it fulfilled
                 'process_date': process_date and process_date.isoformat(),
-                'purchase_invoice_id': nfe_purchase and nfe_purchase[0]
+                'purchase_invoice_id': nfe_purchase_id
             }
             records.append(record)
 
-        next_offset = offset + limit
-        has_next = result_count > next_offset
         next_ = None
-        if has_next:
-            next_ = self.routes[0] + '?limit={}&offset={}&cnpj={}'.format(
-                limit, offset + limit, cnpj)
-
-        has_previous = offset > 0
         previous = None
-        if has_previous:
-            previous = self.routes[0] + '?limit={}&offset={}&cnpj={}'.format(
-                limit, max(offset - limit, 0), cnpj)
+        if rows:
+            url = self.routes[0] + '?limit={}&cursor={}&cnpj={}'
+            if count_type != 'exact':
+                url += '&count=' + count_type
+            if has_next:
+                last_te_id = rows[-1][0].te_id
+                next_ = url.format(limit, encode_cursor('next', last_te_id), cnpj)
+            if has_previous:
+                first_te_id = rows[0][0].te_id
+                previous = url.format(limit, encode_cursor('previous', first_te_id), cnpj)
 
         response = {
             'previous': previous,
@@ -22,31 +22,146 @@
 # Author(s): Stoq Team <dev@stoq.com.br>
 #
 
-from decimal import Decimal
+from contextlib import suppress
+from decimal import Decimal, DecimalException
+import csv
+import json
 import logging
+import uuid
 
-from flask import abort, jsonify, make_response
+import gevent
+from flask import abort, after_this_request, jsonify, make_response, request
 
+from stoqlib.api import api
 from stoqlib.domain.inventory import Inventory
-from stoqlib.domain.person import Branch
-from stoqlib.domain.product import Sellable
+from stoqlib.domain.person import Branch, LoginUser
+from stoqlib.domain.product import Product, Sellable, Storable
 
 from stoqserver.lib.baseresource import BaseResource
+from stoqserver.lib.eventstream import (EventStream, EventStreamUnconnectedStation,
+                                        redis_server)
 from stoqserver.api.decorators import login_required, store_provider
 
 log = logging.getLogger(__name__)
 
-
-class InventoryResource(BaseResource):
-    method_decorators = [login_required, store_provider]
-    routes = ['/inventory', '/inventory/<uuid:inventory_id>']
+# Max number of lines in each chunk sent to an inventory session
+MAX_CHUNK_LINES = 10000
+# Sessions not touched for this long (in seconds) are discarded
+INVENTORY_SESSION_TTL = 24 * 60 * 60
+# Number of items adjusted between each flush/progress report when closing an inventory
+ADJUSTMENT_BATCH_SIZE = 200
+# For how long (in seconds) an inventory is locked by its closing job without reporting
+# any progress. If the process dies while closing it, it can be closed again after that
+CLOSING_LOCK_TTL = 5 * 60
+
+
+def _adjust_inventory(store, inventory, login_user, progress_callback=None):
+    """Adjust the stock of the counted items of inventory and close it
+
+    Each item is still adjusted (and its stock item, history and fiscal entry written)
+    separately by :meth:`InventoryItem.adjust`, since the stock rules (e.g. the average
+    cost and the batches) live there. Only the flushes are batched: the changes are
+    flushed every ADJUSTMENT_BATCH_SIZE items, and progress_callback(adjusted, total) is
+    called.
+    """
+    items = list(inventory.get_items_for_adjustment())
+    product_ids = {item.product_id for item in items}
+    # Keep the products, sellables and storables in the cache while adjusting the items,
+    # so they are not loaded one by one
+    preloaded = list(store.find((Product, Sellable), Product.id == Sellable.id,
+                                Product.id.is_in(product_ids)))
+    preloaded.extend(store.find(Storable, Storable.id.is_in(product_ids)))
+
+    for start in range(0, len(items), ADJUSTMENT_BATCH_SIZE):
+        for item in items[start:start + ADJUSTMENT_BATCH_SIZE]:
+            item.actual_quantity = item.counted_quantity
+            item.reason = 'Automatic adjustment'
+            item.adjust(login_user, invoice_number=None)
+
+        store.flush()
+        if progress_callback:
+            progress_callback(min(start + ADJUSTMENT_BATCH_SIZE, len(items)), len(items))
+
+    inventory.close()
+
+
+def _get_closing_key(inventory_id):
+    return 'inventory-closing-{}'.format(inventory_id)
+
+
+def _get_closing_lock_key(inventory_id):
+    return 'inventory-closing-{}-lock'.format(inventory_id)
+
+
+def _get_closing_job(inventory_id):
+    """Get the status of the background job closing the inventory, if there is one"""
+    job = redis_server.hgetall(_get_closing_key(inventory_id))
+    if not job:
+        return None
+
+    job = {k.decode(): v.decode() for k, v in job.items()}
+    if job.get('status') == 'running' and not redis_server.exists(
+            _get_closing_lock_key(inventory_id)):
+        # The process running it died and its lock expired
+        job.update(status='error', message='The closing of the inventory was interrupted')
+    for name in ['adjusted', 'total']:
+        job[name] = int(job.get(name, 0))
+    return job
+
+
+def _close_inventory_in_background(inventory_id, user_id, station_id):
+    """Close the inventory, reporting the progress to the station's EventStream
+
+    This is meant to run in its own greenlet. The progress can also be followed through
+    GET /inventory/<id>.
+    """
+    key = _get_closing_key(inventory_id)
+    lock_key = _get_closing_lock_key(inventory_id)
+
+    def _send_event(data):
+        data.update(inventory_id=inventory_id)
+        with suppress(EventStreamUnconnectedStation):
+            EventStream.add_station_event(station_id, data)
+
+    def _progress(adjusted, total):
+        redis_server.hset(key, mapping={'adjusted': adjusted, 'total': total})
+        # Still alive, keep the inventory locked
+        redis_server.expire(lock_key, CLOSING_LOCK_TTL)
+        _send_event({'type': 'INVENTORY_CLOSING_PROGRESS', 'adjusted': adjusted, 'total': total})
+
+    try:
+        with api.new_store() as store:
+            try:
+                inventory = store.get(Inventory, inventory_id)
+                login_user = store.get(LoginUser, user_id)
+                _adjust_inventory(store, inventory, login_user, progress_callback=_progress)
+            except Exception:
+                store.retval = False
+                raise
+    except Exception as e:
+        log.exception('Failed to close inventory %s', inventory_id)
+        redis_server.hset(key, mapping={'status': 'error', 'message': str(e)})
+        _send_event({'type': 'INVENTORY_CLOSING_FINISHED', 'success': False, 'message': str(e)})
+    else:
+        # Only report it as done after the store is committed
+        redis_server.hset(key, 'status', 'done')
+        _send_event({'type': 'INVENTORY_CLOSING_FINISHED', 'success': True})
+    finally:
+        redis_server.delete(lock_key)
+        redis_server.expire(key, INVENTORY_SESSION_TTL)
+
+
+class InventoryResourceMixin:
+    """Mixin class that provides common methods for creating inventories from counts"""
 
     def _apply_count_to_inventory(self, store, count, inventory):
         stock_not_managed = []
         unmanaged_barcodes = []
+        # Fetch all the items at once instead of looking for each sellable's item
+        inventory_items = {item.product_id: item for item in inventory.get_items()}
 
         for sellable, quantity in count.items():
-            inventory_item = inventory.get_items().find(product_id=sellable.id).one()
+            inventory_item = inventory_items.get(sellable.id)
 
             if inventory_item:
                 inventory_item.counted_quantity = quantity
@@ -78,9 +193,6 @@ class InventoryResource(BaseResource):
 
         :param count: a dict with string barcodes or codes as keys and its numeric quantities as
         values"""
-        data = {}
-        not_found = set()
-
         for barcode, quantity in count.items():
             if not barcode or not isinstance(barcode, str):
                 message = ('Invalid barcode provided: {}. '
@@ -94,9 +206,19 @@ class InventoryResource(BaseResource):
                 log.error(message)
                 abort(400, message)
 
-            sellable = store.find(Sellable, barcode=str(barcode)).one() or \
-                store.find(Sellable, code=str(barcode)).one()
+        # Resolve all the barcodes at once and then, the ones not found, by their codes
+        by_barcode = {}
+        for sellable in store.find(Sellable, Sellable.barcode.is_in(count.keys())):
+            by_barcode.setdefault(sellable.barcode, sellable)
+        by_code = {}
+        remaining = set(count.keys()) - set(by_barcode.keys())
+        for sellable in store.find(Sellable, Sellable.code.is_in(remaining)):
+            by_code.setdefault(sellable.code, sellable)
 
+        data = {}
+        not_found = set()
+        for barcode, quantity in count.items():
+            sellable = by_barcode.get(barcode) or by_code.get(barcode)
             if not sellable:
                 not_found.add(barcode)
                 continue
@@ -108,30 +230,11 @@ class InventoryResource(BaseResource):
 
         return data, not_found
 
-    def post(self, store):
-        branch_id = self.get_arg('branch_id')
-        count = self.get_arg('count')
-
-        if not branch_id:
-            message = 'No branch_id provided'
-            log.error(message)
-            abort(400, message)
-        if not count:
-            message = 'No count provided'
-            log.error(message)
-            abort(400, message)
-        if not isinstance(count, dict):
-            message = ('count should be a JSON with barcodes or codes as keys '
-                       'and counted quantities as values')
-            log.error(message)
-            abort(400, message)
-
-        branch = store.get(Branch, branch_id)
-        if not branch:
-            message = 'Branch {} not found'.format(branch_id)
-            log.error(message)
-            abort(404, message)
+    def _create_inventory(self, store, branch, count):
+        """Create an inventory for branch from count and return the response for it
 
+        :param count: a dict with string barcodes or codes as keys and its numeric quantities as
+        values"""
         login_user = self.get_current_user(store)
         station = self.get_current_station(store)
 
@@ -141,7 +244,10 @@ class InventoryResource(BaseResource):
         inventory = Inventory.create_inventory(store, branch, station, login_user, query)
         stock_not_managed = self._apply_count_to_inventory(store, sellable_count, inventory)
 
-        items_for_adjustment = inventory.get_items_for_adjustment()
+        items_for_adjustment = list(inventory.get_items_for_adjustment())
+        # Load the products at once. Their sellables are already loaded in sellable_count
+        products = {product.id: product for product in store.find(
+            Product, Product.id.is_in({item.product_id for item in items_for_adjustment}))}
 
         items_for_adjustment_list = []
         for item_for_adjustment in items_for_adjustment:
@@ -151,7 +257,7 @@ class InventoryResource(BaseResource):
                 'difference': str(item_for_adjustment.difference.normalize()),
                 'product': {
                     'sellable': {
-                        'barcode': item_for_adjustment.product.sellable.barcode,
+                        'barcode': products[item_for_adjustment.product_id].sellable.barcode,
                         'code': item_for_adjustment.get_code(),
                         'description': item_for_adjustment.get_description()
                     }
@@ -170,6 +276,72 @@ class InventoryResource(BaseResource):
             'items': items_for_adjustment_list
         }), 201)
 
+
+class InventoryResource(BaseResource, InventoryResourceMixin):
+    method_decorators = [login_required, store_provider]
+    routes = ['/inventory', '/inventory/<uuid:inventory_id>']
+
+    def _close_in_background(self, store, inventory, login_user):
+        key = _get_closing_key(inventory.id)
+        if not redis_server.set(_get_closing_lock_key(inventory.id), 1, nx=True,
+                                ex=CLOSING_LOCK_TTL):
+            message = 'Inventory {} is already being closed'.format(inventory.id)
+            log.error(message)
+            abort(409, message)
+
+        total = inventory.get_items_for_adjustment().count()
+        redis_server.delete(key)
+        redis_server.hset(key, mapping={'status': 'running', 'adjusted': 0, 'total': total})
+        gevent.spawn(_close_inventory_in_background, inventory.id, login_user.id,
+                     self.get_current_station(store).id)
+
+        return make_response(jsonify({
+            'id': inventory.id,
+            'identifier': inventory.identifier,
+            'status': inventory.status,
+            'closing': _get_closing_job(inventory.id),
+        }), 202)
+
+    def get(self, store, inventory_id=None):
+        inventory = inventory_id and store.get(Inventory, inventory_id)
+        if not inventory:
+            message = 'Inventory with ID = {} not found'.format(inventory_id)
+            log.error(message)
+            abort(404, message)
+
+        return make_response(jsonify({
+            'id': inventory.id,
+            'identifier': inventory.identifier,
+            'status': inventory.status,
+            'closing': _get_closing_job(inventory.id),
+        }), 200)
+
+    def post(self, store):
+        branch_id = self.get_arg('branch_id')
+        count = self.get_arg('count')
+
+        if not branch_id:
+            message = 'No branch_id provided'
+            log.error(message)
+            abort(400, message)
+        if not count:
+            message = 'No count provided'
+            log.error(message)
+            abort(400, message)
+        if not isinstance(count, dict):
+            message = ('count should be a JSON with barcodes or codes as keys '
+                       'and counted quantities as values')
+            log.error(message)
+            abort(400, message)
+
+        branch = store.get(Branch, branch_id)
+        if not branch:
+            message = 'Branch {} not found'.format(branch_id)
+            log.error(message)
+            abort(404, message)
+
+        return self._create_inventory(store, branch, count)
+
     def put(self, store, inventory_id):
         new_status = self.get_arg('status')
         if not new_status:
@@ -204,11 +376,9 @@ class InventoryResource(BaseResource):
                 assert inventory.is_open(
                 ), 'It isn\'t possible to close an inventory which is not opened'
 
-                for item in inventory.get_items_for_adjustment():
-                    item.actual_quantity = item.counted_quantity
-                    item.reason = 'Automatic adjustment'
-                    item.adjust(login_user, invoice_number=None)
-                inventory.close()
+                if self.get_arg('background'):
+                    return self._close_in_background(store, inventory, login_user)
+                _adjust_inventory(store, inventory, login_user)
             except AssertionError as err:
                 log.error(str(err))
                 abort(400, str(err))
@@ -218,3 +388,181 @@ class InventoryResource(BaseResource):
             'identifier': inventory.identifier,
             'status': inventory.status,
         }), 200)
+
+
+def _parse_count_chunk(stream, is_csv=False):
+    """Parse the barcode/quantity pairs of a count chunk
+
+    The stream is read line by line, either as NDJSON (one {"barcode": ..., "quantity": ...}
+    object per line) or as CSV (one barcode,quantity pair per line).
+
+    :returns: a list of [barcode, quantity] pairs, with the quantity as a string
+    :raises ValueError: if the chunk is invalid
+    """
+    pairs = []
+    for number, line in enumerate(stream, 1):
+        if number > MAX_CHUNK_LINES:
+            raise ValueError('Chunks can have at most {} lines'.format(MAX_CHUNK_LINES))
+
+        try:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            if is_csv:
+                barcode, quantity = next(csv.reader([line]))
+                quantity = Decimal(quantity)
+            else:
+                data = json.loads(line, parse_float=Decimal)
+                barcode, quantity = data['barcode'], data['quantity']
+        except (ValueError, TypeError, KeyError, DecimalException):
+            raise ValueError('Invalid line {}: {}'.format(number, line))
+
+        if not barcode or not isinstance(barcode, str):
+            raise ValueError('Invalid barcode on line {}: {}'.format(number, barcode))
+        if (not isinstance(quantity, (int, Decimal)) or
+                not Decimal(quantity).is_finite() or quantity < 0):
+            raise ValueError('Invalid quantity on line {}: {}'.format(number, quantity))
+
+        pairs.append([barcode, str(quantity)])
+
+    return pairs
+
+
+class InventorySessionResource(BaseResource, InventoryResourceMixin):
+    """Count an inventory in chunks
+
+    Instead of sending the whole count at once to /inventory, scanners can open a session,
+    send the count progressively and finish it when done:
+
+    * POST /inventory/session with a branch_id opens a session
+    * POST /inventory/session/<id> appends a chunk of barcode/quantity pairs to it, as NDJSON
+      or CSV (using a text/csv content type). Quantities of barcodes counted more than once
+      are summed
+    * PUT /inventory/session/<id> creates the inventory from the counted quantities, just like
+      POST /inventory would
+    * DELETE /inventory/session/<id> discards the session
+
+    The chunks are kept in redis until the session is finished, so the sessions can be used
+    by any of the server processes.
+    """
+
+    method_decorators = [login_required, store_provider]
+    routes = ['/inventory/session', '/inventory/session/<uuid:session_id>']
+
+    def _get_key(self, session_id):
+        return 'inventory-session-{}'.format(session_id)
+
+    def _get_session(self, store, session_id):
+        key = self._get_key(session_id)
+        session = {k.decode(): v.decode() for k, v in redis_server.hgetall(key).items()}
+        if not session:
+            message = 'Inventory session {} not found'.format(session_id)
+            log.error(message)
+            abort(404, message)
+
+        station = self.get_current_station(store)
+        if session['station_id'] != station.id:
+            message = 'Inventory session {} belongs to another station'.format(session_id)
+            log.error(message)
+            abort(403, message)
+
+        return session
+
+    def _iter_chunks(self, session_id, size=100):
+        key = self._get_key(session_id) + '-chunks'
+        start = 0
+        while True:
+            chunks = redis_server.lrange(key, start, start + size - 1)
+            if not chunks:
+                break
+            yield from chunks
+            start += size
+
+    def _discard(self, session_id):
+        key = self._get_key(session_id)
+        redis_server.delete(key, key + '-chunks')
+
+    def post(self, store, session_id=None):
+        if session_id:
+            return self._append(store, session_id)
+
+        branch_id = self.get_arg('branch_id')
+        if not branch_id:
+            message = 'No branch_id provided'
+            log.error(message)
+            abort(400, message)
+
+        branch = store.get(Branch, branch_id)
+        if not branch:
+            message = 'Branch {} not found'.format(branch_id)
+            log.error(message)
+            abort(404, message)
+
+        session_id = str(uuid.uuid4())
+        key = self._get_key(session_id)
+        redis_server.hset(key, mapping={
+            'branch_id': branch.id,
+            'station_id': self.get_current_station(store).id,
+        })
+        redis_server.expire(key, INVENTORY_SESSION_TTL)
+
+        return make_response(jsonify({
+            'id': session_id,
+            'branch_id': branch.id,
+        }), 201)
+
+    def _append(self, store, session_id):
+        self._get_session(store, session_id)
+
+        is_csv = (request.content_type or '').startswith('text/csv')
+        try:
+            pairs = _parse_count_chunk(request.stream, is_csv=is_csv)
+        except ValueError as err:
+            log.error(str(err))
+            abort(400, str(err))
+
+        key = self._get_key(session_id)
+        pipeline = redis_server.pipeline()
+        if pairs:
+            pipeline.rpush(key + '-chunks', json.dumps(pairs))
+        pipeline.expire(key, INVENTORY_SESSION_TTL)
+        pipeline.expire(key + '-chunks', INVENTORY_SESSION_TTL)
+        pipeline.llen(key + '-chunks')
+        chunks = pipeline.execute()[-1]
+
+        return make_response(jsonify({
+            'id': session_id,
+            'received': len(pairs),
+            'chunks': chunks,
+        }), 200)
+
+    def put(self, store, session_id):
+        session = self._get_session(store, session_id)
+
+        count = {}
+        for chunk in self._iter_chunks(session_id):
+            for barcode, quantity in json.loads(chunk.decode()):
+                count[barcode] = count.get(barcode, 0) + Decimal(quantity)
+
+        if not count:
+            message = 'No count provided'
+            log.error(message)
+            abort(400, message)
+
+        # Only discard the count after the inventory is committed, which happens after
+        # the method returns
+        @after_this_request
+        def _discard_session(response):
+            if response.status_code == 201:
+                self._discard(session_id)
+            return response
+
+        branch = store.get(Branch, session['branch_id'])
+        return self._create_inventory(store, branch, count)
+
+    def delete(self, store, session_id):
+        self._get_session(store, session_id)
+        self._discard(session_id)
+        return make_response(jsonify({
+            'id': session_id,
+        }), 200)
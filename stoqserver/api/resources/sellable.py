@@ -22,23 +22,94 @@
 # Author(s): Stoq Team <dev@stoq.com.br>
 #
 
+import datetime
 import logging
+import urllib.parse
+import uuid
 
 from decimal import Decimal, DecimalException
 from flask import abort, make_response, jsonify
+from storm.expr import Desc, Eq, Join, LeftJoin
 
 from stoqlib.domain.image import Image
 from stoqlib.domain.overrides import SellableBranchOverride
 from stoqlib.domain.person import Branch
 from stoqlib.domain.product import Product, Storable
 from stoqlib.domain.sellable import Sellable
+from stoqlib.domain.system import TransactionEntry
 
 from stoqserver.lib.baseresource import BaseResource
+from stoqserver.utils import decode_cursor, encode_cursor
 
 from stoqserver.api.decorators import login_required, store_provider
 
 log = logging.getLogger(__name__)
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+SELLABLE_FIELDS = ['id', 'barcode', 'description', 'notes', 'status', 'image_id']
+DEFAULT_SELLABLE_FIELDS = ['id', 'barcode', 'description', 'notes', 'image_id']
+MAX_BULK_SIZE = 5000
+BULK_BATCH_SIZE = 500
+
+
+def _parse_price(data):
+    """Get the base_price from the payload
+
+    :raises ValueError: if the price is not valid
+    """
+    try:
+        base_price = Decimal(data.get('base_price', "0.01") or '0.01')
+    except (TypeError, ValueError, DecimalException):
+        raise ValueError('Price with incorrect format')
+
+    if base_price and base_price < 0:
+        raise ValueError('Price must be greater than 0')
+
+    return base_price
+
+
+def _setup_sellable(store, sellable, data, base_price, product=None, has_storable=False):
+    """Fill a new sellable (or one pre-created on a sale) with the payload data
+
+    :param product: the product of the sellable, if it was pre-created on a sale.
+      A new one will be created otherwise
+    :param has_storable: if the product already has a storable
+    """
+    barcode = data.get('barcode')
+    sellable.code = barcode
+    sellable.barcode = barcode
+    sellable.description = data.get('description')
+    # FIXME The sellable is created with STATUS_CLOSED because we need the taxes info
+    # to start selling so this is just a temporary sellable just to save it on the
+    # database so the override can be created
+    sellable.status = Sellable.STATUS_CLOSED
+    sellable.base_price = base_price
+    # If the sellable was pre-created on a sale it has a notes informing it and to
+    # proceed this note is removed
+    sellable.notes = sellable.notes.replace(Sellable.NOTES_CREATED_VIA_SALE, "")
+
+    if product is None:
+        product = Product(store=store, sellable=sellable)
+
+    product_data = data.get('product')
+    product.manage_stock = product_data.get('manage_stock', False)
+
+    # For clients that will control their inventory, we have to create a Storable
+    if product.manage_stock and not has_storable:
+        storable = Storable(store=store, product=product)
+        storable.maximum_quantity = 1000
+
+    return product
+
+
+def _normalize_uuid(value):
+    """Get the canonical form of an uuid, as the ids are stored
+
+    :raises ValueError: if value is not an uuid
+    """
+    return str(uuid.UUID(str(value)))
+
 
 class SellableResource(BaseResource):
     method_decorators = [login_required, store_provider]
@@ -50,19 +121,12 @@ class SellableResource(BaseResource):
 
     def _price_validation(self, data):
         try:
-            base_price = Decimal(data.get('base_price', "0.01") or '0.01')
-        except (ValueError, DecimalException):
-            message = 'Price with incorrect format'
-            log.error(message)
-            abort(400, message)
-
-        if base_price and base_price < 0:
-            message = 'Price must be greater than 0'
+            return _parse_price(data)
+        except ValueError as e:
+            message = str(e)
             log.error(message)
             abort(400, message)
 
-        return base_price
-
     def _create_sellable_dict(self, sellable, image):
         return {
             'id': sellable.id,
@@ -83,7 +147,6 @@ class SellableResource(BaseResource):
 
         sellable_id = data.get('sellable_id')
         barcode = data.get('barcode')
-        description = data.get('description')
         base_price = self._price_validation(data)
         sellable = store.get(Sellable, sellable_id)
         sellable_created_via_sale = sellable and Sellable.NOTES_CREATED_VIA_SALE in sellable.notes
@@ -106,28 +169,12 @@ class SellableResource(BaseResource):
             sellable = Sellable(store=store)
             if sellable_id:
                 sellable.id = sellable_id
-        sellable.code = barcode
-        sellable.barcode = barcode
-        sellable.description = description
-        # FIXME The sellable is created with STATUS_CLOSED because we need the taxes info
-        # to start selling so this is just a temporary sellable just to save it on the
-        # database so the override can be created
-        sellable.status = Sellable.STATUS_CLOSED
-        sellable.base_price = base_price
-        # If the sellable was pre-created on a sale it has a notes informing it and to
-        # proceed this note is removed
-        sellable.notes = sellable.notes.replace(Sellable.NOTES_CREATED_VIA_SALE, "")
-
-        product = sellable.product if sellable_created_via_sale else (
-            Product(store=store, sellable=sellable))
-
-        product_data = data.get('product')
-        product.manage_stock = product_data.get('manage_stock', False)
-
-        # For clients that will control their inventory, we have to create a Storable
-        if product.manage_stock and not store.get(Storable, product.id):
-            storable = Storable(store=store, product=product)
-            storable.maximum_quantity = 1000
+
+        if sellable_created_via_sale:
+            _setup_sellable(store, sellable, data, base_price, product=sellable.product,
+                            has_storable=bool(store.get(Storable, sellable.product.id)))
+        else:
+            _setup_sellable(store, sellable, data, base_price)
 
         return make_response(jsonify({
             'message': 'Product created',
@@ -198,10 +245,280 @@ class SellableResource(BaseResource):
                 "data": self._create_sellable_dict(sellable, image)
             }), 200)
 
+        limit = self.get_arg('limit')
+        cursor = self.get_arg('cursor')
+        # The filters are kept in the next link
+        filters = {name: self.get_arg(name) for name in
+                   ['fields', 'status', 'barcode', 'updated_since']}
+        filters = {name: value for name, value in filters.items() if value}
+        fields = filters.get('fields')
+        status = filters.get('status')
+        barcode = filters.get('barcode')
+        updated_since = filters.get('updated_since')
+
+        # Without 'limit' nor 'cursor' the whole list is returned, as before the
+        # pagination existed
+        paginate = bool(limit or cursor)
+        try:
+            limit = int(limit or DEFAULT_PAGE_SIZE) if paginate else None
+        except (TypeError, ValueError):
+            message = "'limit' must be a number"
+            log.error(message)
+            abort(400, message)
+
+        if paginate and limit > MAX_PAGE_SIZE:
+            message = "'limit' must be lower than %s" % MAX_PAGE_SIZE
+            log.error(message)
+            abort(400, message)
+
+        if cursor:
+            try:
+                last_te_id, = decode_cursor(cursor)
+                if not isinstance(last_te_id, int):
+                    raise ValueError(cursor)
+            except ValueError:
+                message = "Invalid 'cursor' provided"
+                log.error(message)
+                abort(400, message)
+
+        fields = fields.split(',') if fields else DEFAULT_SELLABLE_FIELDS
+        invalid_fields = set(fields) - set(SELLABLE_FIELDS)
+        if invalid_fields:
+            message = 'Invalid fields: {}'.format(', '.join(sorted(invalid_fields)))
+            log.error(message)
+            abort(400, message)
+
+        if status and status not in [Sellable.STATUS_AVAILABLE, Sellable.STATUS_CLOSED]:
+            message = 'Status must be: {} or {}'.format(Sellable.STATUS_AVAILABLE,
+                                                        Sellable.STATUS_CLOSED)
+            log.error(message)
+            abort(400, message)
+
+        if updated_since:
+            for date_format in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+                try:
+                    updated_since = datetime.datetime.strptime(updated_since, date_format)
+                    break
+                except ValueError:
+                    continue
+            else:
+                message = "Invalid 'updated_since' provided: {}".format(updated_since)
+                log.error(message)
+                abort(400, message)
+
+        # Only the needed columns are fetched, and the main image (or any other, if the
+        # sellable doesn't have a main one) in the same query, so listing the whole
+        # catalog doesn't need one query per sellable
+        tables = [Sellable,
+                  Join(TransactionEntry, TransactionEntry.id == Sellable.te_id),
+                  LeftJoin(Image, Image.sellable_id == Sellable.id)]
+        columns = (Sellable.te_id, Sellable.id, Sellable.barcode, Sellable.description,
+                   Sellable.notes, Sellable.status, Image.id)
+        clauses = []
+        if cursor:
+            clauses.append(Sellable.te_id > last_te_id)
+        if status:
+            clauses.append(Eq(Sellable.status, status))
+        if barcode:
+            clauses.append(Eq(Sellable.barcode, barcode))
+        if updated_since:
+            clauses.append(TransactionEntry.te_time >= updated_since)
+
+        result = store.using(*tables).find(columns, *clauses)
+        result = result.order_by(Sellable.te_id, Desc(Image.is_main))
+        result = result.config(distinct=(Sellable.te_id, ), limit=limit)
+
         sellables = []
-        for sellable in store.find(Sellable):
-            image = store.find(Image, sellable_id=sellable.id).one()
-            sellables.append(self._create_sellable_dict(sellable, image))
+        te_id = None
+        for te_id, *values in result:
+            row = dict(zip(SELLABLE_FIELDS, values))
+            sellables.append({field: row[field] for field in fields})
+
+        next_ = None
+        if paginate and len(sellables) == limit:
+            args = dict(filters, limit=limit, cursor=encode_cursor(te_id))
+            next_ = self.routes[0] + '?' + urllib.parse.urlencode(sorted(args.items()))
+
+        return make_response(jsonify({'data': sellables, 'next': next_}), 200)
+
+
+class SellableBulkResource(BaseResource):
+    """Create sellables and update their branch overrides in bulk
+
+    The payload is like::
+
+        {
+            "sellables": [{"sellable_id": ..., "barcode": ..., "description": ...,
+                           "base_price": ..., "product": {"manage_stock": ...}}],
+            "overrides": [{"sellable_id": ..., "branch_id": ..., "status": ...,
+                           "base_price": ...}]
+        }
+
+    Each row follows the same rules as POST /sellable and PUT /sellable/<id>/override/<id>,
+    but an invalid row doesn't fail the whole request. Instead, the response will have the
+    result of each row, in the same order they were sent.
+    """
 
-        # TODO: Maybe add pagination
-        return make_response(jsonify({'data': sellables}), 200)
+    method_decorators = [login_required, store_provider]
+    routes = ['/sellable/bulk']
+
+    def _chunks(self, rows):
+        for i in range(0, len(rows), BULK_BATCH_SIZE):
+            yield i, rows[i:i + BULK_BATCH_SIZE]
+
+    def _create_sellables(self, store, rows):
+        results = []
+        seen_ids = set()
+        seen_barcodes = set()
+        for start, chunk in self._chunks(rows):
+            created = []
+            ids = {row.get('sellable_id') for row in chunk if row.get('sellable_id')}
+            barcodes = {row.get('barcode') for row in chunk if row.get('barcode')}
+            sellables = {s.id: s for s in store.find(Sellable, Sellable.id.is_in(ids))}
+            used_barcodes = set(store.find(Sellable.barcode, Sellable.barcode.is_in(barcodes)))
+            storable_ids = set(store.find(Storable.id, Storable.id.is_in(set(sellables))))
+
+            for index, row in enumerate(chunk, start):
+                outcome = {'index': index, 'sellable_id': row.get('sellable_id')}
+                results.append(outcome)
+                try:
+                    base_price = _parse_price(row)
+                except ValueError as e:
+                    outcome.update(result='error', message=str(e))
+                    continue
+
+                sellable_id = row.get('sellable_id')
+                barcode = row.get('barcode')
+                sellable = sellables.get(sellable_id)
+                created_via_sale = sellable and Sellable.NOTES_CREATED_VIA_SALE in sellable.notes
+                if not isinstance(row.get('product'), dict):
+                    outcome.update(result='error',
+                                   message='There is no product data on payload')
+                elif (sellable and not created_via_sale) or sellable_id in seen_ids:
+                    message = 'Product with id {} already exists'.format(sellable_id)
+                    outcome.update(result='exists', message=message)
+                elif barcode and (barcode in used_barcodes or barcode in seen_barcodes):
+                    message = 'Product with barcode {} already exists'.format(barcode)
+                    outcome.update(result='exists', message=message)
+                if 'result' in outcome:
+                    continue
+
+                if created_via_sale:
+                    _setup_sellable(store, sellable, row, base_price, product=sellable.product,
+                                    has_storable=sellable.id in storable_ids)
+                else:
+                    sellable = Sellable(store=store)
+                    if sellable_id:
+                        sellable.id = sellable_id
+                    _setup_sellable(store, sellable, row, base_price)
+
+                if sellable_id:
+                    seen_ids.add(sellable_id)
+                if barcode:
+                    seen_barcodes.add(barcode)
+                outcome['result'] = 'created'
+                created.append((outcome, sellable))
+
+            # Write each batch as soon as it is ready, to keep the pending changes small
+            store.flush()
+            for outcome, sellable in created:
+                outcome['sellable_id'] = sellable.id
+
+        return results
+
+    def _update_overrides(self, store, rows):
+        results = []
+        statuses = [Sellable.STATUS_AVAILABLE, Sellable.STATUS_CLOSED]
+        for start, chunk in self._chunks(rows):
+            sellable_ids = {row.get('sellable_id') for row in chunk if row.get('sellable_id')}
+            branch_ids = {row.get('branch_id') for row in chunk if row.get('branch_id')}
+            sellables = {s.id: s for s in store.find(Sellable, Sellable.id.is_in(sellable_ids))}
+            branches = {b.id: b for b in store.find(Branch, Branch.id.is_in(branch_ids))}
+            overrides = {
+                (sbo.sellable_id, sbo.branch_id): sbo for sbo in store.find(
+                    SellableBranchOverride,
+                    SellableBranchOverride.sellable_id.is_in(sellable_ids),
+                    SellableBranchOverride.branch_id.is_in(branch_ids))}
+
+            for index, row in enumerate(chunk, start):
+                sellable_id = row.get('sellable_id')
+                branch_id = row.get('branch_id')
+                status = row.get('status')
+                outcome = {'index': index, 'sellable_id': sellable_id, 'branch_id': branch_id}
+                results.append(outcome)
+                try:
+                    base_price = _parse_price(row)
+                except ValueError as e:
+                    outcome.update(result='error', message=str(e))
+                    continue
+
+                sellable = sellables.get(sellable_id)
+                branch = branches.get(branch_id)
+                if status and status not in statuses:
+                    message = 'Status must be: {} or {}'.format(*statuses)
+                    outcome.update(result='error', message=message)
+                elif not sellable:
+                    message = 'Sellable with ID = {} not found'.format(sellable_id)
+                    outcome.update(result='error', message=message)
+                elif not branch:
+                    message = 'Branch with ID = {} not found'.format(branch_id)
+                    outcome.update(result='error', message=message)
+                if 'result' in outcome:
+                    continue
+
+                sbo = overrides.get((sellable.id, branch.id))
+                if not sbo:
+                    sbo = SellableBranchOverride(store=store, branch=branch, sellable=sellable)
+                    overrides[(sellable.id, branch.id)] = sbo
+                if status:
+                    sbo.status = status
+                sbo.base_price = base_price or sbo.base_price
+                outcome.update(result='updated', base_price=str(sbo.base_price),
+                               status=sbo.status)
+
+            store.flush()
+
+        return results
+
+    def post(self, store):
+        data = self.get_json() or {}
+        sellables = data.get('sellables') or []
+        overrides = data.get('overrides') or []
+
+        log.debug("POST /sellable/bulk station: %s sellables: %s overrides: %s",
+                  self.get_current_station(store), len(sellables), len(overrides))
+
+        if not isinstance(sellables, list) or not isinstance(overrides, list):
+            message = "'sellables' and 'overrides' must be lists"
+            log.error(message)
+            abort(400, message)
+
+        if len(sellables) + len(overrides) > MAX_BULK_SIZE:
+            message = 'At most {} sellables and overrides can be sent at once'.format(
+                MAX_BULK_SIZE)
+            log.error(message)
+            abort(400, message)
+
+        if not all(isinstance(row, dict) for row in sellables + overrides):
+            message = 'Each sellable and override must be an object'
+            log.error(message)
+            abort(400, message)
+
+        # An id of an existing sellable sent in another form (e.g. upper case) would not
+        # be found, and the sellable would be created again
+        for row in sellables + overrides:
+            for name in ['sellable_id', 'branch_id']:
+                if not row.get(name):
+                    continue
+                try:
+                    row[name] = _normalize_uuid(row[name])
+                except ValueError:
+                    message = 'Invalid {} {}'.format(name, row[name])
+                    log.error(message)
+                    abort(400, message)
+
+        # The sellables are created first, so the overrides can refer to them
+        return make_response(jsonify({
+            'sellables': self._create_sellables(store, sellables),
+            'overrides': self._update_overrides(store, overrides),
+        }), 200)
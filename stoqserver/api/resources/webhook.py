@@ -1,33 +1,79 @@
 import logging
 
-from flask import make_response, request
+from flask import abort, make_response, request
 
 from stoqlib.lib.configparser import get_config
+from stoqserver.lib import delivery, ingestion
 from stoqserver.lib.baseresource import BaseResource
 from stoqserver.signals import WebhookEvent
 
 log = logging.getLogger(__name__)
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 
 class IntegrationWebhookException(Exception):
     pass
 
 
+def check_access_token(token):
+    config = get_config()
+    if not config.has_section('Integration'):
+        return False
+
+    return token == config.get('Integration', 'access_token')
+
+
+def _get_page_args():
+    """Get the start and count of the page of events requested"""
+    args = {}
+    for name, default in [('start', 0), ('count', DEFAULT_PAGE_SIZE)]:
+        try:
+            args[name] = int(request.args.get(name, default))
+        except ValueError:
+            message = "'%s' must be a number" % name
+            log.error(message)
+            abort(400, message)
+
+    if args['start'] < 0:
+        message = "'start' must not be negative"
+        log.error(message)
+        abort(400, message)
+
+    if not 0 < args['count'] <= MAX_PAGE_SIZE:
+        message = "'count' must be between 1 and %s" % MAX_PAGE_SIZE
+        log.error(message)
+        abort(400, message)
+
+    return args['start'], args['count']
+
+
 class WebhookEventResource(BaseResource):
     routes = ['/v1/webhooks/event']
 
     def check_token(self, token):
-        config = get_config()
-        if not config.has_section('Integration'):
-            return False
+        return check_access_token(token)
 
-        return token == config.get('Integration', 'access_token')
+    def _ingest(self):
+        # The event will be processed in the background, see stoqserver.lib.ingestion
+        try:
+            event_id, ingested = ingestion.ingest_event(request.data)
+        except ValueError:
+            message = 'Invalid webhook event'
+            log.error(message)
+            abort(400, message)
+
+        return {'id': event_id, 'duplicated': not ingested}, 202
 
     def post(self):
         token = request.headers.get('Authorization')
         if not self.check_token(token):
             return make_response('Invalid access token', 401)
 
+        if get_config().get('Integration', 'webhook_ingest') == 'true':
+            return self._ingest()
+
         data = self.get_json()
         log.info('Webhook event: %s', data)
 
@@ -41,3 +87,89 @@ class WebhookEventResource(BaseResource):
         # Get first non false response from the event
         reply = replies[0] if replies else None
         return reply, 200
+
+
+class _QueueResourceMixin:
+    """Status and dead letters of the queues of events processed in the background
+
+    See :mod:`stoqserver.lib.redisqueue`. Subclasses define the module that handles them.
+    """
+    # What the queues are, used in the error messages
+    queue_description = None
+    # The key the dead letters are returned in
+    dead_letters_key = 'dead_letters'
+
+    def get_status(self):
+        raise NotImplementedError
+
+    def get_dead_letters(self, name, start, count):
+        raise NotImplementedError
+
+    def requeue_dead_letters(self, name):
+        raise NotImplementedError
+
+    def _get_queue_name(self, name):
+        if not check_access_token(request.headers.get('Authorization')):
+            abort(401, 'Invalid access token')
+
+        if name is not None and name not in self.get_status():
+            message = '%s %s not found' % (self.queue_description, name)
+            log.error(message)
+            abort(404, message)
+        return name
+
+    def get(self, name=None):
+        name = self._get_queue_name(name)
+        if name is None:
+            return self.get_status()
+
+        start, count = _get_page_args()
+        return {
+            'status': self.get_status()[name],
+            self.dead_letters_key: self.get_dead_letters(name, start=start, count=count),
+        }
+
+    def post(self, name=None):
+        """Requeue the dead letters of a queue"""
+        name = self._get_queue_name(name)
+        if name is None:
+            abort(405)
+
+        return {'requeued': self.requeue_dead_letters(name)}
+
+
+class DeliveryResource(_QueueResourceMixin, BaseResource):
+    """Status and dead letters of the events delivered to external systems
+
+    See :mod:`stoqserver.lib.delivery`
+    """
+    routes = ['/v1/webhooks/deliveries', '/v1/webhooks/deliveries/<string:name>']
+    queue_description = 'Destination'
+
+    def get_status(self):
+        return delivery.get_status()
+
+    def get_dead_letters(self, name, start, count):
+        return delivery.get_dead_letters(name, start=start, count=count)
+
+    def requeue_dead_letters(self, name):
+        return delivery.requeue_dead_letters(name)
+
+
+class IngestionResource(_QueueResourceMixin, BaseResource):
+    """Status and failed events of the webhook events processed in the background
+
+    See :mod:`stoqserver.lib.ingestion`
+    """
+    routes = ['/v1/webhooks/ingestion', '/v1/webhooks/ingestion/<string:name>']
+    queue_description = 'Source'
+    dead_letters_key = 'failed_events'
+
+    def get_status(self):
+        return ingestion.get_status()
+
+    def get_dead_letters(self, name, start, count):
+        return ingestion.get_failed_events(name, start=start, count=count)
+
+    def requeue_dead_letters(self, name):
+        return ingestion.requeue_failed_events(name)
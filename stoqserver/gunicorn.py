@@ -25,8 +25,9 @@
 
 run with:
 
-    gunicorn stoqserver.gunicorn -w 4 -b localhost:6971 -k gevent
+    gunicorn stoqserver.gunicorn -c python:stoqserver.gunicorn_config -b localhost:6971
 
+See stoqserver.gunicorn_config for how the workers are set up.
 """
 
 from stoqserver import activate_virtualenv
@@ -40,7 +41,7 @@ patch_psycopg()
 
 import stoq
 from stoqserver import app
-from stoqserver.main import setup_stoq, setup_logging
+from stoqserver.main import prepare_for_fork, setup_stoq, setup_logging
 
 import sys
 # sys.argv comes with the arguments passed to gunicorn, but stoq will not work well with those.
@@ -50,3 +51,7 @@ setup_stoq(register_station=True, name='stoqflask', version=stoq.version)
 setup_logging(app_name='stoq-flask')
 
 application = app.bootstrap_app(debug=False, multiclient=True)
+
+# When the app is preloaded this runs in the gunicorn master, before forking the workers.
+# Otherwise it runs in each worker, where it is harmless
+prepare_for_fork()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+"""Gunicorn configuration for stoqserver.gunicorn
+
+use with:
+
+    gunicorn stoqserver.gunicorn -c python:stoqserver.gunicorn_config -b localhost:6971
+
+The app is preloaded: the master sets up stoq (loading the plugins and the heavy modules)
+once and forks the workers from it, so they start right away and share the memory of what
+was loaded with the master (as long as it isn't written to). Before forking, the master
+closes its connections to the database and redis (see stoqserver.main.prepare_for_fork),
+so each worker opens its own when it needs them.
+
+Note that the app is not reloaded when a worker is restarted, so the master needs to be
+restarted (not only sent a HUP) to load new code or plugins.
+
+To compare the startup time and memory with and without preloading, start the server with
+--preload/--no-preload (or STOQSERVER_GUNICORN_PRELOAD=0), time until the workers log
+"Booting worker" and "Worker ... initialized", and sum the proportional set size (Pss,
+which splits the shared pages among the processes) of the master and the workers:
+
+    for pid in $(pgrep -f stoqserver.gunicorn); do
+        grep ^Pss: /proc/$pid/smaps_rollup
+    done
+"""
+
+import os
+
+bind = 'localhost:6971'
+worker_class = 'gevent'
+workers = int(os.environ.get('STOQSERVER_GUNICORN_WORKERS', 4))
+preload_app = os.environ.get('STOQSERVER_GUNICORN_PRELOAD', '1') != '0'
+
+
+def post_fork(server, worker):
+    # Without preloading, the app is only loaded by the worker after this
+    if not server.cfg.preload_app:
+        return
+
+    from stoqserver.main import reinit_after_fork
+    reinit_after_fork()
@@ -27,7 +27,7 @@ import json
 import logging
 
 import gevent
-from flask import request
+from flask import abort, request
 from flask_restful import Resource
 from serial.serialutil import SerialException
 
@@ -37,7 +37,7 @@ from stoqlib.domain.devices import DeviceSettings
 from stoqlib.domain.token import AccessToken
 from stoqlib.lib.pluginmanager import get_plugin_manager, PluginError
 from ..app import is_multiclient
-from .lock import printer_lock
+from .lock import LockFailedException, lock_station, printer_lock
 
 log = logging.getLogger(__name__)
 
@@ -52,6 +52,10 @@ def get_plugin(manager, name):
 class BaseResource(Resource):
 
     routes = []
+    # The statement timeout (in seconds) of the stores provided to this resource by
+    # store_provider/readonly_store_provider. Can be overridden in the StatementTimeouts
+    # section of the config
+    statement_timeout = None
 
     def get_json(self):
         if not request.data:
@@ -82,6 +86,24 @@ class BaseResource(Resource):
         station = self.get_current_station(store)
         return station and station.branch
 
+    def lock_current_station(self, store):
+        """Lock the current station until the transaction of store is finished
+
+        See :func:`stoqserver.lib.lock.lock_station`
+        """
+        station = self.get_current_station(store)
+        if station is None:
+            message = 'There is no station associated with the access token'
+            log.error(message)
+            abort(400, message)
+
+        try:
+            lock_station(store, station)
+        except LockFailedException:
+            message = 'Another operation is in progress in station %s' % station.name
+            log.error(message)
+            abort(409, message)
+
     @classmethod
     def ensure_printer(cls, station, retries=20):
         # In multiclient mode there is no local printer
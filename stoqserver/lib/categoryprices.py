@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Cache of the client category prices (the price tables) of each station catalog
+
+Every station loads the /data resource, which includes the category prices of all the
+sellables in its catalog. Those prices rarely change, so they are kept in memory for each
+catalog (i.e. for each branch and station type) along with a version of those prices.
+
+The price tables are edited by other processes (e.g. Stoq desktop), so the version is read
+from the database (see :func:`get_prices_version`) and the cached prices are discarded
+when it changes. The version can miss a change committed by a transaction that started
+before the last one seen, so the cached prices also expire after :obj:`CACHE_TTL`.
+"""
+
+import threading
+import time
+
+from storm.expr import Count, Max
+
+from stoqlib.domain.sellable import ClientCategoryPrice
+from stoqlib.domain.system import TransactionEntry
+
+# Time (in seconds) the prices of a catalog are kept in the cache
+CACHE_TTL = 5 * 60
+
+
+def get_prices_version(store):
+    """Get the current version of the price tables
+
+    Changing or creating a price updates its te_time, and removing one changes the
+    count of the prices.
+    """
+    return tuple(store.find(
+        (Count(ClientCategoryPrice.id), Max(TransactionEntry.te_time)),
+        ClientCategoryPrice.te_id == TransactionEntry.id).one())
+
+
+class CategoryPriceCache:
+    """A cache of catalog -> category prices of its sellables"""
+
+    def __init__(self, ttl=CACHE_TTL):
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, catalog, version, sellable_ids):
+        """Get the prices of catalog
+
+        :param version: the current version of the price tables
+        :param sellable_ids: the ids of the sellables currently in the catalog. If some of
+          them were not in the catalog when the prices were cached, they are not valid anymore
+        :returns: a dict of sellable id -> {category id: price} or None if there
+          are no valid prices cached for the catalog
+        """
+        with self._lock:
+            entry = self._entries.get(catalog)
+        if entry is None:
+            return None
+
+        cached_version, cached_ids, prices, expires = entry
+        if expires < time.monotonic():
+            return None
+        if cached_version != version or not cached_ids.issuperset(sellable_ids):
+            return None
+        return prices
+
+    def set(self, catalog, version, sellable_ids, prices):
+        with self._lock:
+            self._entries[catalog] = (version, frozenset(sellable_ids), prices,
+                                      time.monotonic() + self._ttl)
+
+    def invalidate(self):
+        """Remove the prices of all the catalogs"""
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = CategoryPriceCache()
+
+
+def get_cached_prices(catalog, version, sellable_ids):
+    """See :meth:`CategoryPriceCache.get`
+
+    :param catalog: a (branch id, station type name) tuple
+    """
+    return _cache.get(catalog, version, sellable_ids)
+
+
+def cache_prices(catalog, version, sellable_ids, prices):
+    """Cache the prices of catalog. See :func:`get_cached_prices`"""
+    _cache.set(catalog, version, sellable_ids, prices)
+
+
+def clear_cache():
+    """Clear all the cached prices"""
+    _cache.invalidate()
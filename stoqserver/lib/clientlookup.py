@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Lookup of persons (and so, clients) by their CPF/CNPJ
+
+The same client is usually looked up more than once during a checkout, so the person ids
+are kept in a small LRU cache, indexed by the document digits. Only the persons that were
+found are cached, and a hit is checked against the database with a single query by the
+person id, so a person created (or changed) by another request or process is never
+hidden by the cache.
+
+Whether the expression indexes used by the digits-only lookup exist is checked once per
+process, so the server must be restarted after running `stoqserver create_indexes`.
+"""
+
+import collections
+import threading
+import time
+
+from storm.expr import Eq, LeftJoin, Or
+
+from stoqlib.domain.person import Company, Individual, Person
+from stoqlib.lib.formatters import format_document, raw_document
+
+from stoqserver.lib.indexes import get_document_digits, index_exists
+
+CACHE_SIZE = 1024
+# Time (in seconds) an entry is kept in the cache
+CACHE_TTL = 60
+_MISSING = object()
+
+
+class DocumentCache:
+    """A LRU cache of document digits -> person id"""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self._size = size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, document):
+        with self._lock:
+            entry = self._entries.get(document, _MISSING)
+            if entry is _MISSING:
+                return _MISSING
+
+            person_id, expires = entry
+            if expires < time.monotonic():
+                del self._entries[document]
+                return _MISSING
+
+            self._entries.move_to_end(document)
+            return person_id
+
+    def set(self, document, person_id):
+        with self._lock:
+            self._entries[document] = (person_id, time.monotonic() + self._ttl)
+            self._entries.move_to_end(document)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, document=None):
+        """Remove document from the cache, or all the documents if it is None"""
+        with self._lock:
+            if document is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(document, None)
+
+
+_cache = DocumentCache()
+# Index name -> if it exists
+_indexes = {}
+
+
+def _index_exists(store, name):
+    exists = _indexes.get(name)
+    if exists is None:
+        exists = _indexes[name] = index_exists(store, name)
+    return exists
+
+
+def _get_cached_person(store, person_id, digits):
+    # The person may have been removed or had its document changed since it was cached
+    tables = [Person,
+              LeftJoin(Individual, Individual.person_id == Person.id),
+              LeftJoin(Company, Company.person_id == Person.id)]
+    return store.using(*tables).find(
+        Person, Person.id == person_id,
+        Or(Eq(get_document_digits('individual', 'cpf'), digits),
+           Eq(get_document_digits('company', 'cnpj'), digits))).one()
+
+
+def _find_person(store, digits):
+    # The documents are usually stored formatted, and that lookup is indexed
+    person = Person.get_by_document(store, format_document(digits))
+    if person is not None:
+        return person
+
+    # Otherwise, compare only the digits. That needs the expression indexes
+    # (see stoqserver.lib.indexes), or it would scan the whole table
+    if len(digits) == 11:
+        if not _index_exists(store, 'individual_cpf_digits_idx'):
+            return None
+        return store.find(Person, Person.id == Individual.person_id,
+                          Eq(get_document_digits('individual', 'cpf'), digits)).any()
+
+    if not _index_exists(store, 'company_cnpj_digits_idx'):
+        return None
+    return store.find(Person, Person.id == Company.person_id,
+                      Eq(get_document_digits('company', 'cnpj'), digits)).any()
+
+
+def find_person_by_document(store, document):
+    """Find the person with the given CPF/CNPJ, formatted or not
+
+    :returns: the :class:`Person` or None if there is no person with that document
+    """
+    digits = raw_document(document or '')
+    if not digits:
+        return None
+
+    person_id = _cache.get(digits)
+    if person_id is not _MISSING:
+        person = _get_cached_person(store, person_id, digits)
+        if person is not None:
+            return person
+        _cache.invalidate(digits)
+
+    person = _find_person(store, digits)
+    # Persons that were not found are not cached, since they can be created by
+    # another request at any moment
+    if person is not None:
+        _cache.set(digits, person.id)
+    return person
+
+
+def clear_cache():
+    """Clear all the cached lookups and indexes"""
+    _cache.invalidate()
+    _indexes.clear()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Delivery of events to external systems (e.g. the webhooks of an integration)
+
+Instead of pushing the events to the external systems while handling a request, they are
+queued in redis with :func:`enqueue_event` and delivered in the background, so the
+integrations never add latency to the requests (e.g. the checkout).
+
+The destinations are registered by the plugins with :func:`register_destination`. Each
+destination has its own :class:`stoqserver.lib.redisqueue.RedisQueue`, and its events are
+delivered in order, in batches of up to `batch_size` events, POSTed as a json list to its
+url. When a delivery fails, it is tried again with an exponential backoff. After
+:obj:`MAX_ATTEMPTS` failures the batch is moved to the dead letters of the destination,
+which can be inspected and requeued (see :func:`get_dead_letters` and
+:func:`requeue_dead_letters`).
+
+The events are delivered at least once: if a worker dies after a delivery but before
+removing its events from the queue, they will be delivered again, so the destinations
+should use their ids to ignore duplicates.
+"""
+
+import datetime
+import json
+import logging
+import uuid
+
+from stoqserver.lib import httpclient
+from stoqserver.lib.eventstream import redis_server
+from stoqserver.lib.redisqueue import QueueWorkers, RedisQueue
+from stoqserver.utils import JsonEncoder
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+MAX_ATTEMPTS = 10
+# Max number of destinations being delivered at the same time by this process
+MAX_CONCURRENT_DELIVERIES = 4
+
+_destinations = {}
+
+
+class Destination(RedisQueue):
+    """An external system the events are delivered to
+
+    :param name: the name of the destination, which identifies its queue
+    :param url: the url the events are POSTed to
+    :param headers: extra headers of the requests (e.g. for authentication)
+    :param batch_size: max number of events delivered in a single request
+    """
+
+    def __init__(self, name, url, headers=None, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__('delivery', name, MAX_ATTEMPTS)
+        self.url = url
+        self.headers = headers or {}
+        self.batch_size = batch_size
+
+
+def register_destination(name, url, headers=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Register a destination, so events can be enqueued to it
+
+    See :class:`Destination` for the arguments.
+    """
+    destination = _destinations[name] = Destination(name, url, headers=headers,
+                                                    batch_size=batch_size)
+    return destination
+
+
+def get_destination(name):
+    return _destinations[name]
+
+
+def enqueue_event(name, data):
+    """Enqueue an event to be delivered to the destination with name
+
+    :param data: the event. It must be serializable to json
+    :returns: the id of the event
+    """
+    destination = get_destination(name)
+    event_id = str(uuid.uuid4())
+    event = {
+        'id': event_id,
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'data': data,
+    }
+    redis_server.rpush(destination.queue_key, json.dumps(event, cls=JsonEncoder))
+    start_workers()
+    _workers.wakeup()
+    return event_id
+
+
+def deliver(destination):
+    """Deliver the next batch of events of destination
+
+    :returns: the number of events delivered
+    """
+    def _post(events):
+        response = httpclient.post(destination.url, headers=destination.headers, json=events)
+        response.raise_for_status()
+
+    delivered = destination.process(_post, count=destination.batch_size)
+    if delivered:
+        log.info('Delivered %s events to %s', delivered, destination.name)
+    return delivered
+
+
+def _deliver_all(destination):
+    # Keep delivering while there are full batches
+    while deliver(destination) == destination.batch_size:
+        pass
+
+
+_workers = QueueWorkers(lambda: list(_destinations.values()), _deliver_all,
+                        MAX_CONCURRENT_DELIVERIES)
+
+
+def start_workers():
+    """Start delivering the queued events in the background, if not started yet"""
+    _workers.start()
+
+
+def get_status():
+    """Get the status of the deliveries
+
+    :returns: a dict of destination name -> its status
+    """
+    return {name: destination.get_status() for name, destination in _destinations.items()}
+
+
+def get_dead_letters(name, start=0, count=100):
+    """Get the events that could not be delivered to the destination with name"""
+    return get_destination(name).get_dead_letters(start=start, count=count)
+
+
+def requeue_dead_letters(name):
+    """Put the dead letters of the destination with name back in its queue
+
+    :returns: the number of events requeued
+    """
+    count = get_destination(name).requeue_dead_letters()
+    if count:
+        start_workers()
+        _workers.wakeup()
+    return count
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""A cache of files stored on disk
+
+The entries are files named after their keys, so they can be shared by all the processes
+(and workers) using the same directory, and sent to the clients directly from the disk.
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from flask import Response, request
+from werkzeug.wsgi import wrap_file
+
+log = logging.getLogger(__name__)
+
+# When the cache exceeds its max size, entries are removed until it is using this
+# fraction of it, so the eviction does not run again on the next entry
+EVICTION_TARGET = 0.9
+TMP_PREFIX = '.tmp-'
+
+
+class DiskCache:
+    """A cache of key -> file contents
+
+    The least recently used entries are removed when the cache exceeds `max_size`. The
+    access time of the files is used to track their usage, and their modification time
+    to expire them.
+
+    :param path: the directory to store the files in. It will be created if needed
+    :param max_size: the max size of the cache, in bytes, or None for no limit
+    :param ttl: for how long (in seconds) the entries are valid, or None to keep them
+      until they are evicted
+    """
+
+    def __init__(self, path, max_size=None, ttl=None):
+        self.path = path
+        self._max_size = max_size
+        self._ttl = ttl
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _get_path(self, key):
+        # Do not put all the files in a single directory
+        return os.path.join(self.path, key[:2], key)
+
+    def _get_entries(self):
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.startswith(TMP_PREFIX):
+                    # Still being written
+                    continue
+                path = os.path.join(dirpath, filename)
+                with contextlib.suppress(OSError):
+                    yield path, os.stat(path)
+
+    def get(self, key):
+        """Get the path of key's file
+
+        :returns: the path or None if key is not in the cache
+        """
+        path = self._get_path(key)
+        now = time.time()
+        try:
+            stat = os.stat(path)
+            if self._ttl is not None and stat.st_mtime + self._ttl < now:
+                os.unlink(path)
+                return None
+            # Mark the entry as recently used
+            os.utime(path, (now, stat.st_mtime))
+        except OSError:
+            return None
+        return path
+
+    def set(self, key, data):
+        """Store data as key's file
+
+        :returns: the path of the file
+        """
+        return self.set_chunks([data], key=key)[1]
+
+    def set_chunks(self, chunks, key=None):
+        """Store the data from an iterable of chunks, without having all of it in memory
+
+        :param key: the key of the data. If None, the sha256 of the data will be used
+        :returns: a (key, path) tuple
+        """
+        os.makedirs(self.path, exist_ok=True)
+        # Write to a temporary file first, so no one will read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=TMP_PREFIX)
+        size = 0
+        try:
+            sha256 = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+
+            key = key or sha256.hexdigest()
+            path = self._get_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+        if self._max_size:
+            with self._lock:
+                if self._size is None:
+                    self._size = sum(stat.st_size for _, stat in self._get_entries())
+                else:
+                    self._size += size
+                if self._size > self._max_size:
+                    self._evict(keep=path)
+        return key, path
+
+    def _evict(self, keep):
+        now = time.time()
+        # The expired entries go first, then the least recently used ones
+        entries = sorted(self._get_entries(), key=lambda entry: (
+            self._ttl is None or entry[1].st_mtime + self._ttl >= now, entry[1].st_atime))
+        size = sum(stat.st_size for _, stat in entries)
+        target = self._max_size * EVICTION_TARGET
+        for path, stat in entries:
+            if size <= target:
+                break
+            if path == keep:
+                continue
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+                size -= stat.st_size
+
+        log.info('Evicted disk cache %s to %s bytes', self.path, size)
+        self._size = size
+
+    def invalidate(self, key):
+        """Remove key from the cache"""
+        with contextlib.suppress(OSError):
+            os.unlink(self._get_path(key))
+
+
+def send_cached_file(path, etag, mimetype, max_age):
+    """Send a file from the cache, answering conditional requests
+
+    The file is sent with wsgi.file_wrapper (if the server has one), so it is not
+    read into memory.
+
+    :param etag: the ETag of the file contents
+    :param max_age: for how long (in seconds) the clients can use the file without
+      checking if it changed
+    :raises OSError: if the file is not in the cache anymore (e.g. it was evicted by
+      another process after its path was resolved)
+    """
+    f = open(path, 'rb')
+    response = Response(wrap_file(request.environ, f), mimetype=mimetype,
+                        direct_passthrough=True)
+    # The path may not exist anymore, but the opened file is still there
+    response.content_length = os.fstat(f.fileno()).st_size
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
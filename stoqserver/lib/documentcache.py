@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Cache of the documents (coupons, receipts) rendered by the plugins
+
+The POS asks for the same document more than once (e.g. to preview, reprint and send it by
+SMS), and rendering them is expensive. The rendered documents are cached on disk by their
+kind, id and a version of their contents, usually the modification time of the objects
+they are rendered from (see :func:`get_te_time`), so a document is rendered again when
+those objects change.
+
+It can be configured in the DocumentCache section of stoq.conf:
+
+    [DocumentCache]
+    # Optional. Where to store the documents. Defaults to document-cache in the stoq directory
+    path = /var/cache/stoqserver/documents
+    # Optional. Max size of the cache, in MB
+    max_size = 128
+    # Optional. For how long (in seconds) a document is kept
+    ttl = 86400
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from storm.expr import Join
+
+from stoqlib.domain.system import TransactionEntry
+from stoqlib.lib.configparser import get_config
+from stoqlib.lib.decorators import cached_function
+
+from stoqserver.common import APP_DIR
+from stoqserver.lib.diskcache import DiskCache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 128
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def get_te_time(store, klass, obj_id):
+    """Get the modification time of a domain object
+
+    This is queried from the database, so changes made to the object by other
+    stores (e.g. by the plugins) are considered.
+
+    :returns: the modification time or None if the object does not exist
+    """
+    if obj_id is None:
+        return None
+    tables = [klass, Join(TransactionEntry, TransactionEntry.id == klass.te_id)]
+    return store.using(*tables).find(TransactionEntry.te_time, klass.id == obj_id).one()
+
+
+class RenderedDocumentCache:
+    """Cache the documents rendered by the plugins in a :class:`DiskCache`"""
+
+    def __init__(self, disk_cache):
+        self.disk_cache = disk_cache
+
+    def _get_key(self, kind, document_id, version):
+        data = json.dumps([kind, str(document_id), str(version)])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get_or_render(self, kind, document_id, version, render):
+        """Get a rendered document from the cache, rendering it if needed
+
+        :param kind: the kind of the document (e.g. 'sale-coupon')
+        :param version: the version of the document contents. If None, the document
+          is always rendered
+        :param render: a callable that renders the document. What it returns is cached,
+          unless it is None or can't be serialized to json
+        :returns: what `render` returned for this version of the document
+        """
+        if version is None:
+            return render()
+
+        key = self._get_key(kind, document_id, version)
+        path = self.disk_cache.get(key)
+        if path is not None:
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                log.warning('Discarding broken %s %s from the cache', kind, document_id)
+
+        document = render()
+        if document is None:
+            return None
+
+        try:
+            data = json.dumps(document).encode()
+        except TypeError:
+            log.warning('Rendered %s %s can not be cached', kind, document_id)
+        else:
+            self.disk_cache.set(key, data)
+        return document
+
+
+@cached_function()
+def get_document_cache():
+    """Get the :class:`RenderedDocumentCache` shared by the resources of this process"""
+    config = get_config()
+    path = config.get('DocumentCache', 'path') or os.path.join(APP_DIR, 'document-cache')
+    max_size = int(config.get('DocumentCache', 'max_size') or DEFAULT_MAX_SIZE)
+    ttl = int(config.get('DocumentCache', 'ttl') or DEFAULT_TTL)
+    return RenderedDocumentCache(DiskCache(path, max_size=max_size * 1024 * 1024, ttl=ttl))
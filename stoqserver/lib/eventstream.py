@@ -102,17 +102,25 @@ class EventStream(BaseResource):
         """If station specified, put a event only on the client stream.
         Otherwise, put it in all streams
         """
-        payload = json.dumps(data, cls=JsonEncoder)
         if station:
             if station.is_api:
                 return
 
-            receivers = redis_server.publish(station.id, payload)
-            if receivers == 0:
-                raise EventStreamUnconnectedStation
+            cls.add_station_event(station.id, data)
             return
 
-        redis_server.publish(STREAM_ALL_BRANCHES, payload)
+        redis_server.publish(STREAM_ALL_BRANCHES, json.dumps(data, cls=JsonEncoder))
+
+    @classmethod
+    def add_station_event(cls, station_id, data):
+        """Put an event on the stream of the station with station_id
+
+        This can be used when the station object is not available anymore (e.g. after the
+        request finished)
+        """
+        receivers = redis_server.publish(station_id, json.dumps(data, cls=JsonEncoder))
+        if receivers == 0:
+            raise EventStreamUnconnectedStation
 
     @classmethod
     def ask_question(cls, station, question):
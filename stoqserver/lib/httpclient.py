@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Client for the requests this server makes to external services (e.g. Twilio)
+
+All the requests share a session, so the connections to the services are reused, and
+have a timeout, so a slow service can't hold a request forever. Only the failures to
+connect are retried, since the service may have already acted on a request that failed
+after being sent.
+
+The requests the POS doesn't need to wait for can be dispatched with :func:`dispatch`,
+which runs them in the background and reports their status in the stream of the station
+(see :class:`EventStream`) as an event like:
+
+    {
+        "type": "OUTBOUND_REQUEST_STATUS",
+        "data": {
+            "id": "<the id returned by dispatch>",
+            "kind": "sms",
+            "status": "delivered",  # or "failed"
+            "status_code": 201,
+            "response": "<the response body>",  # or "error": "<the error>"
+        }
+    }
+"""
+
+import contextlib
+import logging
+import uuid
+
+from gevent.pool import Pool
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from stoqlib.lib.decorators import cached_function
+
+from stoqserver.lib.eventstream import EventStream, EventStreamUnconnectedStation
+
+log = logging.getLogger(__name__)
+
+# The (connect, read) timeouts of the requests, in seconds
+DEFAULT_TIMEOUT = (5, 30)
+MAX_RETRIES = 3
+# The retries wait 0.5s, 1s, 2s...
+RETRY_BACKOFF_FACTOR = 0.5
+# Max number of connections kept open to each host
+POOL_SIZE = 10
+# Max number of dispatched requests running at the same time
+MAX_DISPATCHES = 20
+
+_dispatch_pool = Pool(MAX_DISPATCHES)
+
+
+@cached_function()
+def get_session():
+    """Get the :class:`requests.Session` shared by the outbound requests"""
+    retry = Retry(total=MAX_RETRIES, read=0, status=0, backoff_factor=RETRY_BACKOFF_FACTOR)
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def request(method, url, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """Make a request using the shared session
+
+    The arguments are the same as :func:`requests.request`
+    """
+    return get_session().request(method, url, timeout=timeout, **kwargs)
+
+
+def post(url, **kwargs):
+    """Make a POST request using the shared session. See :func:`request`"""
+    return request('POST', url, **kwargs)
+
+
+def _report(station_id, status):
+    if station_id is None:
+        return
+
+    with contextlib.suppress(EventStreamUnconnectedStation):
+        EventStream.add_station_event(station_id, {
+            'type': 'OUTBOUND_REQUEST_STATUS',
+            'data': status,
+        })
+
+
+def _run_dispatch(dispatch_id, station_id, kind, func, args, kwargs):
+    status = {'id': dispatch_id, 'kind': kind}
+    try:
+        response = func(*args, **kwargs)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        log.warning('Failed to dispatch %s %s: %s', kind, dispatch_id, e)
+        status['status'] = 'failed'
+        status['status_code'] = e.response.status_code if e.response is not None else None
+        status['error'] = str(e)
+    except Exception:
+        log.exception('Failed to dispatch %s %s', kind, dispatch_id)
+        status['status'] = 'failed'
+        status['status_code'] = None
+        status['error'] = 'Unexpected error'
+    else:
+        log.info('Dispatched %s %s', kind, dispatch_id)
+        status['status'] = 'delivered'
+        status['status_code'] = response.status_code
+        status['response'] = response.text
+
+    _report(station_id, status)
+
+
+def dispatch(station, kind, func, *args, **kwargs):
+    """Run func, which makes a request, in the background
+
+    :param station: the station to report the status of the request to
+    :param kind: the kind of the request (e.g. 'sms'), so the station can tell
+      the requests apart
+    :param func: a callable that makes the request, returning its
+      :class:`requests.Response`. It will be called with args and kwargs
+    :returns: the id of the request, used in the status reported
+    """
+    dispatch_id = str(uuid.uuid4())
+    # The station object can't be used after the request that dispatched this
+    station_id = None if station.is_api else station.id
+    _dispatch_pool.spawn(_run_dispatch, dispatch_id, station_id, kind, func, args, kwargs)
+    return dispatch_id
+
+
+def wait_dispatches(timeout=None):
+    """Wait for the dispatched requests to finish
+
+    :returns: True if all of them finished
+    """
+    return _dispatch_pool.join(timeout=timeout)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Cache of the sellable images served by the API
+
+The images are stored on disk named after the sha256 of their contents, which is also
+used as their ETag, along with the thumbnails generated from them. The image a request
+resolves to is kept in memory for a while, so repeated requests are served straight from
+the disk. After that, only the id and the modification time of the image are queried to
+check if it changed, the image itself is only read from the database when it did.
+
+It can be configured in the ImageCache section of stoq.conf:
+
+    [ImageCache]
+    # Optional. Where to store the images. Defaults to image-cache in the stoq directory
+    path = /var/cache/stoqserver/images
+    # Optional. Max size of the cache, in MB
+    max_size = 512
+    # Optional. For how long (in seconds) the clients can use the images without
+    # checking if they changed
+    max_age = 86400
+"""
+
+import hashlib
+import io
+import os
+import threading
+import time
+
+from PIL import Image as PILImage
+from storm.expr import Func, Join
+
+from stoqlib.domain.image import Image
+from stoqlib.domain.system import TransactionEntry
+from stoqlib.lib.configparser import get_config
+from stoqlib.lib.decorators import cached_function
+
+from stoqserver.common import APP_DIR
+from stoqserver.lib.diskcache import DiskCache
+
+DEFAULT_MAX_SIZE = 512
+DEFAULT_MAX_AGE = 24 * 60 * 60
+# The sizes (of the largest side, in pixels) the thumbnails can be generated in
+THUMBNAIL_SIZES = [64, 128, 256, 512]
+# Time (in seconds) the image a request resolves to is kept in memory
+LOOKUP_TTL = 30
+MAX_LOOKUPS = 10000
+# Number of images loaded from the database at a time
+LOAD_BATCH_SIZE = 50
+# Images bigger than this (in bytes) are read from the database in chunks of this size
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def get_image_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_thumbnail(fp, size):
+    """Resize the image in the file object fp to fit in a size x size square
+
+    :returns: the resized image, as png
+    """
+    image = PILImage.open(fp)
+    image.thumbnail((size, size), PILImage.ANTIALIAS)
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+
+class ImageCache:
+    """Resolve the images of sellables to files in a :class:`DiskCache`"""
+
+    def __init__(self, disk_cache, lookup_ttl=LOOKUP_TTL):
+        self.disk_cache = disk_cache
+        self._lookup_ttl = lookup_ttl
+        # (sellable id, is_main, keyword) -> (image id, image hash, expires)
+        self._lookups = {}
+        # (image id, modification time) -> image hash
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _get_lookup(self, key):
+        with self._lock:
+            lookup = self._lookups.get(key)
+        if lookup is None or lookup[2] < time.monotonic():
+            return None
+        return lookup[:2]
+
+    def _set_lookup(self, key, image_id, image_hash):
+        with self._lock:
+            if len(self._lookups) >= MAX_LOOKUPS:
+                self._lookups.clear()
+                self._versions.clear()
+            self._lookups[key] = (image_id, image_hash, time.monotonic() + self._lookup_ttl)
+
+    def _iter_image_chunks(self, store, image_id, length):
+        for offset in range(0, length, STREAM_CHUNK_SIZE):
+            # substring() positions start at 1
+            chunk = store.find(Func('substring', Image.image, offset + 1, STREAM_CHUNK_SIZE),
+                               Image.id == image_id).one()
+            yield bytes(chunk)
+
+    def _store_images(self, store, image_ids):
+        """Store the images with the given ids in the disk cache
+
+        :returns: a dict of image id -> image hash, for the images that have data
+        """
+        hashes = {}
+        # octet_length() does not need to read the whole image
+        lengths = dict(store.find((Image.id, Func('octet_length', Image.image)),
+                                  Image.id.is_in(list(image_ids))))
+
+        # Big images are streamed to the disk a chunk at a time, so they are never
+        # entirely in memory
+        for image_id, length in lengths.items():
+            if length and length > STREAM_CHUNK_SIZE:
+                hashes[image_id], _ = self.disk_cache.set_chunks(
+                    self._iter_image_chunks(store, image_id, length))
+
+        # The small ones are loaded in batches, but not all of them at once
+        small_ids = [image_id for image_id, length in lengths.items()
+                     if length and length <= STREAM_CHUNK_SIZE]
+        for i in range(0, len(small_ids), LOAD_BATCH_SIZE):
+            batch = small_ids[i:i + LOAD_BATCH_SIZE]
+            for image_id, data in store.find((Image.id, Image.image), Image.id.is_in(batch)):
+                image_hash = hashes[image_id] = get_image_hash(data)
+                if self.disk_cache.get(image_hash) is None:
+                    self.disk_cache.set(image_hash, data)
+        return hashes
+
+    def _find_images(self, store, sellable_ids, is_main, keyword):
+        # The image data is not fetched here, only what tells if it changed
+        tables = [Image, Join(TransactionEntry, TransactionEntry.id == Image.te_id)]
+        clauses = [Image.sellable_id.is_in(sellable_ids)]
+        if is_main is not None:
+            clauses.append(Image.is_main == is_main)
+        if keyword:
+            clauses.append(Image.keywords.like('%{}%'.format(keyword)))
+
+        # The first image of each sellable
+        rows = store.using(*tables).find(
+            (Image.sellable_id, Image.id, TransactionEntry.te_time), *clauses)
+        rows = rows.order_by(Image.sellable_id, Image.te_id).config(
+            distinct=(Image.sellable_id, ))
+
+        images = {sellable_id: (None, None) for sellable_id in sellable_ids}
+        missing = {}
+        for sellable_id, image_id, te_time in rows:
+            image_hash = self._versions.get((image_id, te_time))
+            if image_hash is None:
+                missing[image_id] = (sellable_id, te_time)
+                continue
+            images[sellable_id] = (image_id, image_hash)
+
+        for image_id, image_hash in self._store_images(store, missing).items():
+            sellable_id, te_time = missing[image_id]
+            self._versions[(image_id, te_time)] = image_hash
+            images[sellable_id] = (image_id, image_hash)
+        return images
+
+    def _get_path(self, store, image_id, image_hash, size):
+        path = self.disk_cache.get(image_hash)
+        if path is None:
+            # Someone removed it from the disk
+            image_hash = self._store_images(store, [image_id]).get(image_id)
+            path = image_hash and self.disk_cache.get(image_hash)
+            if path is None:
+                return None
+
+        if size is None:
+            return path, image_hash
+
+        thumbnail_key = '%s-%d' % (image_hash, size)
+        thumbnail_path = self.disk_cache.get(thumbnail_key)
+        if thumbnail_path is None:
+            with open(path, 'rb') as f:
+                thumbnail_path = self.disk_cache.set(thumbnail_key, make_thumbnail(f, size))
+        return thumbnail_path, thumbnail_key
+
+    def get_images(self, store, sellable_ids, is_main=None, keyword=None, size=None):
+        """Get the images of many sellables at once
+
+        The images that are not resolved yet are resolved in a single query.
+        See :meth:`get_image` for the arguments.
+
+        :returns: a dict of sellable id -> (path, etag) for the sellables that have
+          such an image
+        """
+        assert size is None or size in THUMBNAIL_SIZES, size
+        lookups = {}
+        for sellable_id in sellable_ids:
+            lookup = self._get_lookup((sellable_id, is_main, keyword))
+            if lookup is not None:
+                lookups[sellable_id] = lookup
+
+        missing = [sellable_id for sellable_id in sellable_ids if sellable_id not in lookups]
+        if missing:
+            for sellable_id, lookup in self._find_images(store, missing, is_main,
+                                                         keyword).items():
+                self._set_lookup((sellable_id, is_main, keyword), *lookup)
+                lookups[sellable_id] = lookup
+
+        images = {}
+        for sellable_id, (image_id, image_hash) in lookups.items():
+            if image_id is None:
+                continue
+            image = self._get_path(store, image_id, image_hash, size)
+            if image is not None:
+                images[sellable_id] = image
+        return images
+
+    def get_image(self, store, sellable_id, is_main=None, keyword=None, size=None):
+        """Get the image of a sellable
+
+        :param is_main: if not None, only consider the images with this is_main
+        :param keyword: only consider the images with this keyword
+        :param size: if not None, get a thumbnail of the image in this size.
+          It must be one of :obj:`THUMBNAIL_SIZES`
+        :returns: a (path, etag) tuple, or None if the sellable has no such image
+        """
+        images = self.get_images(store, [sellable_id], is_main=is_main, keyword=keyword,
+                                 size=size)
+        return images.get(sellable_id)
+
+
+def get_max_age():
+    """Get for how long the clients can cache the images, in seconds"""
+    max_age = get_config().get('ImageCache', 'max_age')
+    return int(max_age) if max_age else DEFAULT_MAX_AGE
+
+
+@cached_function()
+def get_image_cache():
+    """Get the :class:`ImageCache` shared by the resources of this process"""
+    config = get_config()
+    path = config.get('ImageCache', 'path') or os.path.join(APP_DIR, 'image-cache')
+    max_size = int(config.get('ImageCache', 'max_size') or DEFAULT_MAX_SIZE)
+    return ImageCache(DiskCache(path, max_size=max_size * 1024 * 1024))
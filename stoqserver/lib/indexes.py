@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Indexes for queries done by the API on tables it does not own
+
+The tables are created by stoqlib and its plugins, so instead of adding columns to them
+we index the expressions the resources filter by. Postgres will only use those indexes
+when the query uses the exact same expression, so the resources should always build
+them from the templates defined here.
+
+The indexes are created (and so the existing rows indexed) by the
+`stoqserver create_indexes` command. They are built concurrently, so the tables can
+still be written while that runs. Until then, the resources should check with
+:func:`index_exists` and fall back to a query that doesn't need the index.
+"""
+
+import logging
+
+from storm.expr import SQL
+
+from stoqserver.lib.database import autocommit
+
+log = logging.getLogger(__name__)
+
+# The access key of an NF-e is the Id of its infNFe tag, without the 'NFe' prefix
+NFE_KEY_TEMPLATE = (
+    "substring(CAST((xpath('//nfe:infNFe/@Id', {xml}, "
+    "ARRAY[ARRAY['nfe', 'http://www.portalfiscal.inf.br/nfe']]))[1] AS text) FROM 4)")
+# The document type is the root tag of the xml (e.g. '<nfeProc' or '<resNFe')
+NFE_DOCUMENT_TYPE_TEMPLATE = "left(CAST({xml} AS text), 8)"
+
+# Only the digits of a CPF/CNPJ, so they can be found no matter how they were formatted
+DOCUMENT_DIGITS_TEMPLATE = "regexp_replace({column}, '[^0-9]', '', 'g')"
+
+# (table, index name, indexed columns/expressions)
+INDEXES = [
+    ('nfe_purchase', 'nfe_purchase_cnpj_key_idx',
+     ['cnpj', '(%s)' % NFE_KEY_TEMPLATE.format(xml='xml')]),
+    ('imported_nfe', 'imported_nfe_cnpj_document_type_te_id_idx',
+     ['cnpj', '(%s)' % NFE_DOCUMENT_TYPE_TEMPLATE.format(xml='xml'), 'te_id']),
+    ('individual', 'individual_cpf_digits_idx',
+     ['(%s)' % DOCUMENT_DIGITS_TEMPLATE.format(column='cpf')]),
+    ('company', 'company_cnpj_digits_idx',
+     ['(%s)' % DOCUMENT_DIGITS_TEMPLATE.format(column='cnpj')]),
+]
+
+
+def get_nfe_key(table):
+    """Get an expression for the access key of the NF-e stored in table's xml column"""
+    return SQL(NFE_KEY_TEMPLATE.format(xml='%s.xml' % table))
+
+
+def get_nfe_document_type(table):
+    """Get an expression for the type of the document stored in table's xml column"""
+    return SQL(NFE_DOCUMENT_TYPE_TEMPLATE.format(xml='%s.xml' % table))
+
+
+def get_document_digits(table, column):
+    """Get an expression for the digits of the document stored in table's column"""
+    return SQL(DOCUMENT_DIGITS_TEMPLATE.format(column='%s.%s' % (table, column)))
+
+
+def index_exists(store, name):
+    """Check if the index with name exists and can be used by the queries
+
+    An index that is still being built concurrently (or whose build failed) can't
+    """
+    row = store.execute('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(?)',
+                        (name, )).get_one()
+    return bool(row and row[0])
+
+
+def create_indexes(store):
+    """Create the missing indexes
+
+    Tables that don't exist in the database (e.g. the ones from a plugin that is not
+    installed) are skipped.
+
+    :returns: the names of the created indexes
+    """
+    created = []
+    for table, name, columns in INDEXES:
+        if store.execute('SELECT to_regclass(?)', (table, )).get_one()[0] is None:
+            log.info('Skipping index %s: table %s does not exist', name, table)
+            continue
+
+        if index_exists(store, name):
+            continue
+
+        log.info('Creating index %s on %s', name, table)
+        # CONCURRENTLY doesn't block the writes to the table, but can't run in a transaction
+        with autocommit(store):
+            # A failed concurrent build leaves an invalid index behind
+            store.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % (name, ))
+            store.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s)' % (
+                name, table, ', '.join(columns)))
+        created.append(name)
+
+    return created
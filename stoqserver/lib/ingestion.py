@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Ingestion of the events received by the webhook
+
+When the ingest mode is enabled in the Integration section of stoq.conf:
+
+    [Integration]
+    webhook_ingest = true
+
+the webhook doesn't wait for the plugins to process the events. The raw events are
+persisted in redis with :func:`ingest_event` and acknowledged right away, and a pool of
+workers processes them in the background by sending :obj:`WebhookEvent`.
+
+Each source of events (the "source" of the event, e.g. "ifood") has its own
+:class:`stoqserver.lib.redisqueue.RedisQueue`, so its events are processed in the order
+they were received, by a single worker at a time, even when there are many processes.
+Events from different sources are processed concurrently.
+
+The events are deduplicated by their source and id (the "id" or "event_id" of the event, or
+the hash of its contents if it has none), so an event retried by its sender is only
+processed once.
+An event whose processing fails is retried with a backoff, and after
+:obj:`MAX_ATTEMPTS` failures it is moved to the failed events of its source, which can
+be inspected and requeued (see :func:`get_failed_events` and :func:`requeue_failed_events`).
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+
+from stoqserver.lib.eventstream import redis_server
+from stoqserver.lib.redisqueue import QueueWorkers, RedisQueue
+from stoqserver.signals import WebhookEvent
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOURCE = 'default'
+MAX_ATTEMPTS = 5
+# For how long (in seconds) the ids of the events are remembered to deduplicate them
+DEDUPLICATION_TTL = 7 * 24 * 60 * 60
+# Max number of sources being processed at the same time by this process
+MAX_CONCURRENT_SOURCES = 4
+
+SOURCES_KEY = 'webhook-sources'
+
+
+def _get_queue(source):
+    return RedisQueue('webhook', source, MAX_ATTEMPTS)
+
+
+def _get_seen_key(source, event_id):
+    # Different sources can use the same ids
+    return 'webhook-seen-%s-%s' % (source, event_id)
+
+
+def get_event_id(data, raw_data):
+    """Get the id of an event, used to deduplicate it
+
+    :param raw_data: the event, as received
+    """
+    event_id = isinstance(data, dict) and (data.get('id') or data.get('event_id'))
+    if event_id:
+        return str(event_id)
+    return hashlib.sha256(raw_data).hexdigest()
+
+
+def get_event_source(data):
+    source = isinstance(data, dict) and data.get('source')
+    return str(source) if source else DEFAULT_SOURCE
+
+
+def ingest_event(raw_data):
+    """Persist an event to be processed in the background
+
+    :param raw_data: the event, as received
+    :returns: a (event id, ingested) tuple. ingested is False if the event was
+      already ingested before
+    :raises ValueError: if the event is not valid json
+    """
+    data = json.loads(raw_data.decode())
+    event_id = get_event_id(data, raw_data)
+    source = get_event_source(data)
+    seen_key = _get_seen_key(source, event_id)
+    if not redis_server.set(seen_key, 1, nx=True, ex=DEDUPLICATION_TTL):
+        log.info('Ignoring duplicated webhook event %s from %s', event_id, source)
+        return event_id, False
+
+    event = {
+        'id': event_id,
+        'received_at': datetime.datetime.utcnow().isoformat(),
+        'data': data,
+    }
+    try:
+        pipeline = redis_server.pipeline()
+        pipeline.rpush(_get_queue(source).queue_key, json.dumps(event))
+        pipeline.sadd(SOURCES_KEY, source)
+        pipeline.execute()
+    except Exception:
+        # Let the sender retry it
+        redis_server.delete(seen_key)
+        raise
+
+    log.info('Ingested webhook event %s from %s', event_id, source)
+    start_workers()
+    _workers.wakeup()
+    return event_id, True
+
+
+def _send_events(events):
+    for event in events:
+        try:
+            WebhookEvent.send(event['data'])
+        except Exception:
+            log.exception('Error processing webhook event %s', event['id'])
+            raise
+
+
+def process_next_event(source):
+    """Process the next event received from source
+
+    :returns: True if an event was processed
+    """
+    return bool(_get_queue(source).process(_send_events))
+
+
+def _process_source(queue):
+    while queue.process(_send_events):
+        pass
+
+
+def _get_sources():
+    return sorted(source.decode() for source in redis_server.smembers(SOURCES_KEY))
+
+
+_workers = QueueWorkers(lambda: [_get_queue(source) for source in _get_sources()],
+                        _process_source, MAX_CONCURRENT_SOURCES)
+
+
+def start_workers():
+    """Start processing the ingested events in the background, if not started yet"""
+    _workers.start()
+
+
+def get_status():
+    """Get the status of the ingested events
+
+    :returns: a dict of source -> its status
+    """
+    return {source: _get_queue(source).get_status() for source in _get_sources()}
+
+
+def get_failed_events(source, start=0, count=100):
+    """Get the events from source that could not be processed"""
+    return _get_queue(source).get_dead_letters(start=start, count=count)
+
+
+def requeue_failed_events(source):
+    """Put the failed events from source back in its queue
+
+    :returns: the number of events requeued
+    """
+    count = _get_queue(source).requeue_dead_letters()
+    if count:
+        start_workers()
+        _workers.wakeup()
+    return count
@@ -23,7 +23,10 @@
 #
 
 import logging
+import time
+import zlib
 
+import gevent
 from gevent.lock import Semaphore
 
 from stoqserver.app import is_multiclient
@@ -32,6 +35,13 @@ log = logging.getLogger(__name__)
 
 printer_lock = Semaphore()
 
+# The first key of the advisory locks of the stations, so they don't clash with other
+# advisory locks taken in the database
+STATION_LOCK_NAMESPACE = 0x5354
+# For how long (in seconds) to wait for the lock of a station
+STATION_LOCK_TIMEOUT = 30
+STATION_LOCK_POLL_INTERVAL = 0.05
+
 
 class LockFailedException(Exception):
     pass
@@ -94,3 +104,35 @@ def lock_printer(func):
             printer_lock.release()
 
     return new_func
+
+
+def get_station_lock_key(station_id):
+    """Get the key of station_id's advisory lock, an integer in the int4 range"""
+    return zlib.crc32(str(station_id).encode()) - 2 ** 31
+
+
+def lock_station(store, station, timeout=STATION_LOCK_TIMEOUT):
+    """Lock station until the transaction of store is finished
+
+    This serializes the operations of a station (e.g. opening the till or creating a sale)
+    among all the processes using the database, which the other locks in this module can't
+    do in multi client mode, while the operations of different stations never wait for
+    each other.
+
+    The lock is a PostgreSQL transaction level advisory lock, so it is released when store
+    is committed or rolled back. It is polled instead of waited for in the database, so
+    other greenlets can run while it is not available.
+
+    :raises LockFailedException: if the lock was not acquired in `timeout` seconds
+    """
+    key = get_station_lock_key(station.id)
+    deadline = time.monotonic() + timeout
+    while True:
+        acquired = store.execute('SELECT pg_try_advisory_xact_lock(?, ?)',
+                                 (STATION_LOCK_NAMESPACE, key)).get_one()[0]
+        if acquired:
+            return
+        if time.monotonic() >= deadline:
+            log.info('Failed to lock station %s', station.id)
+            raise LockFailedException()
+        gevent.sleep(STATION_LOCK_POLL_INTERVAL)
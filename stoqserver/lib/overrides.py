@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Resolution of the branch overrides of sellables and products
+
+Some attributes of sellables and products can be overridden for each branch (see
+:mod:`stoqlib.domain.overrides`). The overridden attributes are read once per item during
+the fiscal emission, so instead of querying the override on each access, the overrides
+are kept per store and can be fetched for all the items of a sale at once with
+:func:`prefetch_overrides`.
+
+Only the stores inside :func:`cache_overrides` (e.g. the ones of the requests, see
+:func:`stoqserver.api.decorators.store_provider`) keep the overrides, and only until it
+exits. Other stores, like the default one that lives as long as the process, query the
+override on each access. Overrides created after they were resolved won't be seen by
+that store, unless :func:`invalidate_overrides` is called.
+"""
+
+import contextlib
+import weakref
+
+from stoqlib.api import api
+from stoqlib.domain.overrides import ProductBranchOverride, SellableBranchOverride
+from stoqlib.domain.product import Product
+from stoqlib.domain.sellable import Sellable
+
+# The overridable classes, with their override class and the attribute referencing them
+OVERRIDE_CLASSES = {
+    Sellable: (SellableBranchOverride, 'sellable_id'),
+    Product: (ProductBranchOverride, 'product_id'),
+}
+
+
+class BranchOverrides:
+    """The overrides resolved by a store"""
+
+    def __init__(self, store):
+        # A strong reference would keep the store alive in _overrides forever
+        self._store_ref = weakref.ref(store)
+        self._branch_id = None
+        # (override class, branch id, object id) -> override or None
+        self._overrides = {}
+
+    def _get_branch_id(self, branch=None):
+        if branch is not None:
+            return branch.id
+        if self._branch_id is None:
+            self._branch_id = api.get_current_branch(self._store_ref()).id
+        return self._branch_id
+
+    def prefetch(self, klass, ids, branch=None):
+        """Fetch the overrides of the klass objects with the given ids at once
+
+        :param branch: the branch of the overrides. Defaults to the current one
+        """
+        override_class, attr = OVERRIDE_CLASSES[klass]
+        branch_id = self._get_branch_id(branch)
+        ids = {id_ for id_ in ids
+               if (override_class, branch_id, id_) not in self._overrides}
+        if not ids:
+            return
+
+        for id_ in ids:
+            self._overrides[(override_class, branch_id, id_)] = None
+        store = self._store_ref()
+        for obj in store.find(override_class, getattr(override_class, attr).is_in(ids),
+                              override_class.branch_id == branch_id):
+            self._overrides[(override_class, branch_id, getattr(obj, attr))] = obj
+
+    def get(self, obj, branch=None):
+        """Get the override of obj (a :class:`Sellable` or :class:`Product`)
+
+        :returns: the override or None if obj is not overridden in the branch
+        """
+        override_class, _ = OVERRIDE_CLASSES[type(obj)]
+        key = (override_class, self._get_branch_id(branch), obj.id)
+        if key not in self._overrides:
+            self.prefetch(type(obj), [obj.id], branch=branch)
+        return self._overrides[key]
+
+
+_overrides = weakref.WeakKeyDictionary()
+
+
+@contextlib.contextmanager
+def cache_overrides(store):
+    """Keep the overrides resolved by store while inside this context"""
+    _overrides[store] = BranchOverrides(store)
+    try:
+        yield
+    finally:
+        _overrides.pop(store, None)
+
+
+def get_branch_overrides(store):
+    """Get the :class:`BranchOverrides` of store
+
+    :returns: the overrides or None if store doesn't keep them. See :func:`cache_overrides`
+    """
+    return _overrides.get(store)
+
+
+def prefetch_overrides(store, objs, branch=None):
+    """Fetch the overrides of objs at once, if store keeps them
+
+    :param objs: a list of :class:`Sellable` and/or :class:`Product`
+    """
+    overrides = get_branch_overrides(store)
+    if overrides is None:
+        return
+
+    for klass in OVERRIDE_CLASSES:
+        ids = [obj.id for obj in objs if type(obj) is klass]
+        if ids:
+            overrides.prefetch(klass, ids, branch=branch)
+
+
+def invalidate_overrides(store):
+    """Forget the overrides resolved by store"""
+    if store in _overrides:
+        _overrides[store] = BranchOverrides(store)
+
+
+def get_overridden_value(obj, name, original):
+    """Get the value of the attribute name of obj in the current branch
+
+    :param original: the value of the attribute in obj itself. It is used if the
+      override doesn't exist or doesn't define the attribute
+    """
+    overrides = get_branch_overrides(obj.store)
+    if overrides is None:
+        # Resolved only for this access
+        overrides = BranchOverrides(obj.store)
+    override = overrides.get(obj)
+    return getattr(override, name, original) or original
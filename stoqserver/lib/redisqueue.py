@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Ordered queues of events in redis, processed in the background
+
+This is the base of the delivery of events to external systems (see
+:mod:`stoqserver.lib.delivery`) and of the ingestion of the webhook events (see
+:mod:`stoqserver.lib.ingestion`).
+
+The events of a :class:`RedisQueue` are processed in order, by a single worker at a time,
+even when there are many processes, and they are only removed from the queue after being
+processed. When the processing fails, it is tried again with an exponential backoff, and
+the next events wait for it. After `max_attempts` failures the events are moved to the
+dead letters of the queue, which can be inspected and requeued.
+
+:class:`QueueWorkers` processes many queues concurrently in the background.
+"""
+
+import datetime
+import json
+import logging
+import time
+import uuid
+
+import gevent
+from gevent.event import Event
+from gevent.pool import Pool
+
+from stoqserver.lib.eventstream import redis_server
+
+log = logging.getLogger(__name__)
+
+# The delay (in seconds) before the first retry. It doubles on each failure
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 60 * 60
+# Interval (in seconds) between the checks for events to process
+POLL_INTERVAL = 5
+# For how long (in seconds) a worker can hold the lock of a queue
+LOCK_TTL = 5 * 60
+
+
+def get_retry_delay(attempts):
+    """Get for how long to wait before retrying something that failed `attempts` times"""
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+class RedisQueue:
+    """A queue of events in redis
+
+    :param prefix: the prefix of the redis keys of the queue
+    :param name: the name of the queue
+    :param max_attempts: how many times the processing of the events can fail before
+      they are moved to the dead letters
+    """
+
+    def __init__(self, prefix, name, max_attempts):
+        self.prefix = prefix
+        self.name = name
+        self.max_attempts = max_attempts
+
+    @property
+    def queue_key(self):
+        return '%s-queue-%s' % (self.prefix, self.name)
+
+    @property
+    def dead_key(self):
+        return '%s-dead-%s' % (self.prefix, self.name)
+
+    @property
+    def state_key(self):
+        return '%s-state-%s' % (self.prefix, self.name)
+
+    @property
+    def lock_key(self):
+        return '%s-lock-%s' % (self.prefix, self.name)
+
+    def _handle_failure(self, events, error):
+        state = redis_server.hgetall(self.state_key)
+        attempts = int(state.get(b'attempts', 0)) + 1
+        if attempts < self.max_attempts:
+            delay = get_retry_delay(attempts)
+            log.warning('Processing %s %s failed (attempt %s), retrying in %ss: %s',
+                        self.prefix, self.name, attempts, delay, error)
+            redis_server.hset(self.state_key, mapping={
+                'attempts': attempts,
+                'next_attempt': time.time() + delay,
+                'last_error': error,
+            })
+            return
+
+        log.error('Processing %s %s failed %s times, moving %s events to the dead letters: %s',
+                  self.prefix, self.name, attempts, len(events), error)
+        failed_at = datetime.datetime.utcnow().isoformat()
+        pipeline = redis_server.pipeline()
+        for event in events:
+            event.update(error=error, attempts=attempts, failed_at=failed_at)
+            pipeline.rpush(self.dead_key, json.dumps(event))
+        pipeline.ltrim(self.queue_key, len(events), -1)
+        pipeline.delete(self.state_key)
+        pipeline.execute()
+
+    def process(self, handler, count=1):
+        """Process the next events of the queue
+
+        :param handler: a callable that receives the list of events to process. If it
+          raises, they are kept in the queue to be retried later
+        :param count: max number of events processed at once
+        :returns: the number of events processed
+        """
+        next_attempt = redis_server.hget(self.state_key, 'next_attempt')
+        if next_attempt is not None and float(next_attempt) > time.time():
+            return 0
+
+        token = str(uuid.uuid4())
+        if not redis_server.set(self.lock_key, token, nx=True, ex=LOCK_TTL):
+            # Some other worker is processing it
+            return 0
+
+        try:
+            events = [json.loads(event) for event in
+                      redis_server.lrange(self.queue_key, 0, count - 1)]
+            if not events:
+                return 0
+
+            try:
+                handler(events)
+            except Exception as e:
+                self._handle_failure(events, str(e))
+                return 0
+
+            pipeline = redis_server.pipeline()
+            pipeline.ltrim(self.queue_key, len(events), -1)
+            pipeline.delete(self.state_key)
+            pipeline.execute()
+            return len(events)
+        finally:
+            if redis_server.get(self.lock_key) == token.encode():
+                redis_server.delete(self.lock_key)
+
+    def get_status(self):
+        state = redis_server.hgetall(self.state_key)
+        next_attempt = state.get(b'next_attempt')
+        return {
+            'pending': redis_server.llen(self.queue_key),
+            'dead': redis_server.llen(self.dead_key),
+            'attempts': int(state.get(b'attempts', 0)),
+            'next_attempt': (datetime.datetime.utcfromtimestamp(float(next_attempt)).isoformat()
+                             if next_attempt else None),
+            'last_error': state[b'last_error'].decode() if b'last_error' in state else None,
+        }
+
+    def get_dead_letters(self, start=0, count=100):
+        """Get the events that could not be processed"""
+        return [json.loads(event) for event in
+                redis_server.lrange(self.dead_key, start, start + count - 1)]
+
+    def requeue_dead_letters(self):
+        """Put the dead letters back in the queue
+
+        :returns: the number of events requeued
+        """
+        count = 0
+        while True:
+            event = redis_server.lindex(self.dead_key, 0)
+            if event is None:
+                break
+
+            event = json.loads(event)
+            for key in ['error', 'attempts', 'failed_at']:
+                event.pop(key, None)
+            # If this is interrupted, the event will be requeued again, but not lost
+            pipeline = redis_server.pipeline()
+            pipeline.rpush(self.queue_key, json.dumps(event))
+            pipeline.lpop(self.dead_key)
+            pipeline.execute()
+            count += 1
+        return count
+
+
+class QueueWorkers:
+    """Process queues in the background, each one by a single greenlet at a time
+
+    :param get_queues: a callable that returns the queues to process
+    :param process: a callable that processes the queue it receives
+    :param size: max number of queues processed at the same time by this process
+    """
+
+    def __init__(self, get_queues, process, size):
+        self._get_queues = get_queues
+        self._process = process
+        self._size = size
+        self._wakeup = Event()
+        self._greenlet = None
+
+    def _run(self):
+        pool = Pool(self._size)
+        running = {}
+        while True:
+            self._wakeup.clear()
+            for queue in self._get_queues():
+                if queue.name in running and not running[queue.name].ready():
+                    continue
+                if not redis_server.llen(queue.queue_key):
+                    continue
+                running[queue.name] = pool.spawn(self._process, queue)
+            self._wakeup.wait(timeout=POLL_INTERVAL)
+
+    def start(self):
+        """Start processing the queues, if not started yet"""
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._run)
+
+    def wakeup(self):
+        """Check the queues for events to process right away"""
+        self._wakeup.set()
@@ -22,12 +22,12 @@
 # Author(s): Stoq Team <dev@stoq.com.br>
 #
 
-import base64
 import datetime
 import decimal
 import functools
-import io
+import json
 import logging
+import uuid
 from decimal import Decimal
 from typing import Dict, Optional
 
@@ -36,11 +36,12 @@ import gevent
 import requests
 
 from stoqlib.lib.component import provide_utility
-from flask import request, abort, send_file, make_response, jsonify
+from flask import Response, request, abort, make_response, jsonify
 
 from stoqlib.api import api
 from stoqlib.database.interfaces import ICurrentUser
 from stoqlib.domain.events import SaleConfirmedRemoteEvent
+from stoqlib.domain.fiscal import Invoice
 from stoqlib.domain.image import Image
 from stoqlib.domain.overrides import ProductBranchOverride, SellableBranchOverride
 from stoqlib.domain.payment.group import PaymentGroup
@@ -68,12 +69,22 @@ from stoqlib.lib.pluginmanager import get_plugin_manager
 from storm.expr import LeftJoin, Join, And, Eq, Ne, Coalesce, Sum
 
 from stoqserver.app import is_multiclient
+from stoqserver.lib import httpclient
 from stoqserver.lib.baseresource import BaseResource
 from stoqserver.lib.eventstream import EventStream, EventStreamBrokenException, STREAM_BROKEN
+from stoqserver.lib.categoryprices import cache_prices, get_cached_prices, get_prices_version
+from stoqserver.lib.clientlookup import find_person_by_document
+from stoqserver.lib.diskcache import send_cached_file
+from stoqserver.lib.documentcache import get_document_cache, get_te_time
+from stoqserver.lib.imagecache import THUMBNAIL_SIZES, get_image_cache, get_max_age
+from stoqserver.lib.overrides import get_overridden_value, prefetch_overrides
+from stoqserver.lib.tillsummary import (check_till_summary, get_till_summary,
+                                        invalidate_till_summary)
 from .checks import check_drawer, check_pinpad, check_sat
 from .constants import PROVIDER_MAP
 from .lock import lock_pinpad, lock_printer, lock_sat, printer_lock, LockFailedException
 from ..api.decorators import login_required, store_provider
+from ..utils import get_base64_decoded_length, iter_base64_decode
 from ..signals import (GenerateAdvancePaymentReceiptPictureEvent,
                        GenerateInvoicePictureEvent, GenerateTillClosingReceiptImageEvent,
                        GrantLoyaltyPointsEvent, PrintAdvancePaymentReceiptEvent,
@@ -154,15 +165,8 @@ def override(column):
         assert False, type(column)
 
     def _get(self):
-        branch = api.get_current_branch(self.store)
-
-        if klass == Sellable:
-            obj = self.store.find(SellableBranchOverride, sellable=self, branch=branch).one()
-        elif klass == Product:
-            obj = self.store.find(ProductBranchOverride, product=self, branch=branch).one()
-
-        original = getattr(self, '__' + name)
-        return getattr(obj, name, original) or original
+        # The overrides are resolved once per store (see stoqserver.lib.overrides)
+        return get_overridden_value(self, name, getattr(self, '__' + name))
 
     def _set(self, value):
         assert False, self
@@ -185,19 +189,14 @@ class DataResource(BaseResource):
     routes = ['/data']
     method_decorators = [login_required, store_provider]
 
-    def _get_sellable_data(self, store, station):
+    def _get_catalog(self, station):
+        """Get the tables and the query to find the sellables in station's catalog"""
         tables = [
             Sellable,
             Join(Product, Product.id == Sellable.id),
-            LeftJoin(Storable, Product.id == Storable.id),
-            LeftJoin(Image,
-                     And(Sellable.id == Image.sellable_id, Eq(Image.is_main, True))),
             LeftJoin(SellableBranchOverride,
                      And(SellableBranchOverride.sellable_id == Sellable.id,
                          SellableBranchOverride.branch_id == station.branch.id)),
-            LeftJoin(ProductStockItem,
-                     And(ProductStockItem.storable_id == Sellable.id,
-                         ProductStockItem.branch_id == station.branch.id))
         ]
 
         if api.sysparam.get_bool('REQUIRE_PRODUCT_BRANCH_OVERRIDE'):
@@ -216,11 +215,46 @@ class DataResource(BaseResource):
             # is `pos`)
             query = And(query, Sellable.keywords.like('%{}%'.format(station.type.name)))
 
+        return tables, query
+
+    def _get_sellable_data(self, store, station):
+        tables, query = self._get_catalog(station)
+        tables.extend([
+            LeftJoin(Storable, Product.id == Storable.id),
+            LeftJoin(Image,
+                     And(Sellable.id == Image.sellable_id, Eq(Image.is_main, True))),
+            LeftJoin(ProductStockItem,
+                     And(ProductStockItem.storable_id == Sellable.id,
+                         ProductStockItem.branch_id == station.branch.id))
+        ])
+
         return store.using(*tables).find(
             (Sellable, Product, Storable, Image.id,
              SellableBranchOverride, Sum(ProductStockItem.quantity)), query).group_by(
             Sellable.id, Product.id, Storable.id, Image.id, SellableBranchOverride.id)
 
+    def _get_category_prices(self, store, station, sellable_ids):
+        """Get the category prices of the sellables in station's catalog
+
+        :returns: a dict of sellable id -> {category id: price}
+        """
+        catalog = (station.branch.id, station.type and station.type.name)
+        version = get_prices_version(store)
+        prices = get_cached_prices(catalog, version, sellable_ids)
+        if prices is not None:
+            return prices
+
+        tables, query = self._get_catalog(station)
+        tables.append(Join(ClientCategoryPrice, ClientCategoryPrice.sellable_id == Sellable.id))
+        prices = {}
+        for sellable_id, category_id, price in store.using(*tables).find(
+                (ClientCategoryPrice.sellable_id, ClientCategoryPrice.category_id,
+                 ClientCategoryPrice.price), query):
+            prices.setdefault(sellable_id, {})[category_id] = str(price)
+
+        cache_prices(catalog, version, sellable_ids, prices)
+        return prices
+
     def _dump_sellable(self, category_prices, sellable, branch, image_id, storable, sbo, psi_qty):
         requires_kitchen_production = sbo and sbo.requires_kitchen_production
         if requires_kitchen_production is None:
@@ -242,14 +276,12 @@ class DataResource(BaseResource):
         }
 
     def _get_categories(self, store, station):
-        # Pre-create sellable category prices to avoid multiple queries inside the sellable loop
-        sellable_category_prices = {}
-        for item in store.find(ClientCategoryPrice):
-            cat_prices = sellable_category_prices.setdefault(item.sellable_id, {})
-            cat_prices[item.category_id] = str(item.price)
+        sellable_data = list(self._get_sellable_data(store, station))
+        # Get the category prices at once to avoid multiple queries inside the sellable loop
+        sellable_category_prices = self._get_category_prices(
+            store, station, [data[0].id for data in sellable_data])
 
         categories_dict = {}  # type: Dict[str, Dict]
-        sellable_data = self._get_sellable_data(store, station)
         # Build list of products inside each category
         for (sellable, product, storable, image, sbo, psi_qty) in sellable_data:
             category_prices = sellable_category_prices.get(sellable.id, {})
@@ -497,12 +529,18 @@ class TillClosingReceiptResource(BaseResource):
 
     @classmethod
     def get_till_closing_receipt_image(cls, till):
-        image = None
-        responses = GenerateTillClosingReceiptImageEvent.send(till)
-        if len(responses) == 1:  # Only nonfiscal plugin should answer this signal
-            image = responses[0][1]
-
-        return image
+        def _render():
+            image = None
+            responses = GenerateTillClosingReceiptImageEvent.send(till)
+            if len(responses) == 1:  # Only nonfiscal plugin should answer this signal
+                image = responses[0][1]
+            return image
+
+        version = None
+        if till.status not in [Till.STATUS_PENDING, Till.STATUS_OPEN]:
+            version = get_te_time(till.store, Till, till.id)
+        return get_document_cache().get_or_render('till-closing-receipt', till.id, version,
+                                                  _render)
 
     def get(self, store, till_id):
         till = store.get(Till, till_id)
@@ -535,6 +573,8 @@ class TillResource(BaseResource):
         return last_till
 
     def _close_till(self, store, till, till_summaries):
+        # The running summary was shown to the user, so make sure it was right
+        check_till_summary(store, till)
         # Create TillSummaries
         till.get_day_summary()
 
@@ -564,6 +604,7 @@ class TillResource(BaseResource):
             # This till is missing money!
             till.add_credit_entry(abs(balance), _('Blind till closing'))
         till.close_till(self.get_current_user(store))
+        invalidate_till_summary(till.id)
 
     def _handle_close_till(self, store, till, till_summaries, include_receipt_image=False):
         station = self.get_current_station(store)
@@ -588,10 +629,10 @@ class TillResource(BaseResource):
 
     def _get_till_summary(self, store, till):
         payment_data = []
-        for (method, provider, card_type), value in till.get_day_summary_data().items():
+        for (method_name, provider, card_type), value in get_till_summary(store, till).items():
             payment_data.append({
-                'method': method.method_name,
-                'provider': provider.short_name if provider else None,
+                'method': method_name,
+                'provider': provider,
                 'card_type': card_type,
                 'system_value': str(value),
             })
@@ -638,6 +679,8 @@ class TillResource(BaseResource):
     def post(self):
         data = self.get_json()
         with api.new_store() as store:
+            # Concurrent requests from the same station would race to open/close the till
+            self.lock_current_station(store)
             till = Till.get_last(store, self.get_current_station(store))
 
             # Provide responsible
@@ -900,20 +943,128 @@ class ImageResource(BaseResource):
     method_decorators = [store_provider]
 
     def get(self, store, id):
-        images = store.find(Image, sellable_id=id)
-
+        is_main = None
         if 'is_main' in request.args:
-            images = images.find(is_main=bool(request.args['is_main']))
+            is_main = bool(request.args['is_main'])
+
+        size = request.args.get('size')
+        if size:
+            if not size.isdigit() or int(size) not in THUMBNAIL_SIZES:
+                message = "'size' must be one of: {}".format(
+                    ', '.join(str(s) for s in THUMBNAIL_SIZES))
+                log.error(message)
+                abort(400, message)
+            size = int(size)
+
+        # Another process can evict the image from the disk after it was resolved.
+        # Resolving it again puts it back
+        for attempt in range(2):
+            image = get_image_cache().get_image(store, id, is_main=is_main,
+                                                keyword=request.args.get('keyword'),
+                                                size=size or None)
+            if image is None:
+                return make_response(_("Image not found."), 404)
+
+            path, etag = image
+            try:
+                return send_cached_file(path, etag, 'image/png', get_max_age())
+            except OSError:
+                log.warning('Image %s of sellable %s not found in the cache', etag, id)
 
-        keyword_filter = request.args.get('keyword')
-        if keyword_filter:
-            images = images.find(Image.keywords.like('%{}%'.format(keyword_filter)))
+        message = 'Image of sellable {} is not available'.format(id)
+        log.error(message)
+        abort(503, message)
 
-        image = images.order_by(Image.te_id).first()
-        if image:
-            return send_file(io.BytesIO(image.image), mimetype='image/png')
-        else:
-            return make_response(_("Image not found."), 404)
+
+class ImageBundleResource(BaseResource):
+    """The main images (or their thumbnails) of many sellables in a single response
+
+    Used by the POS to warm up its catalog without a request per image. The payload is like::
+
+        {
+            "sellable_ids": ["<sellable id>", ...],
+            # Optional. One of the ImageResource thumbnail sizes
+            "size": 128,
+            # Optional. The etags the client already has. Those images are not sent again
+            "etags": {"<sellable id>": "<etag>", ...}
+        }
+
+    The response is a multipart/form-data, which browsers can parse with
+    `Response.formData()`. Its first part, named `index`, is a json with the etag of
+    each requested sellable's image (or null if it has no image), and the other ones
+    are the images that changed, named after their sellable ids.
+    """
+
+    routes = ['/image/bundle']
+    method_decorators = [store_provider]
+
+    MAX_BUNDLE_SIZE = 1000
+    CHUNK_SIZE = 64 * 1024
+
+    def _iter_bundle(self, boundary, index, images):
+        part_header = '--{}\r\nContent-Disposition: form-data; name="{}"{}\r\n' \
+                      'Content-Type: {}\r\n\r\n'
+        yield part_header.format(boundary, 'index', '', 'application/json').encode()
+        yield json.dumps(index).encode() + b'\r\n'
+
+        for sellable_id, (path, etag) in images.items():
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                # Evicted from the cache since it was resolved. The client can still
+                # request it alone
+                log.warning('Image %s of sellable %s not found in the cache', etag, sellable_id)
+                continue
+
+            with f:
+                filename = '; filename="{}.png"'.format(etag)
+                yield part_header.format(boundary, sellable_id, filename, 'image/png').encode()
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                    yield chunk
+                yield b'\r\n'
+
+        yield '--{}--\r\n'.format(boundary).encode()
+
+    def post(self, store):
+        data = self.get_json() or {}
+        sellable_ids = data.get('sellable_ids')
+        size = data.get('size')
+        known_etags = data.get('etags') or {}
+
+        if not isinstance(sellable_ids, list) or not sellable_ids:
+            message = "'sellable_ids' must be a non empty list"
+            log.error(message)
+            abort(400, message)
+
+        if len(sellable_ids) > self.MAX_BUNDLE_SIZE:
+            message = "Bundles can't have more than {} images".format(self.MAX_BUNDLE_SIZE)
+            log.error(message)
+            abort(400, message)
+
+        if size is not None and size not in THUMBNAIL_SIZES:
+            message = "'size' must be one of: {}".format(
+                ', '.join(str(s) for s in THUMBNAIL_SIZES))
+            log.error(message)
+            abort(400, message)
+
+        for sellable_id in sellable_ids:
+            try:
+                uuid.UUID(str(sellable_id))
+            except ValueError:
+                message = "Invalid sellable id: {}".format(sellable_id)
+                log.error(message)
+                abort(400, message)
+
+        images = get_image_cache().get_images(store, sellable_ids, is_main=True, size=size)
+        index = {sellable_id: images[sellable_id][1] if sellable_id in images else None
+                 for sellable_id in sellable_ids}
+        images = {sellable_id: image for sellable_id, image in images.items()
+                  if known_etags.get(sellable_id) != image[1]}
+
+        # Only files from the disk are read here, so this can run after the store is closed
+        boundary = uuid.uuid4().hex
+        return Response(self._iter_bundle(boundary, index, images),
+                        content_type='multipart/form-data; boundary={}'.format(boundary))
 
 
 class SaleResourceMixin:
@@ -972,7 +1123,7 @@ class SaleResourceMixin:
         if client_id:
             client = store.get(Client, client_id)
         elif client_document:
-            person = Person.get_by_document(store, client_document)
+            person = find_person_by_document(store, client_document)
             if person and person.client:
                 client = person.client
             elif person and not person.client:
@@ -1267,6 +1418,8 @@ class SaleResource(BaseResource, SaleResourceMixin):
 
         log.debug("POST /sale station: %s payload: %s",
                   self.get_current_station(store), data)
+        # A retried request must see the sale saved by the original one
+        self.lock_current_station(store)
 
         client, client_document, coupon_document = self._get_client_and_document(store, data)
 
@@ -1406,6 +1559,8 @@ class SaleResource(BaseResource, SaleResourceMixin):
         elif till.status != Till.STATUS_OPEN:
             raise TillError(_('There is no till open'))
 
+        # The fiscal emission reads the overridden attributes of each item
+        prefetch_overrides(store, [item.sellable for item in sale.get_items()])
         sale.confirm(user, till)
 
         GrantLoyaltyPointsEvent.send(sale, document=(client_document or coupon_document))
@@ -1483,6 +1638,7 @@ class AdvancePaymentResource(BaseResource, SaleResourceMixin):
         # initialization
         from stoqpassbook.domain import AdvancePayment
         data = self.get_json()
+        self.lock_current_station(store)
         client, client_document, coupon_document = self._get_client_and_document(store, data)
 
         advance_id = data.get('sale_id')
@@ -1539,13 +1695,24 @@ class AdvancePaymentCouponImageResource(BaseResource):
     method_decorators = [login_required, store_provider]
 
     def get(self, store, id):
-        responses = GenerateAdvancePaymentReceiptPictureEvent.send(id)
+        def _render():
+            responses = GenerateAdvancePaymentReceiptPictureEvent.send(id)
+            if len(responses) == 0:
+                abort(400)
+            return responses[0][1]
 
-        if len(responses) == 0:
-            abort(400)
+        try:
+            # We need to delay this import since the plugin will only be in the path after
+            # stoqlib initialization
+            from stoqpassbook.domain import AdvancePayment
+        except ImportError:
+            version = None
+        else:
+            version = get_te_time(store, AdvancePayment, id)
 
         return {
-            'image': responses[0][1],
+            'image': get_document_cache().get_or_render('advance-payment-coupon', id,
+                                                        version, _render),
         }, 200
 
 
@@ -1573,25 +1740,39 @@ class SaleCouponImageResource(BaseResource):
         if not sale:
             abort(400)
 
-        responses = GenerateInvoicePictureEvent.send(sale)
+        def _render():
+            return GenerateInvoicePictureEvent.send(sale)[0][1]
+
+        # The fiscal plugins keep the authorization/contingency state of the coupon in
+        # their own tables, so the coupon can only be cached after it was transmitted.
+        # From then on, it only changes with the sale or its invoice (e.g. when cancelled)
+        responses = signal('CheckCouponTransmittedEvent').send(sale)
+        if responses and responses[0][1]:
+            version = (get_te_time(store, Sale, sale.id),
+                       get_te_time(store, Invoice, sale.invoice_id))
+        else:
+            version = None
+        document = get_document_cache().get_or_render('sale-coupon', sale.id, version, _render)
         try:
-            image, mimetype = responses[0][1]
+            image, mimetype = document
         except (TypeError, ValueError):
-            image = responses[0][1]
+            image = document
             mimetype = None
 
         if request.args.get('download'):
             return self._get_danfe(image, mimetype)
 
-        assert len(responses) >= 0
         return {
             'image': image,
             'mimetype': mimetype,
         }, 200
 
     def _get_danfe(self, image, mimetype):
-        image_decoded = base64.b64decode(image)
-        return send_file(io.BytesIO(image_decoded), mimetype=mimetype)
+        # The document can have a few MB, so decode and send it a chunk at a time
+        response = Response(iter_base64_decode(image), mimetype=mimetype,
+                            direct_passthrough=True)
+        response.content_length = get_base64_decoded_length(image)
+        return response
 
 
 class SmsResource(BaseResource):
@@ -1607,18 +1788,30 @@ class SmsResource(BaseResource):
 
         sms_data = {"From": from_phone_number, "To": to, "Body": message}
 
-        r = requests.post('https://api.twilio.com/2010-04-01/Accounts/%s/Messages.json' % sid,
-                          data=sms_data, auth=(sid, secret))
-        return r.text
+        return httpclient.post(
+            'https://api.twilio.com/2010-04-01/Accounts/%s/Messages.json' % sid,
+            data=sms_data, auth=(sid, secret))
 
     def post(self, store, sale_id):
         GetCouponSmsTextEvent = signal('GetCouponSmsTextEvent')
         assert len(GetCouponSmsTextEvent.receivers) == 1
 
+        data = self.get_json()
         sale = store.get(Sale, sale_id)
-        message = GetCouponSmsTextEvent.send(sale)[0][1]
-        to = '+55' + self.get_json()['phone_number']
-        return self._send_sms(to, message)
+        text = GetCouponSmsTextEvent.send(sale)[0][1]
+        to = '+55' + data['phone_number']
+        if data.get('async'):
+            # The status will be reported in the event stream
+            station = self.get_current_station(store)
+            dispatch_id = httpclient.dispatch(station, 'sms', self._send_sms, to, text)
+            return {'id': dispatch_id, 'status': 'queued'}, 202
+
+        try:
+            return self._send_sms(to, text).text
+        except requests.RequestException as e:
+            message = 'Failed to send the SMS: %s' % e
+            log.error(message)
+            abort(502, message)
 
 
 class PassbookUsersResource(BaseResource):
@@ -1669,12 +1862,25 @@ class ExternalOrderResource(BaseResource):
 
     def _get_receipt_image(self, store, external_order_id):
         station = self.get_current_station(store)
-        responses = GenerateExternalOrderReceiptImageEvent.send(station,
-                                                                external_order_id=external_order_id)
-        if len(responses) == 1:  # Only ifood plugin should answer this signal
-            return responses[0][1]
 
-        return None
+        def _render():
+            responses = GenerateExternalOrderReceiptImageEvent.send(
+                station, external_order_id=external_order_id)
+            if len(responses) == 1:  # Only ifood plugin should answer this signal
+                return responses[0][1]
+            return None
+
+        try:
+            # We need to delay this import since the plugin will only be in the path after
+            # stoqlib initialization
+            from stoqifood.domain import ExternalOrder
+        except ImportError:
+            version = None
+        else:
+            version = get_te_time(store, ExternalOrder, external_order_id)
+
+        return get_document_cache().get_or_render(
+            'external-order-receipt', (external_order_id, station.id), version, _render)
 
     def _print_external_order(self, store, external_order_id):
         station = self.get_current_station(store)
@@ -1714,9 +1920,8 @@ class LockerResource(BaseResource):
         config = get_config()
         api_key = config.get("Condlink", "api_key")
         headers = {"x-api-key": api_key}
-        response = requests.post('https://onii.condlink.com.br/accessDevice/v1/comm5',
-                                 headers=headers, data=locker_data)
-        return response.text
+        return httpclient.post('https://onii.condlink.com.br/accessDevice/v1/comm5',
+                               headers=headers, data=locker_data)
 
     @login_required
     def post(self):
@@ -1731,4 +1936,17 @@ class LockerResource(BaseResource):
         if not locker_mac:
             return {'message': 'No locker_mac provided'}, 400
 
-        return self._open_locker(locker_number, locker_mac)
+        if data.get('async'):
+            # The status will be reported in the event stream
+            with api.new_store() as store:
+                station = self.get_current_station(store)
+                dispatch_id = httpclient.dispatch(station, 'locker', self._open_locker,
+                                                  locker_number, locker_mac)
+            return {'id': dispatch_id, 'status': 'queued'}, 202
+
+        try:
+            return self._open_locker(locker_number, locker_mac).text
+        except requests.RequestException as e:
+            message = 'Failed to open the locker: %s' % e
+            log.error(message)
+            abort(502, message)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+#
+# Copyright (C) 2021 Stoq Tecnologia <http://www.stoq.com.br>
+# All rights reserved
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., or visit: http://www.gnu.org/.
+#
+# Author(s): Stoq Team <dev@stoq.com.br>
+#
+
+"""Running summary of the open tills
+
+The POS polls the till status all the time and, while the till is open, the status
+includes the summary of its entries by payment method, provider and card type. Instead of
+aggregating all the entries of the till on every request (like
+:meth:`Till.get_day_summary_data` does), a running summary is kept in memory for each till
+and only the entries created since it was last read are added to it.
+
+The payments are created by other processes too (e.g. the plugins and Stoq desktop), so
+the number of entries and their latest modification time are read from the database to
+tell if the summary is up to date. The modification time of an entry is the latest one of
+the entry, its payment and its card data, since the summary also depends on the payment
+method and on the card provider and type. If an entry that was already summarized
+changes, or some entry was missed, the summary is built again from all the entries.
+
+Reading that version is still an aggregate over all the entries of the till, so every
+GET /till scans them (and their payments and card data). The version can't be kept only
+in memory, since it would miss the entries written by the other processes. What the
+running summary saves is fetching and summarizing all the entries again: only the new
+ones are fetched.
+"""
+
+import decimal
+import logging
+import threading
+
+from storm.expr import And, Count, Func, Join, LeftJoin, Max
+from storm.info import ClassAlias
+
+from stoqlib.domain.payment.card import CreditCardData, CreditProvider
+from stoqlib.domain.payment.method import PaymentMethod
+from stoqlib.domain.payment.payment import Payment
+from stoqlib.domain.system import TransactionEntry
+from stoqlib.domain.till import TillEntry
+
+log = logging.getLogger(__name__)
+
+# The entries that are not from payments (e.g. cash supplies and removals) are money
+MONEY_METHOD = 'money'
+MAX_TILLS = 1000
+
+
+PaymentTransactionEntry = ClassAlias(TransactionEntry, 'payment_te')
+CardTransactionEntry = ClassAlias(TransactionEntry, 'card_te')
+
+# The modification time of an entry, its payment or its card data, whichever is the
+# latest. GREATEST ignores the NULLs from the entries without payment or card data
+_modification_time = Func('GREATEST', TransactionEntry.te_time,
+                          PaymentTransactionEntry.te_time, CardTransactionEntry.te_time)
+
+
+def _get_entry_tables():
+    return [
+        TillEntry,
+        Join(TransactionEntry, TransactionEntry.id == TillEntry.te_id),
+        LeftJoin(Payment, Payment.id == TillEntry.payment_id),
+        LeftJoin(PaymentTransactionEntry, PaymentTransactionEntry.id == Payment.te_id),
+        LeftJoin(CreditCardData, CreditCardData.payment_id == Payment.id),
+        LeftJoin(CardTransactionEntry, CardTransactionEntry.id == CreditCardData.te_id),
+    ]
+
+
+def get_entries_version(store, till_id):
+    """Get the current version of the entries of a till
+
+    Note that this aggregates all the entries of the till, so its cost grows with them.
+
+    :returns: a (number of entries, latest modification time) tuple
+    """
+    return tuple(store.using(*_get_entry_tables()).find(
+        (Count(TillEntry.id), Max(_modification_time)),
+        TillEntry.till_id == till_id).one())
+
+
+def _find_entries(store, till_id, since=None):
+    tables = _get_entry_tables() + [
+        LeftJoin(PaymentMethod, PaymentMethod.id == Payment.method_id),
+        LeftJoin(CreditProvider, CreditProvider.id == CreditCardData.provider_id),
+    ]
+    query = TillEntry.till_id == till_id
+    if since is not None:
+        query = And(query, _modification_time >= since)
+    # Only what is summarized is fetched, not the entries and payments themselves
+    return store.using(*tables).find(
+        (TillEntry.id, _modification_time, TillEntry.value, PaymentMethod.method_name,
+         CreditProvider.short_name, CreditCardData.card_type), query)
+
+
+class RunningTillSummary:
+    """The summary of the entries of a till
+
+    :attr values: a dict of (method name, provider short name, card type) -> value
+    """
+
+    def __init__(self):
+        self.values = {(MONEY_METHOD, None, None): decimal.Decimal(0)}
+        self.version = (0, None)
+        self._entry_ids = set()
+
+    def copy(self):
+        summary = RunningTillSummary()
+        summary.values = dict(self.values)
+        summary.version = self.version
+        summary._entry_ids = set(self._entry_ids)
+        return summary
+
+    def add_entries(self, rows):
+        """Add the entries in rows to the summary
+
+        :param rows: the rows returned by :func:`_find_entries`
+        :returns: False if an entry that is already in the summary changed, in which
+          case the summary must be built again
+        """
+        count, last_te_time = self.version
+        for entry_id, te_time, value, method_name, provider, card_type in rows:
+            if entry_id in self._entry_ids:
+                if last_te_time is not None and te_time > last_te_time:
+                    return False
+                continue
+
+            key = (method_name or MONEY_METHOD, provider, card_type)
+            self.values[key] = self.values.get(key, decimal.Decimal(0)) + value
+            self._entry_ids.add(entry_id)
+            count += 1
+            if last_te_time is None or te_time > last_te_time:
+                last_te_time = te_time
+
+        self.version = (count, last_te_time)
+        return True
+
+
+class TillSummaryCache:
+    """A cache of till id -> :class:`RunningTillSummary`"""
+
+    def __init__(self):
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    def _build(self, store, till_id):
+        summary = RunningTillSummary()
+        summary.add_entries(_find_entries(store, till_id))
+        return summary
+
+    def get(self, store, till_id):
+        """Get the summary of a till, bringing it up to date if needed
+
+        :returns: a dict of (method name, provider short name, card type) -> value
+        """
+        with self._lock:
+            summary = self._summaries.get(till_id)
+
+        version = get_entries_version(store, till_id)
+        if summary is None:
+            summary = self._build(store, till_id)
+        elif summary.version != version:
+            # The summary may be being read by other requests, so update a copy of it
+            summary = summary.copy()
+            updated = summary.add_entries(_find_entries(store, till_id, since=summary.version[1]))
+            # Entries can be committed with a modification time older than the
+            # latest one (or removed), so they would be missed
+            if not updated or summary.version[0] != version[0]:
+                log.info('Rebuilding the summary of till %s', till_id)
+                summary = self._build(store, till_id)
+
+        with self._lock:
+            if till_id not in self._summaries and len(self._summaries) >= MAX_TILLS:
+                self._summaries.clear()
+            self._summaries[till_id] = summary
+        return dict(summary.values)
+
+    def invalidate(self, till_id=None):
+        """Remove the summary of till_id, or of all the tills if it is None"""
+        with self._lock:
+            if till_id is None:
+                self._summaries.clear()
+            else:
+                self._summaries.pop(till_id, None)
+
+
+_cache = TillSummaryCache()
+
+
+def get_till_summary(store, till):
+    """Get the summary of the entries of till. See :meth:`TillSummaryCache.get`"""
+    return _cache.get(store, till.id)
+
+
+def check_till_summary(store, till):
+    """Check the running summary of till against :meth:`Till.get_day_summary_data`
+
+    :returns: True if they match
+    """
+    summary = {key: value for key, value in get_till_summary(store, till).items() if value}
+    expected = {}
+    for (method, provider, card_type), value in till.get_day_summary_data().items():
+        if value:
+            key = (method.method_name, provider.short_name if provider else None, card_type)
+            expected[key] = value
+
+    if summary != expected:
+        log.error('Running summary of till %s is %r, but its entries sum up to %r',
+                  till.id, summary, expected)
+        invalidate_till_summary(till.id)
+        return False
+    return True
+
+
+def invalidate_till_summary(till_id=None):
+    """Forget the summary of till_id, or of all the tills if it is None"""
+    _cache.invalidate(till_id)
+
+
+def clear_cache():
+    """Clear all the till summaries"""
+    _cache.invalidate()
@@ -23,6 +23,7 @@
 #
 
 import atexit
+import gc
 import logging
 from logging.handlers import SysLogHandler
 import multiprocessing
@@ -54,6 +55,7 @@ from stoqlib.lib.osutils import get_application_dir
 
 import stoqserver
 from .common import SERVER_XMLRPC_PORT
+from .lib.indexes import create_indexes
 from .taskmanager import Worker
 from .tasks import backup_database, restore_database, backup_status, start_flask_server
 from .sentry import setup_sentry
@@ -149,6 +151,40 @@ def setup_logging(app_name='stoq-server', is_debug=None):
         root.addHandler(hdlr)
 
 
+def prepare_for_fork():
+    """Prepare a process that set up stoq to be forked
+
+    This is called by the gunicorn master after preloading the app (see
+    stoqserver.gunicorn_config), so the workers share its memory instead of each one
+    setting up stoq and loading the plugins again.
+    """
+    from .lib.database import disconnect_store
+    from .lib.eventstream import redis_server
+
+    # The connections would be shared by the workers. The default store and redis
+    # reconnect in each worker when they are used
+    disconnect_store(api.get_default_store())
+    redis_server.connection_pool.disconnect()
+
+    # Move everything loaded so far to the permanent generation, so the garbage collector
+    # of the workers won't write to (and copy) the memory pages shared with the master
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def reinit_after_fork():
+    """Reinitialize what can't be shared with the parent in a forked process"""
+    from .lib.eventstream import redis_server
+
+    # redis would also do this when the pool is used, by checking the pid
+    redis_server.connection_pool.reset()
+    # The default store reconnects here. Its application name (which has the pid of the
+    # process, see pg_stat_activity) is only set when the store is created or rolled back
+    api.get_default_store()._setup_application_name()
+    logger.info('Worker %s initialized', os.getpid())
+
+
 class StoqServerCmdHandler:
 
     #
@@ -309,6 +345,17 @@ class StoqServerCmdHandler:
                          action='store',
                          dest='user_hash')
 
+    def cmd_create_indexes(self, options, *args):
+        """Create the indexes used by the API resources"""
+        setup_stoq()
+        setup_logging()
+
+        with api.new_store() as store:
+            created = create_indexes(store)
+
+        for name in created:
+            print("Created index %s" % (name, ))
+
     def cmd_exec_action(self, options, *args):
         """Run an action on an already running server instance"""
         setup_logging()
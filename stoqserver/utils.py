@@ -22,6 +22,8 @@
 # Author(s): Stoq Team <dev@stoq.com.br>
 #
 
+import base64
+import binascii
 import datetime
 import decimal
 import json
@@ -44,6 +46,50 @@ class JsonEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def encode_cursor(*values):
+    """Encode values in an opaque cursor to be used in pagination links"""
+    data = json.dumps(values).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor created by :func:`encode_cursor`
+
+    :returns: the list of values encoded in the cursor
+    :raises ValueError: if the cursor is not valid
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode())
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError(cursor)
+
+    if not isinstance(values, list):
+        raise ValueError(cursor)
+    return values
+
+
+def get_base64_decoded_length(data):
+    """Get the length of the data encoded in the base64 string data"""
+    length = len(data) - data.count('\n') - data.count('\r')
+    return length * 3 // 4 - data.rstrip()[-2:].count('=')
+
+
+def iter_base64_decode(data, chunk_size=64 * 1024):
+    """Decode the base64 string data a chunk at a time
+
+    This avoids having another full copy of big documents in memory.
+
+    :param chunk_size: the size of the decoded chunks
+    """
+    if '\n' in data:
+        data = ''.join(data.split())
+    # Each 4 base64 characters are decoded to 3 bytes
+    encoded_chunk_size = chunk_size // 3 * 4
+    for i in range(0, len(data), encoded_chunk_size):
+        yield base64.b64decode(data[i:i + encoded_chunk_size])
+
+
 def get_user_hash():
     return md5(api.sysparam.get_string('USER_HASH').encode('UTF-8')).hexdigest()
 
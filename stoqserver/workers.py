@@ -45,6 +45,7 @@ from stoqlib.lib.environment import is_developer_mode
 from stoqlib.lib.pluginmanager import get_plugin_manager
 
 from . import __version__ as stoqserver_version
+from .lib import delivery, ingestion
 from .lib.checks import check_drawer, check_pinpad, check_sat
 from .lib.lock import LockFailedException
 from .lib.eventstream import EventStream, DeviceType
@@ -127,6 +128,18 @@ def check_pinpad_loop(station):
         gevent.sleep(60)
 
 
+@worker
+def deliver_events(station):
+    # Deliver the events left in the queues when the server was stopped
+    delivery.start_workers()
+
+
+@worker
+def process_webhook_events(station):
+    # Process the events ingested by the webhook that were left unprocessed
+    ingestion.start_workers()
+
+
 @worker
 def post_ping_request(station):
     if is_developer_mode():
@@ -18,6 +18,7 @@ from stoqlib.lib.formatters import raw_document
 from stoqlib.lib.parameters import sysparam
 
 from stoqserver.api.resources.b1food import (_check_if_uuid,
+                                             _get_changed_since,
                                              _get_card_name,
                                              _get_card_description,
                                              _get_category_info,
@@ -222,6 +223,23 @@ def test_check_if_uuid_invalid(abort):
     assert abort.call_args_list[0][0] == (400, 'os IDs das lojas devem ser do tipo UUID')
 
 
+@pytest.mark.parametrize('changed_since, expected', [
+    (None, None),
+    ('2020-01-02', datetime(2020, 1, 2)),
+    ('2020-01-02 10:30:00', datetime(2020, 1, 2, 10, 30)),
+    ('2020-01-02 10:30:00 -0300', datetime(2020, 1, 2, 10, 30)),
+])
+def test_get_changed_since(changed_since, expected):
+    data = {'dataAlteracao': changed_since} if changed_since else {}
+    assert _get_changed_since(data) == expected
+
+
+@mock.patch('stoqserver.api.resources.b1food.abort')
+def test_get_changed_since_invalid(abort):
+    _get_changed_since({'dataAlteracao': '02/01/2020'})
+    abort.assert_called_once_with(400, "Invalid 'dataAlteracao' provided: 02/01/2020")
+
+
 def test_get_credit_provider_description(example_creator):
     credit_provider = example_creator.create_credit_provider(short_name='Test')
     assert _get_credit_provider_description(credit_provider) == 'Test'
@@ -707,6 +725,36 @@ def test_get_sellables_with_lojas_filter_without_pbo(get_config_mock, get_networ
     }]
 
 
+@mock.patch('stoqserver.api.resources.b1food._get_network_info')
+@mock.patch('stoqserver.api.decorators.get_config')
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_sellables_with_lojas_filter_mixed_pbo(get_config_mock, get_network_info,
+                                                   b1food_client, store, sale, current_station,
+                                                   sellable, network, example_creator):
+    get_config_mock.return_value.get.return_value = "B1FoodClientId"
+    get_network_info.return_value = network
+
+    delivery = sysparam.get_object(store, 'DELIVERY_SERVICE')
+    sellables = store.find(Sellable, Ne(Sellable.id, delivery.sellable.id))
+    branch_id = current_station.branch.id
+    other_branch_id = example_creator.create_branch().id
+    ProductBranchOverride(store=store, product=sellable.product, branch_id=branch_id)
+
+    query_string = {
+        'Authorization': 'Bearer B1FoodClientId',
+        'lojas': '[{},{}]'.format(branch_id, other_branch_id)
+    }
+    response = b1food_client.get('b1food/terceiros/restful/material',
+                                 query_string=query_string)
+    res = json.loads(response.data.decode('utf-8'))
+
+    assert response.status_code == 200
+    branch_items = [item for item in res if item['lojaId'] == branch_id]
+    other_branch_items = [item for item in res if item['lojaId'] == other_branch_id]
+    assert [item['idMaterial'] for item in branch_items] == [sellable.id]
+    assert len(other_branch_items) == sellables.count()
+
+
 @mock.patch('stoqserver.api.resources.b1food._get_network_info')
 @mock.patch('stoqserver.api.decorators.get_config')
 @pytest.mark.usefixtures('mock_new_store')
@@ -2052,3 +2100,72 @@ def test_get_login_users_inactive(get_config_mock, get_network_info,
     res = json.loads(response.data.decode('utf-8'))
 
     assert res == []
+
+
+@mock.patch('stoqserver.api.resources.b1food._get_network_info')
+@mock.patch('stoqserver.api.decorators.get_config')
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_sellables_changed_since(get_config_mock, get_network_info, b1food_client,
+                                     sellable, network):
+    get_config_mock.return_value.get.return_value = "B1FoodClientId"
+    get_network_info.return_value = network
+
+    query_string = {
+        'Authorization': 'Bearer B1FoodClientId',
+        'dataAlteracao': sellable.te.te_server.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    response = b1food_client.get('b1food/terceiros/restful/material',
+                                 query_string=query_string)
+    res = json.loads(response.data.decode('utf-8'))
+
+    assert response.status_code == 200
+    assert sellable.id in [item['idMaterial'] for item in res]
+
+    query_string['dataAlteracao'] = '2999-01-01'
+    response = b1food_client.get('b1food/terceiros/restful/material',
+                                 query_string=query_string)
+    res = json.loads(response.data.decode('utf-8'))
+
+    assert response.status_code == 200
+    assert res == []
+
+
+@pytest.mark.parametrize('endpoint', ('terminais', 'cargos', 'tiposdescontos', 'funcionarios'))
+@mock.patch('stoqserver.api.resources.b1food._get_network_info')
+@mock.patch('stoqserver.api.decorators.get_config')
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_master_data_changed_since_future(get_config_mock, get_network_info,
+                                              b1food_client, network, endpoint):
+    get_config_mock.return_value.get.return_value = "B1FoodClientId"
+    get_network_info.return_value = network
+
+    query_string = {
+        'Authorization': 'Bearer B1FoodClientId',
+        'dataAlteracao': '2999-01-01',
+    }
+    response = b1food_client.get('b1food/terceiros/restful/' + endpoint,
+                                 query_string=query_string)
+    res = json.loads(response.data.decode('utf-8'))
+
+    assert response.status_code == 200
+    assert res == []
+
+
+@mock.patch('stoqserver.api.resources.b1food._get_network_info')
+@mock.patch('stoqserver.api.decorators.get_config')
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_branches_changed_since_future(get_config_mock, get_network_info,
+                                           b1food_client, network):
+    get_config_mock.return_value.get.return_value = "B1FoodClientId"
+    get_network_info.return_value = network
+
+    query_string = {
+        'Authorization': 'Bearer B1FoodClientId',
+        'dataAlteracao': '2999-01-01',
+    }
+    response = b1food_client.get('b1food/terceiros/restful/rede-loja',
+                                 query_string=query_string)
+    res = json.loads(response.data.decode('utf-8'))
+
+    assert response.status_code == 200
+    assert res[0]['lojas'] == []
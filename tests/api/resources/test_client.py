@@ -23,6 +23,8 @@
 #
 
 import json
+from unittest import mock
+
 import pytest
 
 from stoqlib.domain.person import Client
@@ -192,3 +194,59 @@ def test_client_get_by_category(client, example_creator, store):
     res = json.loads(response.data.decode('utf-8'))[0]
     assert res['name'] == payload['name']
     assert res['category_name'] == payload['category_name']
+
+
+@pytest.fixture
+def category_clients(example_creator):
+    category = example_creator.create_client_category(name='Staff')
+    clients = []
+    for i in range(3):
+        client = example_creator.create_client(name='Staff %s' % i)
+        client.category = category
+        clients.append(client)
+    return clients
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_client_get_by_category_paginated(client, category_clients):
+    query_string = {'category_name': 'Staff', 'limit': 2, 'fields': 'id,name'}
+    response = client.get('/client', query_string=query_string)
+
+    assert response.status_code == 200
+    res = json.loads(response.data.decode())
+    assert res['data'] == [{'id': c.id, 'name': c.person.name} for c in category_clients[:2]]
+    assert res['next'].startswith('/client?')
+
+    response = client.get(res['next'])
+    res = json.loads(response.data.decode())
+    assert res['data'] == [{'id': category_clients[2].id, 'name': 'Staff 2'}]
+    assert res['next'] is None
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_client_get_by_category_ndjson(client, category_clients):
+    query_string = {'category_name': 'Staff', 'format': 'ndjson', 'fields': 'id,category_name'}
+    with mock.patch('stoqserver.api.resources.client.EXPORT_BATCH_SIZE', 2):
+        response = client.get('/client', query_string=query_string)
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.data.decode().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {'id': c.id, 'category_name': 'Staff'} for c in category_clients]
+
+
+@pytest.mark.usefixtures('mock_new_store')
+@pytest.mark.parametrize('query_string, message', [
+    ({'limit': 'x'}, "'limit' must be a number"),
+    ({'limit': 1001}, "'limit' must be lower than 1000"),
+    ({'cursor': 'x'}, "Invalid 'cursor' provided"),
+    ({'fields': 'id,password'}, 'Invalid fields: password'),
+    ({'format': 'xml'}, "'format' must be json or ndjson"),
+])
+def test_client_get_by_category_invalid_args(client, query_string, message):
+    query_string['category_name'] = 'Staff'
+    response = client.get('/client', query_string=query_string)
+
+    assert response.status_code == 400
+    assert response.json['message'] == message
@@ -23,6 +23,7 @@
 #
 
 from datetime import datetime
+from unittest import mock
 
 from freezegun import freeze_time
 import pytest
@@ -30,9 +31,9 @@ import pytest
 from stoqlib.domain.person import UserBranchAccess
 from stoqlib.domain.nfe import NFePurchase
 from stoqnfe.domain.distribution import ImportedNfe
-from stoqserver.api.resources.imported_nfe import MAX_PAGE_SIZE
+from stoqserver.api.resources.imported_nfe import MAX_PAGE_SIZE, _decode_cursor
 from lxml import etree
-from stoqserver.utils import get_pytests_datadir
+from stoqserver.utils import encode_cursor, get_pytests_datadir
 
 
 @pytest.fixture
@@ -177,14 +178,18 @@ def test_get_imported_nfe_without_nfe_purchase(client, branch_with_access, impor
 
 
 @pytest.mark.usefixtures('mock_new_store')
+@pytest.mark.parametrize('indexed', [True, False])
 def test_get_imported_nfe_with_nfe_purchase(store, client, branch_with_access,
-                                            example_creator, imported_nfe):
+                                            example_creator, imported_nfe, indexed):
     nfe_purchase = NFePurchase(store=store, branch=branch_with_access,
                                cnpj=imported_nfe.cnpj, xml=imported_nfe.xml)
     query_string = {
         'cnpj': imported_nfe.cnpj
     }
-    response = client.get('/api/v1/imported_nfe', query_string=query_string)
+    # Without the index, the purchase is looked up for each nfe
+    with mock.patch('stoqserver.api.resources.imported_nfe.index_exists',
+                    return_value=indexed):
+        response = client.get('/api/v1/imported_nfe', query_string=query_string)
 
     assert response.status_code == 200
     assert response.json == {
@@ -203,7 +208,8 @@ def test_get_imported_nfe_with_nfe_purchase(store, client, branch_with_access,
 
 @freeze_time('2021-02-10 12:00:00', ignore=['gi'])
 @pytest.mark.usefixtures('mock_new_store', 'branch_with_access')
-def test_get_imported_nfe_with_next(store, client, imported_nfe, imported_nfe_xml):
+@pytest.mark.parametrize('indexed', [True, False])
+def test_get_imported_nfe_with_next(store, client, imported_nfe, imported_nfe_xml, indexed):
     other_imported_nfe = ImportedNfe(store=store, key='123', xml=imported_nfe_xml,
                                      cnpj=imported_nfe.cnpj, process_date=datetime.now())
     query_string = {
@@ -211,12 +217,15 @@ def test_get_imported_nfe_with_next(store, client, imported_nfe, imported_nfe_xm
         'limit': 1
     }
     route = '/api/v1/imported_nfe'
-    response = client.get(route, query_string=query_string)
+    with mock.patch('stoqserver.api.resources.imported_nfe.index_exists',
+                    return_value=indexed):
+        response = client.get(route, query_string=query_string)
 
     assert response.status_code == 200
     assert response.json == {
         'previous': None,
-        'next': route + '?limit=1&offset=1&cnpj={}'.format(imported_nfe.cnpj),
+        'next': route + '?limit=1&cursor={}&cnpj={}'.format(
+            encode_cursor('next', other_imported_nfe.te_id), imported_nfe.cnpj),
         'count': 1,
         'total_records': 2,
         'records': [{
@@ -230,7 +239,8 @@ def test_get_imported_nfe_with_next(store, client, imported_nfe, imported_nfe_xm
 
 @freeze_time('2021-02-10 12:00:00', ignore=['gi'])
 @pytest.mark.usefixtures('mock_new_store', 'branch_with_access')
-def test_get_imported_nfe_with_previous(store, client, imported_nfe, imported_nfe_xml):
+@pytest.mark.parametrize('indexed', [True, False])
+def test_get_imported_nfe_with_previous(store, client, imported_nfe, imported_nfe_xml, indexed):
     ImportedNfe(store=store, cnpj=imported_nfe.cnpj, key='123', xml=imported_nfe_xml,
                 process_date=datetime.now())
     query_string = {
@@ -239,11 +249,14 @@ def test_get_imported_nfe_with_previous(store, client, imported_nfe, imported_nf
         'offset': 1
     }
     route = '/api/v1/imported_nfe'
-    response = client.get(route, query_string=query_string)
+    with mock.patch('stoqserver.api.resources.imported_nfe.index_exists',
+                    return_value=indexed):
+        response = client.get(route, query_string=query_string)
 
     assert response.status_code == 200
     assert response.json == {
-        'previous': route + '?limit=1&offset=0&cnpj={}'.format(imported_nfe.cnpj),
+        'previous': route + '?limit=1&cursor={}&cnpj={}'.format(
+            encode_cursor('previous', imported_nfe.te_id), imported_nfe.cnpj),
         'next': None,
         'count': 1,
         'total_records': 2,
@@ -258,8 +271,9 @@ def test_get_imported_nfe_with_previous(store, client, imported_nfe, imported_nf
 
 @freeze_time('2021-02-10 12:00:00', ignore=['gi'])
 @pytest.mark.usefixtures('mock_new_store', 'branch_with_access')
+@pytest.mark.parametrize('indexed', [True, False])
 def test_get_imported_nfe_with_previous_and_next(store, client, imported_nfe, imported_nfe_xml,
-                                                 other_imported_nfe_xml):
+                                                 other_imported_nfe_xml, indexed):
     other_imported_nfe = ImportedNfe(store=store, key='123', xml=imported_nfe_xml,
                                      cnpj=imported_nfe.cnpj, process_date=datetime.now())
     ImportedNfe(store=store, cnpj=imported_nfe.cnpj, key='456', xml=other_imported_nfe_xml,
@@ -270,12 +284,16 @@ def test_get_imported_nfe_with_previous_and_next(store, client, imported_nfe, im
         'offset': 1
     }
     route = '/api/v1/imported_nfe'
-    response = client.get(route, query_string=query_string)
+    with mock.patch('stoqserver.api.resources.imported_nfe.index_exists',
+                    return_value=indexed):
+        response = client.get(route, query_string=query_string)
 
     assert response.status_code == 200
     assert response.json == {
-        'previous': route + '?limit=1&offset=0&cnpj={}'.format(imported_nfe.cnpj),
-        'next': route + '?limit=1&offset=2&cnpj={}'.format(imported_nfe.cnpj),
+        'previous': route + '?limit=1&cursor={}&cnpj={}'.format(
+            encode_cursor('previous', other_imported_nfe.te_id), imported_nfe.cnpj),
+        'next': route + '?limit=1&cursor={}&cnpj={}'.format(
+            encode_cursor('next', other_imported_nfe.te_id), imported_nfe.cnpj),
         'count': 1,
         'total_records': 3,
         'records': [{
@@ -285,3 +303,106 @@ def test_get_imported_nfe_with_previous_and_next(store, client, imported_nfe, im
             'purchase_invoice_id': None
         }]
     }
+
+
+@pytest.mark.usefixtures('mock_new_store')
+@pytest.mark.parametrize('indexed', [True, False])
+def test_get_imported_nfe_with_many_nfe_purchases(store, client, branch_with_access,
+                                                  imported_nfe, indexed):
+    for i in range(2):
+        NFePurchase(store=store, branch=branch_with_access,
+                    cnpj=imported_nfe.cnpj, xml=imported_nfe.xml)
+    query_string = {
+        'cnpj': imported_nfe.cnpj
+    }
+    with mock.patch('stoqserver.api.resources.imported_nfe.index_exists',
+                    return_value=indexed):
+        response = client.get('/api/v1/imported_nfe', query_string=query_string)
+
+    assert response.status_code == 200
+    assert response.json['total_records'] == 1
+    assert [record['id'] for record in response.json['records']] == [imported_nfe.id]
+    assert response.json['records'][0]['purchase_invoice_id'] is not None
+
+
+def test_cursor():
+    assert _decode_cursor(encode_cursor('next', 123)) == ('next', 123)
+    assert _decode_cursor(encode_cursor('previous', 1)) == ('previous', 1)
+
+
+@pytest.mark.parametrize('cursor', ('foo', encode_cursor('foo', 1), encode_cursor('next', 'x'),
+                                    encode_cursor('next')))
+def test_decode_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        _decode_cursor(cursor)
+
+
+def test_get_imported_nfe_invalid_cursor(client):
+    query_string = {
+        'cnpj': '99.399.705/0001-90',
+        'cursor': 'foo',
+    }
+    response = client.get('/api/v1/imported_nfe', query_string=query_string)
+
+    assert response.status_code == 400
+    assert response.json == {'message': "Invalid 'cursor' provided"}
+
+
+def test_get_imported_nfe_invalid_count(client):
+    query_string = {
+        'cnpj': '99.399.705/0001-90',
+        'count': 'foo',
+    }
+    response = client.get('/api/v1/imported_nfe', query_string=query_string)
+
+    assert response.status_code == 400
+    assert response.json == {'message': "'count' must be one of: exact, estimated"}
+
+
+@freeze_time('2021-02-10 12:00:00', ignore=['gi'])
+@pytest.mark.usefixtures('mock_new_store', 'branch_with_access')
+@pytest.mark.parametrize('indexed', [True, False])
+def test_get_imported_nfe_follow_cursors(store, client, imported_nfe, imported_nfe_xml, indexed):
+    imported_nfes = [imported_nfe]
+    for key in ['123', '456']:
+        imported_nfes.insert(0, ImportedNfe(store=store, key=key, xml=imported_nfe_xml,
+                                            cnpj=imported_nfe.cnpj,
+                                            process_date=datetime.now()))
+    query_string = {
+        'cnpj': imported_nfe.cnpj,
+        'limit': 1
+    }
+    with mock.patch('stoqserver.api.resources.imported_nfe.index_exists',
+                    return_value=indexed):
+        response = client.get('/api/v1/imported_nfe', query_string=query_string)
+        assert [r['id'] for r in response.json['records']] == [imported_nfes[0].id]
+
+        response = client.get(response.json['next'])
+        assert [r['id'] for r in response.json['records']] == [imported_nfes[1].id]
+
+        response = client.get(response.json['next'])
+        assert [r['id'] for r in response.json['records']] == [imported_nfes[2].id]
+        assert response.json['next'] is None
+
+        response = client.get(response.json['previous'])
+        assert [r['id'] for r in response.json['records']] == [imported_nfes[1].id]
+
+        response = client.get(response.json['previous'])
+        assert [r['id'] for r in response.json['records']] == [imported_nfes[0].id]
+        assert response.json['previous'] is None
+        assert response.json['total_records'] == 3
+
+
+@pytest.mark.usefixtures('mock_new_store', 'branch_with_access')
+@mock.patch('stoqserver.api.resources.imported_nfe.estimate_count')
+def test_get_imported_nfe_estimated_count(mock_estimate_count, client, imported_nfe):
+    mock_estimate_count.return_value = 1000
+    query_string = {
+        'cnpj': imported_nfe.cnpj,
+        'count': 'estimated',
+    }
+    response = client.get('/api/v1/imported_nfe', query_string=query_string)
+
+    assert response.status_code == 200
+    assert response.json['total_records'] == 1000
+    assert response.json['count'] == 1
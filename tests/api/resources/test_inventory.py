@@ -22,11 +22,22 @@
 # Author(s): Stoq Team <dev@stoq.com.br>
 #
 
+import contextlib
+import io
 import json
+from decimal import Decimal
+from unittest import mock
+
 import pytest
+from storm.tracer import install_tracer, remove_tracer
 
 from stoqlib.domain.inventory import Inventory
 
+from stoqserver.api.resources.inventory import (InventoryResource,
+                                                _close_inventory_in_background,
+                                                _get_closing_job, _parse_count_chunk)
+from stoqserver.lib.eventstream import redis_server
+
 pytestmark = pytest.mark.usefixtures('mock_new_store')
 
 
@@ -42,6 +53,25 @@ def inventory(example_creator):
     return inventory
 
 
+class _StatementCounter:
+    def __init__(self):
+        self.statements = []
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.statements.append(statement)
+
+
+@contextlib.contextmanager
+def _count_statements(store):
+    store.flush()
+    counter = _StatementCounter()
+    install_tracer(counter)
+    try:
+        yield counter.statements
+    finally:
+        remove_tracer(counter)
+
+
 def test_inventory_post(client, store, example_creator, branch):
     product = example_creator.create_product(branch=branch, description='Product 1',
                                              stock=1, storable=True)
@@ -381,3 +411,230 @@ def test_inventory_put_already_closed(client, inventory):
 
     assert response.status_code == 400
     assert res['message'] == 'It isn\'t possible to close an inventory which is not opened'
+
+
+@pytest.mark.parametrize('size', (2, 20))
+def test_inventory_convert_count_keys_query_count(store, example_creator, branch, size):
+    count = {}
+    for i in range(size):
+        sellable = example_creator.create_sellable()
+        if i % 2:
+            sellable.barcode = 'barcode-%s' % i
+            count[sellable.barcode] = i
+        else:
+            sellable.code = 'code-%s' % i
+            count[sellable.code] = i
+    count['not-found'] = 1
+
+    with _count_statements(store) as statements:
+        data, not_found = InventoryResource()._convert_count_keys(store, count)
+
+    # One query for the barcodes and another one for the codes, no matter the count size
+    assert len(statements) == 2
+    assert len(data) == size
+    assert not_found == {'not-found'}
+
+
+@pytest.mark.parametrize('size', (2, 20))
+def test_inventory_apply_count_query_count(store, example_creator, inventory, size):
+    count = {}
+    for i in range(size):
+        item = example_creator.create_inventory_item(inventory=inventory)
+        count[item.product.sellable] = i
+
+    with _count_statements(store) as statements:
+        stock_not_managed = InventoryResource()._apply_count_to_inventory(
+            store, count, inventory)
+
+    assert len(statements) == 1
+    assert stock_not_managed == []
+    assert {item.counted_quantity for item in inventory.get_items()} == set(range(size))
+
+
+def test_parse_count_chunk():
+    stream = io.BytesIO(b'{"barcode": "123", "quantity": 2}\n\n{"barcode": "456", "quantity": 1.5}\n')
+    assert _parse_count_chunk(stream) == [['123', '2'], ['456', '1.5']]
+
+    stream = io.BytesIO(b'123,2\n"4,56",1.5\n')
+    assert _parse_count_chunk(stream, is_csv=True) == [['123', '2'], ['4,56', '1.5']]
+
+
+@pytest.mark.parametrize('content, is_csv, message', (
+    (b'{"barcode": "123"}', False, 'Invalid line 1: {"barcode": "123"}'),
+    (b'{"barcode": "123", "quantity": 1}\nfoo', False, 'Invalid line 2: foo'),
+    (b'{"barcode": "", "quantity": 1}', False, 'Invalid barcode on line 1: '),
+    (b'{"barcode": "123", "quantity": -1}', False, 'Invalid quantity on line 1: -1'),
+    (b'{"barcode": "123", "quantity": "1"}', False, 'Invalid quantity on line 1: 1'),
+    (b'123', True, 'Invalid line 1: 123'),
+    (b'123,foo', True, 'Invalid line 1: 123,foo'),
+    (b'123,nan', True, 'Invalid quantity on line 1: NaN'),
+))
+def test_parse_count_chunk_invalid(content, is_csv, message):
+    with pytest.raises(ValueError) as err:
+        _parse_count_chunk(io.BytesIO(content), is_csv=is_csv)
+    assert str(err.value) == message
+
+
+@mock.patch('stoqserver.api.resources.inventory.MAX_CHUNK_LINES', 1)
+def test_parse_count_chunk_too_many_lines():
+    with pytest.raises(ValueError) as err:
+        _parse_count_chunk(io.BytesIO(b'123,1\n456,1\n'), is_csv=True)
+    assert str(err.value) == 'Chunks can have at most 1 lines'
+
+
+def test_inventory_session(client, store, example_creator, branch):
+    product = example_creator.create_product(branch=branch, description='Product 1',
+                                             stock=1, storable=True)
+    product.sellable.barcode = '7891910000197'
+
+    response = client.post('/inventory/session', json={'branch_id': branch.id})
+    assert response.status_code == 201
+    session_id = response.json['id']
+    route = '/inventory/session/{}'.format(session_id)
+
+    for quantity in [2, 3.5]:
+        chunk = json.dumps({'barcode': product.sellable.barcode, 'quantity': quantity})
+        chunk += '\n' + json.dumps({'barcode': 'not-found', 'quantity': 1})
+        response = client.post(route, data=chunk)
+        assert response.status_code == 200
+        assert response.json['received'] == 2
+
+    assert response.json['chunks'] == 2
+
+    response = client.put(route)
+    assert response.status_code == 201
+    assert response.json['not_found'] == ['not-found']
+    inventory = store.get(Inventory, response.json['id'])
+    item = inventory.get_items_for_adjustment().one()
+    assert item.counted_quantity == Decimal('5.5')
+
+    assert not redis_server.exists('inventory-session-{}'.format(session_id))
+    assert client.put(route).status_code == 404
+
+
+def test_inventory_session_invalid_chunk(client, branch):
+    response = client.post('/inventory/session', json={'branch_id': branch.id})
+    route = '/inventory/session/{}'.format(response.json['id'])
+
+    response = client.post(route, data='foo')
+    assert response.status_code == 400
+    assert response.json == {'message': 'Invalid line 1: foo'}
+
+    response = client.put(route)
+    assert response.status_code == 400
+    assert response.json == {'message': 'No count provided'}
+
+
+def test_inventory_session_delete(client, branch):
+    response = client.post('/inventory/session', json={'branch_id': branch.id})
+    route = '/inventory/session/{}'.format(response.json['id'])
+
+    assert client.delete(route).status_code == 200
+    assert client.post(route, data='{"barcode": "123", "quantity": 1}').status_code == 404
+
+
+@pytest.mark.parametrize('payload, status_code, message', (
+    ({}, 400, 'No branch_id provided'),
+    ({'branch_id': '888dbd47-f8b3-11e8-8ca5-000bca142853'}, 404,
+     'Branch 888dbd47-f8b3-11e8-8ca5-000bca142853 not found'),
+))
+def test_inventory_session_open_invalid(client, payload, status_code, message):
+    response = client.post('/inventory/session', json=payload)
+    assert response.status_code == status_code
+    assert response.json == {'message': message}
+
+
+def test_inventory_get(client, inventory):
+    response = client.get('/inventory/{}'.format(inventory.id))
+    assert response.status_code == 200
+    assert response.json == {
+        'id': inventory.id,
+        'identifier': inventory.identifier,
+        'status': Inventory.STATUS_OPEN,
+        'closing': None,
+    }
+
+
+def test_inventory_get_not_found(client):
+    response = client.get('/inventory/888dbd47-f8b3-11e8-8ca5-000bca142853')
+    assert response.status_code == 404
+
+
+@mock.patch('stoqserver.api.resources.inventory.gevent.spawn')
+def test_inventory_put_closed_in_background(mock_spawn, client, example_creator, inventory):
+    example_creator.create_inventory_item(inventory=inventory).counted_quantity = 6
+
+    payload = {'status': 'closed', 'background': True}
+    try:
+        response = client.put('/inventory/{}'.format(inventory.id), json=payload)
+        assert response.status_code == 202
+        assert response.json['status'] == Inventory.STATUS_OPEN
+        assert response.json['closing'] == {'status': 'running', 'adjusted': 0, 'total': 1}
+        mock_spawn.assert_called_once_with(_close_inventory_in_background, inventory.id,
+                                           client.user.id, client.station.id)
+
+        # The inventory can't be closed twice at the same time
+        response = client.put('/inventory/{}'.format(inventory.id), json=payload)
+        assert response.status_code == 409
+        assert response.json == {
+            'message': 'Inventory {} is already being closed'.format(inventory.id)}
+    finally:
+        redis_server.delete('inventory-closing-{}'.format(inventory.id),
+                            'inventory-closing-{}-lock'.format(inventory.id))
+
+
+@mock.patch('stoqserver.api.resources.inventory.ADJUSTMENT_BATCH_SIZE', 2)
+@mock.patch('stoqserver.api.resources.inventory.EventStream.add_station_event')
+def test_close_inventory_in_background(mock_add_event, example_creator, inventory,
+                                       current_user, current_station):
+    for i in range(3):
+        example_creator.create_inventory_item(inventory=inventory).counted_quantity = 6
+
+    _close_inventory_in_background(inventory.id, current_user.id, current_station.id)
+
+    assert inventory.status == Inventory.STATUS_CLOSED
+    assert _get_closing_job(inventory.id) == {'status': 'done', 'adjusted': 3, 'total': 3}
+    assert all(c[0][0] == current_station.id for c in mock_add_event.call_args_list)
+    assert [c[0][1] for c in mock_add_event.call_args_list] == [
+        {'type': 'INVENTORY_CLOSING_PROGRESS', 'adjusted': 2, 'total': 3,
+         'inventory_id': inventory.id},
+        {'type': 'INVENTORY_CLOSING_PROGRESS', 'adjusted': 3, 'total': 3,
+         'inventory_id': inventory.id},
+        {'type': 'INVENTORY_CLOSING_FINISHED', 'success': True, 'inventory_id': inventory.id},
+    ]
+    redis_server.delete('inventory-closing-{}'.format(inventory.id))
+
+
+@mock.patch('stoqserver.api.resources.inventory.EventStream.add_station_event')
+@mock.patch('stoqserver.api.resources.inventory._adjust_inventory')
+def test_close_inventory_in_background_error(mock_adjust_inventory, mock_add_event, inventory,
+                                             current_user, current_station):
+    mock_adjust_inventory.side_effect = Exception('foo')
+
+    _close_inventory_in_background(inventory.id, current_user.id, current_station.id)
+
+    job = _get_closing_job(inventory.id)
+    assert job['status'] == 'error'
+    assert job['message'] == 'foo'
+    mock_add_event.assert_called_once_with(
+        current_station.id,
+        {'type': 'INVENTORY_CLOSING_FINISHED', 'success': False, 'message': 'foo',
+         'inventory_id': inventory.id})
+    redis_server.delete('inventory-closing-{}'.format(inventory.id))
+
+
+def test_get_closing_job_interrupted(inventory):
+    key = 'inventory-closing-{}'.format(inventory.id)
+    redis_server.hset(key, mapping={'status': 'running', 'adjusted': 2, 'total': 3})
+    redis_server.set(key + '-lock', 1)
+    try:
+        assert _get_closing_job(inventory.id) == {'status': 'running', 'adjusted': 2,
+                                                  'total': 3}
+
+        # The process closing it died and the lock expired
+        redis_server.delete(key + '-lock')
+        assert _get_closing_job(inventory.id) == {
+            'status': 'error', 'adjusted': 2, 'total': 3,
+            'message': 'The closing of the inventory was interrupted'}
+    finally:
+        redis_server.delete(key, key + '-lock')
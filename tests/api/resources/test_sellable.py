@@ -1,11 +1,13 @@
 import json
+from unittest import mock
 import pytest
 from decimal import Decimal
 
-from stoqlib.domain.product import Product
+from stoqlib.domain.overrides import SellableBranchOverride
+from stoqlib.domain.product import Product, Storable
 from stoqlib.domain.sellable import Sellable
 
-from stoqserver.api.resources.sellable import SellableResource
+from stoqserver.api.resources.sellable import MAX_BULK_SIZE, SellableResource
 
 
 @pytest.fixture
@@ -238,6 +240,85 @@ def test_sellable_get_all(client, example_creator):
     assert set(("description", "id", "image_id", "barcode", "notes")) == res['data'][0].keys()
 
 
+@pytest.mark.usefixtures('mock_new_store')
+def test_sellable_get_all_paginated(client, example_creator):
+    for i in range(3):
+        example_creator.create_sellable(description="S%s" % i)
+
+    ids = []
+    next_ = '/sellable?limit=2'
+    while next_:
+        response = client.get(next_)
+        assert response.status_code == 200
+        assert len(response.json['data']) <= 2
+        ids.extend(s['id'] for s in response.json['data'])
+        next_ = response.json['next']
+
+    assert len(ids) >= 3
+    assert len(ids) == len(set(ids))
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_sellable_get_all_not_paginated(client, example_creator, store):
+    for i in range(3):
+        example_creator.create_sellable(description="S%s" % i)
+
+    with mock.patch('stoqserver.api.resources.sellable.DEFAULT_PAGE_SIZE', 2):
+        response = client.get('/sellable')
+
+    assert response.status_code == 200
+    assert response.json['next'] is None
+    assert len(response.json['data']) == store.find(Sellable).count()
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_sellable_get_all_with_filters(client, example_creator):
+    sellable = example_creator.create_sellable(description="S1")
+    sellable.barcode = '7896045504831'
+    sellable.status = Sellable.STATUS_CLOSED
+    main_image = example_creator.create_image()
+    main_image.sellable_id = sellable.id
+    main_image.is_main = True
+    other_image = example_creator.create_image()
+    other_image.sellable_id = sellable.id
+
+    query_string = {
+        'barcode': sellable.barcode,
+        'status': Sellable.STATUS_CLOSED,
+        'updated_since': '2020-01-01',
+        'fields': 'id,status,image_id',
+    }
+    response = client.get('/sellable', query_string=query_string)
+    assert response.status_code == 200
+    assert response.json == {
+        'data': [{
+            'id': sellable.id,
+            'status': Sellable.STATUS_CLOSED,
+            'image_id': main_image.id,
+        }],
+        'next': None,
+    }
+
+    query_string['status'] = Sellable.STATUS_AVAILABLE
+    response = client.get('/sellable', query_string=query_string)
+    assert response.json['data'] == []
+
+
+@pytest.mark.parametrize('query_string, message', (
+    ({'limit': 'foo'}, "'limit' must be a number"),
+    ({'limit': 1001}, "'limit' must be lower than 1000"),
+    ({'cursor': 'foo'}, "Invalid 'cursor' provided"),
+    ({'fields': 'id,foo'}, 'Invalid fields: foo'),
+    ({'status': 'foo'}, 'Status must be: available or closed'),
+    ({'updated_since': 'foo'}, "Invalid 'updated_since' provided: foo"),
+))
+@pytest.mark.usefixtures('mock_new_store')
+def test_sellable_get_all_invalid_args(client, query_string, message):
+    response = client.get('/sellable', query_string=query_string)
+    assert response.status_code == 400
+    assert response.json == {'message': message}
+
+
 def test_price_validation():
     res = SellableResource()._price_validation({
         'base_price': 10.00
@@ -251,3 +332,75 @@ def test_price_validation():
         'base_price': 0
     })
     assert res == Decimal("0.01")
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_sellable_bulk(client, store, sellable, current_station):
+    new_id = '8397d64b-5024-4142-af00-a0e3df3ff4ad'
+    payload = {
+        'sellables': [
+            {'sellable_id': new_id, 'barcode': '7896045504831', 'description': 'Cerveja',
+             'base_price': 3.7, 'product': {'manage_stock': True}},
+            # The same id, but not in its canonical form
+            {'sellable_id': sellable.id.upper(), 'product': {}},
+            {'barcode': '7896045504831', 'product': {}},
+            {'base_price': -1, 'product': {}},
+            {'barcode': '123'},
+        ],
+        'overrides': [
+            {'sellable_id': new_id, 'branch_id': current_station.branch_id,
+             'status': Sellable.STATUS_AVAILABLE, 'base_price': 4},
+            {'sellable_id': sellable.id, 'branch_id': current_station.branch_id,
+             'status': 'foo'},
+            {'sellable_id': '888dbd47-f8b3-11e8-8ca5-000bca142853',
+             'branch_id': current_station.branch_id},
+            {'sellable_id': sellable.id, 'branch_id': current_station.branch_id.upper()},
+        ],
+    }
+
+    response = client.post('/sellable/bulk', json=payload)
+    assert response.status_code == 200
+    assert [r['result'] for r in response.json['sellables']] == [
+        'created', 'exists', 'exists', 'error', 'error']
+    assert response.json['sellables'][1]['message'] == (
+        'Product with id {} already exists'.format(sellable.id))
+    assert response.json['sellables'][2]['message'] == (
+        'Product with barcode 7896045504831 already exists')
+    assert response.json['sellables'][3]['message'] == 'Price must be greater than 0'
+    assert response.json['sellables'][4]['message'] == 'There is no product data on payload'
+
+    assert [r['result'] for r in response.json['overrides']] == [
+        'updated', 'error', 'error', 'updated']
+    assert response.json['overrides'][0]['status'] == Sellable.STATUS_AVAILABLE
+    assert response.json['overrides'][0]['base_price'] == '4'
+    assert response.json['overrides'][3]['branch_id'] == current_station.branch_id
+
+    new_sellable = store.get(Sellable, new_id)
+    assert new_sellable.barcode == '7896045504831'
+    assert new_sellable.status == Sellable.STATUS_CLOSED
+    assert store.get(Storable, new_id) is not None
+    sbo = SellableBranchOverride.find_by_sellable(branch=current_station.branch,
+                                                  sellable=new_sellable)
+    assert sbo.status == Sellable.STATUS_AVAILABLE
+
+
+@pytest.mark.usefixtures('mock_new_store')
+@pytest.mark.parametrize('payload, message', [
+    ({'sellables': [{'sellable_id': 'foo', 'product': {}}]}, 'Invalid sellable_id foo'),
+    ({'overrides': [{'sellable_id': '8397d64b-5024-4142-af00-a0e3df3ff4ad',
+                     'branch_id': 'foo'}]}, 'Invalid branch_id foo'),
+])
+def test_sellable_bulk_invalid_ids(client, payload, message):
+    response = client.post('/sellable/bulk', json=payload)
+    assert response.status_code == 400
+    assert response.json == {'message': message}
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_sellable_bulk_too_many_rows(client):
+    payload = {'sellables': [{}] * (MAX_BULK_SIZE + 1)}
+    response = client.post('/sellable/bulk', json=payload)
+    assert response.status_code == 400
+    assert response.json == {
+        'message': 'At most {} sellables and overrides can be sent at once'.format(
+            MAX_BULK_SIZE)}
@@ -2,6 +2,8 @@ from unittest import mock
 import json
 import pytest
 
+from stoqserver.lib import delivery, ingestion
+from stoqserver.lib.eventstream import redis_server
 from stoqserver.signals import WebhookEvent
 
 
@@ -12,6 +14,7 @@ def mock_config(monkeypatch):
     get_config_mock.return_value.has_section.return_value = True
     get_config_mock.return_value.get.return_value = 'mysecretaccesstoken'
     monkeypatch.setattr('stoqserver.api.resources.webhook.get_config', get_config_mock)
+    return get_config_mock
 
 
 @pytest.mark.usefixtures('mock_new_store')
@@ -35,3 +38,148 @@ def test_post_webhook(client):
     res = json.loads(response.data.decode('utf-8'))
     assert response.status_code == 200
     assert res == {'response': True}
+
+
+@mock.patch('stoqserver.api.resources.webhook.ingestion.ingest_event')
+@pytest.mark.usefixtures('mock_new_store')
+def test_post_webhook_ingest(mock_ingest_event, client, mock_config):
+    config = {'access_token': 'mysecretaccesstoken', 'webhook_ingest': 'true'}
+    mock_config.return_value.get.side_effect = lambda section, option: config[option]
+    mock_ingest_event.return_value = ('e1', True)
+    callback = mock.Mock()
+    WebhookEvent.connect(callback)
+
+    client.auth_token = 'mysecretaccesstoken'
+    response = client.post("/v1/webhooks/event", data=b'{"id": "e1"}')
+
+    assert response.status_code == 202
+    assert response.json == {'id': 'e1', 'duplicated': False}
+    mock_ingest_event.assert_called_once_with(b'{"id": "e1"}')
+    callback.assert_not_called()
+    WebhookEvent.disconnect(callback)
+
+
+@pytest.fixture
+def destination():
+    destination = delivery.register_destination('test', 'http://example.com/hook')
+    yield destination
+    redis_server.delete(destination.queue_key, destination.dead_key, destination.state_key)
+    delivery._destinations.pop('test')
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_deliveries(client, destination):
+    client.auth_token = 'mysecretaccesstoken'
+    response = client.get('/v1/webhooks/deliveries')
+
+    assert response.status_code == 200
+    assert response.json['test'] == {
+        'pending': 0,
+        'dead': 0,
+        'attempts': 0,
+        'next_attempt': None,
+        'last_error': None,
+    }
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_deliveries_invalid_token(client, destination):
+    client.auth_token = 'invalid'
+    response = client.get('/v1/webhooks/deliveries')
+
+    assert response.status_code == 401
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_delivery_not_found(client, destination):
+    client.auth_token = 'mysecretaccesstoken'
+    response = client.get('/v1/webhooks/deliveries/missing')
+
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('query_string, message', [
+    ({'start': 'foo'}, "'start' must be a number"),
+    ({'count': 'foo'}, "'count' must be a number"),
+    ({'start': -1}, "'start' must not be negative"),
+    ({'count': 0}, "'count' must be between 1 and 1000"),
+    ({'count': 1001}, "'count' must be between 1 and 1000"),
+])
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_delivery_invalid_args(client, destination, query_string, message):
+    client.auth_token = 'mysecretaccesstoken'
+    response = client.get('/v1/webhooks/deliveries/test', query_string=query_string)
+
+    assert response.status_code == 400
+    assert response.json == {'message': message}
+
+
+@mock.patch('stoqserver.api.resources.webhook.delivery.requeue_dead_letters')
+@pytest.mark.usefixtures('mock_new_store')
+def test_post_delivery_requeue(mock_requeue, client, destination):
+    mock_requeue.return_value = 3
+    client.auth_token = 'mysecretaccesstoken'
+    response = client.post('/v1/webhooks/deliveries/test')
+
+    assert response.status_code == 200
+    assert response.json == {'requeued': 3}
+    mock_requeue.assert_called_once_with('test')
+
+
+@pytest.fixture
+def webhook_source():
+    redis_server.sadd(ingestion.SOURCES_KEY, 'test')
+    yield 'test'
+    redis_server.srem(ingestion.SOURCES_KEY, 'test')
+    redis_server.delete('webhook-dead-test')
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_ingestion_source(client, webhook_source):
+    redis_server.rpush('webhook-dead-test', json.dumps({'id': 'e1', 'error': 'foo'}))
+    client.auth_token = 'mysecretaccesstoken'
+    response = client.get('/v1/webhooks/ingestion/test')
+
+    assert response.status_code == 200
+    assert response.json == {
+        'status': {'pending': 0, 'dead': 1, 'attempts': 0, 'next_attempt': None,
+                   'last_error': None},
+        'failed_events': [{'id': 'e1', 'error': 'foo'}],
+    }
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_ingestion_invalid_token(client, webhook_source):
+    client.auth_token = 'invalid'
+    response = client.get('/v1/webhooks/ingestion')
+
+    assert response.status_code == 401
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_ingestion_source_not_found(client, webhook_source):
+    client.auth_token = 'mysecretaccesstoken'
+    response = client.get('/v1/webhooks/ingestion/missing')
+
+    assert response.status_code == 404
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_get_ingestion_source_invalid_args(client, webhook_source):
+    client.auth_token = 'mysecretaccesstoken'
+    response = client.get('/v1/webhooks/ingestion/test', query_string={'start': 'foo'})
+
+    assert response.status_code == 400
+    assert response.json == {'message': "'start' must be a number"}
+
+
+@mock.patch('stoqserver.api.resources.webhook.ingestion.requeue_failed_events')
+@pytest.mark.usefixtures('mock_new_store')
+def test_post_ingestion_requeue(mock_requeue, client, webhook_source):
+    mock_requeue.return_value = 2
+    client.auth_token = 'mysecretaccesstoken'
+    response = client.post('/v1/webhooks/ingestion/test')
+
+    assert response.status_code == 200
+    assert response.json == {'requeued': 2}
+    mock_requeue.assert_called_once_with('test')
@@ -8,6 +8,9 @@ from lxml import etree
 
 from stoqlib.lib.decorators import cached_property
 from stoqserver.app import bootstrap_app
+from stoqserver.lib import categoryprices, clientlookup, tillsummary
+from stoqserver.lib.diskcache import DiskCache
+from stoqserver.lib.documentcache import RenderedDocumentCache
 from stoqserver.utils import get_pytests_datadir
 
 
@@ -36,6 +39,9 @@ class StoqTestClient(FlaskClient):
             response.json = json.loads(response.data.decode())
         except AttributeError:
             pass
+        except ValueError:
+            # Not a json response (e.g. a NDJSON stream)
+            response.json = None
         return response
 
     def get(self, *args, **kwargs):
@@ -51,6 +57,9 @@ class StoqTestClient(FlaskClient):
             kwargs['data'] = json.dumps(kwargs.pop('json'))
         return self._request('put', *args, **kwargs)
 
+    def delete(self, *args, **kwargs):
+        return self._request('delete', *args, **kwargs)
+
 
 class B1foodTestClient(FlaskClient):
     @cached_property(ttl=0)
@@ -77,6 +86,26 @@ class B1foodTestClient(FlaskClient):
         return self._request('get', *args, **kwargs)
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # The cached objects would outlive the test transaction
+    clientlookup.clear_cache()
+    categoryprices.clear_cache()
+    tillsummary.clear_cache()
+    yield
+    clientlookup.clear_cache()
+    categoryprices.clear_cache()
+    tillsummary.clear_cache()
+
+
+@pytest.fixture(autouse=True)
+def document_cache(monkeypatch, tmp_path):
+    # Do not render the documents to the real cache
+    cache = RenderedDocumentCache(DiskCache(str(tmp_path / 'document-cache')))
+    monkeypatch.setattr('stoqserver.lib.restful.get_document_cache', lambda: cache)
+    return cache
+
+
 # This is flask test client according to boilerplate:
 # https://flask.palletsprojects.com/en/1.0.x/testing/
 @pytest.fixture
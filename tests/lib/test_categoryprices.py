@@ -0,0 +1,38 @@
+from unittest import mock
+
+from stoqserver.lib.categoryprices import CategoryPriceCache
+
+
+def test_category_price_cache():
+    cache = CategoryPriceCache()
+    prices = {'s1': {'c1': '10'}}
+    cache.set(('b1', None), (1, None), ['s1', 's2'], prices)
+
+    assert cache.get(('b1', None), (1, None), ['s1']) is prices
+    assert cache.get(('b1', 'pos'), (1, None), ['s1']) is None
+    # The price tables changed
+    assert cache.get(('b1', None), (2, None), ['s1']) is None
+    # A sellable was added to the catalog after the prices were cached
+    assert cache.get(('b1', None), (1, None), ['s1', 's3']) is None
+
+
+@mock.patch('stoqserver.lib.categoryprices.time.monotonic')
+def test_category_price_cache_ttl(mock_monotonic):
+    cache = CategoryPriceCache(ttl=10)
+    mock_monotonic.return_value = 100
+    cache.set(('b1', None), 1, [], {})
+
+    mock_monotonic.return_value = 109
+    assert cache.get(('b1', None), 1, []) == {}
+    mock_monotonic.return_value = 111
+    assert cache.get(('b1', None), 1, []) is None
+
+
+def test_category_price_cache_invalidate():
+    cache = CategoryPriceCache()
+    cache.set(('b1', None), 1, [], {})
+    cache.set(('b2', None), 1, [], {})
+
+    cache.invalidate()
+    assert cache.get(('b1', None), 1, []) is None
+    assert cache.get(('b2', None), 1, []) is None
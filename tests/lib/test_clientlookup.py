@@ -0,0 +1,85 @@
+from unittest import mock
+
+from stoqserver.lib.clientlookup import DocumentCache, _MISSING, find_person_by_document
+
+
+def test_document_cache_lru():
+    cache = DocumentCache(size=2)
+    cache.set('1', 'a')
+    cache.set('2', 'b')
+    assert cache.get('1') == 'a'
+
+    # '2' is the least recently used one
+    cache.set('3', 'c')
+    assert cache.get('2') is _MISSING
+    assert cache.get('1') == 'a'
+    assert cache.get('3') == 'c'
+
+    cache.invalidate('1')
+    assert cache.get('1') is _MISSING
+    cache.invalidate()
+    assert cache.get('3') is _MISSING
+
+
+@mock.patch('stoqserver.lib.clientlookup.time.monotonic')
+def test_document_cache_ttl(mock_monotonic):
+    cache = DocumentCache(ttl=10)
+    mock_monotonic.return_value = 100
+    cache.set('1', 'a')
+
+    mock_monotonic.return_value = 109
+    assert cache.get('1') == 'a'
+    mock_monotonic.return_value = 111
+    assert cache.get('1') is _MISSING
+
+
+def test_find_person_by_document(store, example_creator):
+    individual = example_creator.create_individual()
+    individual.cpf = '160.618.061-40'
+    company = example_creator.create_company()
+    company.cnpj = '99399705000190'
+
+    assert find_person_by_document(store, '16061806140') == individual.person
+    assert find_person_by_document(store, '160.618.061-40') == individual.person
+    assert find_person_by_document(store, '99.399.705/0001-90') == company.person
+    assert find_person_by_document(store, '') is None
+    assert find_person_by_document(store, None) is None
+
+
+def test_find_person_by_document_cache(store, example_creator):
+    assert find_person_by_document(store, '160.618.061-40') is None
+
+    # Persons that were not found are not cached
+    individual = example_creator.create_individual()
+    individual.cpf = '160.618.061-40'
+    assert find_person_by_document(store, '160.618.061-40') == individual.person
+
+    with mock.patch('stoqserver.lib.clientlookup._find_person') as mock_find_person:
+        assert find_person_by_document(store, '160.618.061-40') == individual.person
+    mock_find_person.assert_not_called()
+
+    # The cached person doesn't have that document anymore
+    individual.cpf = '999.999.999-99'
+    assert find_person_by_document(store, '160.618.061-40') is None
+
+
+@mock.patch('stoqserver.lib.clientlookup.index_exists')
+def test_find_person_by_document_without_index(mock_index_exists, store, example_creator):
+    mock_index_exists.return_value = False
+    individual = example_creator.create_individual()
+    individual.cpf = '160.618.061-40'
+    company = example_creator.create_company()
+    company.cnpj = '99399705000190'
+
+    # The formatted document is still found, but not the unformatted one
+    assert find_person_by_document(store, '16061806140') == individual.person
+    assert find_person_by_document(store, '99.399.705/0001-90') is None
+
+
+@mock.patch('stoqserver.lib.clientlookup.index_exists')
+def test_find_person_by_document_index_checked_once(mock_index_exists, store):
+    mock_index_exists.return_value = True
+
+    assert find_person_by_document(store, '16061806140') is None
+    assert find_person_by_document(store, '16061806140') is None
+    mock_index_exists.assert_called_once_with(store, 'individual_cpf_digits_idx')
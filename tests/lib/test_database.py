@@ -0,0 +1,193 @@
+import socket
+from unittest import mock
+
+import gevent
+import pytest
+from flask import Flask
+from storm.database import create_database
+from storm.expr import SQL, Select
+from storm.store import Store
+
+from stoqserver.lib.database import (ReadOnlyStorePool, _is_client_disconnected,
+                                     cancel_on_disconnect, create_readonly_store_pool,
+                                     disconnect_store, estimate_count, get_statement_timeout,
+                                     readonly_store, set_statement_timeout)
+
+
+@pytest.fixture
+def database():
+    return mock.Mock()
+
+
+@pytest.fixture
+def app():
+    return Flask(__name__)
+
+
+def test_set_statement_timeout():
+    store = mock.Mock()
+    set_statement_timeout(store, 1.5)
+    store.execute.assert_called_once_with('SET LOCAL statement_timeout = 1500')
+
+
+def test_disconnect_store():
+    store = Store(create_database('sqlite:'))
+    store.execute('SELECT 1')
+    raw_connection = store._connection._raw_connection
+
+    disconnect_store(store)
+    with pytest.raises(Exception):
+        raw_connection.execute('SELECT 1')
+
+    # It reconnects when used again
+    assert store.execute('SELECT 1').get_one() == (1, )
+    assert store._connection._raw_connection is not raw_connection
+
+
+def test_disconnect_store_without_reconnecting(tmp_path):
+    store = Store(create_database('sqlite:{}'.format(tmp_path / 'db.sqlite')))
+    store.execute('CREATE TABLE foo (id INTEGER PRIMARY KEY)')
+    store.commit()
+    store.execute('INSERT INTO foo VALUES (1)')
+    database = store._connection._database
+
+    with mock.patch.object(database, 'raw_connect', wraps=database.raw_connect) as mock_connect:
+        disconnect_store(store)
+        mock_connect.assert_not_called()
+
+        # The changes that were not committed are lost
+        assert store.execute('SELECT COUNT(*) FROM foo').get_one() == (0, )
+        mock_connect.assert_called_once_with()
+
+
+@mock.patch('stoqserver.lib.database.StoqlibStore')
+def test_readonly_store_pool(mock_store_class, database):
+    pool = ReadOnlyStorePool(database, size=2, statement_timeout=10)
+
+    with pool.store() as store:
+        assert store is mock_store_class.return_value
+        assert store.execute.call_args_list == [
+            mock.call('SET TRANSACTION READ ONLY'),
+            mock.call('SET LOCAL statement_timeout = 10000'),
+        ]
+
+    store.rollback.assert_called_once_with()
+    store.reset.assert_called_once_with()
+    mock_store_class.assert_called_once_with(database)
+
+    # The released store should be reused
+    with pool.store(statement_timeout=1) as other_store:
+        assert other_store is store
+        other_store.execute.assert_called_with('SET LOCAL statement_timeout = 1000')
+    assert mock_store_class.call_count == 1
+
+
+@mock.patch('stoqserver.lib.database.StoqlibStore')
+def test_readonly_store_pool_discard_broken_store(mock_store_class, database):
+    pool = ReadOnlyStorePool(database)
+    broken_store = mock.Mock()
+    broken_store.rollback.side_effect = Exception('connection lost')
+    mock_store_class.side_effect = [broken_store, mock.Mock()]
+
+    with pool.store():
+        pass
+    broken_store.close.assert_called_once_with()
+
+    with pool.store() as store:
+        assert store is not broken_store
+
+
+@mock.patch('stoqserver.lib.database.get_config')
+def test_get_readonly_store_pool_disabled(mock_get_config):
+    mock_get_config.return_value.get.return_value = None
+    assert create_readonly_store_pool() is None
+
+
+@mock.patch('stoqserver.lib.database.create_database')
+@mock.patch('stoqserver.lib.database.get_config')
+def test_get_readonly_store_pool_with_replica(mock_get_config, mock_create_database):
+    config = {
+        'enabled': 'true',
+        'uri': 'postgres://replica/stoq',
+        'pool_size': '2',
+        'statement_timeout': '30',
+    }
+    mock_get_config.return_value.get.side_effect = lambda section, name: config.get(name)
+
+    pool = create_readonly_store_pool()
+    mock_create_database.assert_called_once_with('postgres://replica/stoq')
+    assert pool._database is mock_create_database.return_value
+    assert pool._statement_timeout == 30
+
+
+@mock.patch('stoqserver.lib.database.get_readonly_store_pool')
+def test_readonly_store_without_pool(mock_get_pool, store):
+    mock_get_pool.return_value = None
+    with mock.patch('stoqserver.lib.database.api') as mock_api:
+        mock_api.new_store.return_value.__enter__.return_value = store
+        with readonly_store() as readonly:
+            assert readonly is store
+
+
+@mock.patch('stoqserver.lib.database.get_config')
+def test_get_statement_timeout(mock_get_config):
+    class FooResource:
+        statement_timeout = 60
+
+    mock_get_config.return_value.get.return_value = None
+    assert get_statement_timeout(None) is None
+    assert get_statement_timeout(FooResource()) == 60
+
+    mock_get_config.return_value.get.return_value = '10'
+    assert get_statement_timeout(FooResource()) == 10
+    mock_get_config.return_value.get.assert_called_with('StatementTimeouts', 'FooResource')
+
+
+def test_is_client_disconnected():
+    client, server = socket.socketpair()
+    assert not _is_client_disconnected(server)
+
+    client.send(b'x')
+    assert not _is_client_disconnected(server)
+
+    client.close()
+    server.recv(1)
+    assert _is_client_disconnected(server)
+
+    server.close()
+    assert _is_client_disconnected(server)
+
+
+def test_cancel_on_disconnect(app):
+    client, server = socket.socketpair()
+    store = mock.Mock()
+
+    with app.test_request_context('/foo', environ_base={'gunicorn.socket': server}):
+        with cancel_on_disconnect(store, interval=0.01):
+            gevent.sleep(0.05)
+            store._connection._raw_connection.cancel.assert_not_called()
+
+            client.close()
+            gevent.sleep(0.05)
+            store._connection._raw_connection.cancel.assert_called_once_with()
+
+    server.close()
+
+
+def test_cancel_on_disconnect_without_socket(app):
+    store = mock.Mock()
+    with mock.patch('stoqserver.lib.database.gevent') as mock_gevent:
+        with app.test_request_context('/foo'):
+            with cancel_on_disconnect(store):
+                pass
+
+    mock_gevent.spawn.assert_not_called()
+
+
+@pytest.mark.parametrize('plan', ([{'Plan': {'Plan Rows': 42}}], '[{"Plan": {"Plan Rows": 42}}]'))
+def test_estimate_count(plan):
+    store = mock.Mock()
+    store.execute.return_value.get_one.return_value = (plan, )
+
+    assert estimate_count(store, Select(SQL('1'), tables=[SQL('foo')])) == 42
+    store.execute.assert_called_once_with('EXPLAIN (FORMAT JSON) SELECT 1 FROM foo', [])
@@ -0,0 +1,107 @@
+from unittest import mock
+
+import pytest
+import requests
+
+from stoqserver.lib import delivery, redisqueue
+from stoqserver.lib.eventstream import redis_server
+
+
+@pytest.fixture
+def destination():
+    destination = delivery.register_destination('test', 'http://example.com/hook',
+                                                headers={'x-token': 'secret'}, batch_size=2)
+    keys = [destination.queue_key, destination.dead_key, destination.state_key,
+            destination.lock_key]
+    redis_server.delete(*keys)
+    yield destination
+    redis_server.delete(*keys)
+    delivery._destinations.pop('test')
+
+
+@pytest.fixture(autouse=True)
+def mock_start_workers():
+    with mock.patch('stoqserver.lib.delivery.start_workers') as mock_start_workers:
+        yield mock_start_workers
+
+
+@mock.patch('stoqserver.lib.delivery.httpclient.post')
+def test_deliver(mock_post, destination, mock_start_workers):
+    ids = [delivery.enqueue_event('test', {'sale': i}) for i in range(3)]
+    mock_start_workers.assert_called()
+
+    assert delivery.deliver(destination) == 2
+    events = mock_post.call_args[1]['json']
+    assert [event['id'] for event in events] == ids[:2]
+    assert [event['data'] for event in events] == [{'sale': 0}, {'sale': 1}]
+    mock_post.assert_called_once_with('http://example.com/hook', headers={'x-token': 'secret'},
+                                      json=events)
+
+    assert delivery.deliver(destination) == 1
+    assert delivery.deliver(destination) == 0
+    assert delivery.get_status()['test']['pending'] == 0
+
+
+@mock.patch('stoqserver.lib.delivery.httpclient.post')
+def test_deliver_locked(mock_post, destination):
+    delivery.enqueue_event('test', {})
+    redis_server.set(destination.lock_key, 'other worker')
+
+    assert delivery.deliver(destination) == 0
+    mock_post.assert_not_called()
+
+
+@mock.patch('stoqserver.lib.redisqueue.time.time')
+@mock.patch('stoqserver.lib.delivery.httpclient.post')
+def test_deliver_retry(mock_post, mock_time, destination):
+    mock_time.return_value = 1000
+    mock_post.side_effect = requests.ConnectionError('Connection refused')
+    delivery.enqueue_event('test', {})
+
+    assert delivery.deliver(destination) == 0
+    status = delivery.get_status()['test']
+    assert status['pending'] == 1
+    assert status['attempts'] == 1
+    assert status['last_error'] == 'Connection refused'
+
+    # It is not retried before the delay
+    assert delivery.deliver(destination) == 0
+    assert mock_post.call_count == 1
+
+    mock_time.return_value = 1000 + redisqueue.RETRY_DELAY
+    mock_post.side_effect = None
+    assert delivery.deliver(destination) == 1
+    status = delivery.get_status()['test']
+    assert status['pending'] == 0
+    assert status['attempts'] == 0
+
+
+@mock.patch('stoqserver.lib.redisqueue.time.time')
+@mock.patch('stoqserver.lib.delivery.httpclient.post')
+def test_deliver_dead_letters(mock_post, mock_time, destination):
+    destination.max_attempts = 2
+    mock_time.return_value = 1000
+    mock_post.return_value.raise_for_status.side_effect = requests.HTTPError('500 Server Error')
+    event_id = delivery.enqueue_event('test', {'sale': 1})
+
+    delivery.deliver(destination)
+    mock_time.return_value = 2000
+    delivery.deliver(destination)
+
+    status = delivery.get_status()['test']
+    assert status['pending'] == 0
+    assert status['dead'] == 1
+    dead_letters = delivery.get_dead_letters('test')
+    assert dead_letters[0]['id'] == event_id
+    assert dead_letters[0]['attempts'] == 2
+    assert dead_letters[0]['error'] == '500 Server Error'
+
+    assert delivery.requeue_dead_letters('test') == 1
+    assert delivery.get_dead_letters('test') == []
+    mock_post.return_value.raise_for_status.side_effect = None
+    assert delivery.deliver(destination) == 1
+    assert mock_post.call_args[1]['json'][0] == {
+        'id': event_id,
+        'created_at': dead_letters[0]['created_at'],
+        'data': {'sale': 1},
+    }
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import time
+
+import pytest
+from flask import Flask
+
+from stoqserver.lib.diskcache import DiskCache, send_cached_file
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    assert cache.get('abc') is None
+
+    path = cache.set('abc', b'data')
+    assert path == os.path.join(str(tmp_path), 'ab', 'abc')
+    assert cache.get('abc') == path
+    with open(path, 'rb') as f:
+        assert f.read() == b'data'
+
+    cache.invalidate('abc')
+    assert cache.get('abc') is None
+
+
+def test_disk_cache_eviction(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size=10)
+    for i, key in enumerate(['k1', 'k2', 'k3']):
+        path = cache.set(key, b'1234')
+        # Make sure the entries have different modification times
+        os.utime(path, (i, i))
+
+    # k1 was the least recently used entry
+    assert cache.get('k1') is None
+    assert cache.get('k2') is not None
+    assert cache.get('k3') is not None
+
+
+def test_disk_cache_eviction_keeps_new_entry(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size=2)
+    assert cache.get('k1') is None
+    path = cache.set('k1', b'1234')
+    assert os.path.exists(path)
+
+
+def test_send_cached_file(tmp_path):
+    path = DiskCache(str(tmp_path)).set('abc', b'data')
+    app = Flask(__name__)
+
+    with app.test_request_context('/'):
+        response = send_cached_file(path, 'abc', 'image/png', 60)
+        assert response.status_code == 200
+        assert response.headers['ETag'] == '"abc"'
+        assert response.headers['Cache-Control'] == 'public, max-age=60'
+        assert b''.join(response.response) == b'data'
+
+    with app.test_request_context('/', headers={'If-None-Match': '"abc"'}):
+        response = send_cached_file(path, 'abc', 'image/png', 60)
+        assert response.status_code == 304
+
+    # Evicted after its path was resolved
+    os.unlink(path)
+    with app.test_request_context('/'):
+        with pytest.raises(OSError):
+            send_cached_file(path, 'abc', 'image/png', 60)
+
+
+def test_disk_cache_set_chunks(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    key, path = cache.set_chunks(iter([b'da', b'ta']))
+    assert key == hashlib.sha256(b'data').hexdigest()
+    assert cache.get(key) == path
+    with open(path, 'rb') as f:
+        assert f.read() == b'data'
+
+    assert cache.set_chunks([b'data'], key='abc') == ('abc', cache.get('abc'))
+
+
+def test_disk_cache_set_chunks_error(tmp_path):
+    def _chunks():
+        yield b'data'
+        raise ValueError()
+
+    cache = DiskCache(str(tmp_path))
+    with pytest.raises(ValueError):
+        cache.set_chunks(_chunks(), key='abc')
+    assert cache.get('abc') is None
+    # The temporary file was removed
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_disk_cache_ttl(tmp_path):
+    cache = DiskCache(str(tmp_path), ttl=60)
+    path = cache.set('abc', b'data')
+    assert cache.get('abc') == path
+
+    # Reading the entry does not make it live longer
+    os.utime(path, (time.time(), time.time() - 61))
+    assert cache.get('abc') is None
+    assert not os.path.exists(path)
+
+
+def test_disk_cache_eviction_expired_first(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size=10, ttl=60)
+    expired_path = cache.set('k1', b'1234')
+    os.utime(expired_path, (time.time(), time.time() - 61))
+    path = cache.set('k2', b'1234')
+    # k2 is the least recently used one, but k1 expired
+    os.utime(path, (0, time.time()))
+    cache.set('k3', b'1234')
+
+    assert not os.path.exists(expired_path)
+    assert cache.get('k2') == path
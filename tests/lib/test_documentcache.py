@@ -0,0 +1,52 @@
+import datetime
+from unittest import mock
+
+import pytest
+from stoqlib.domain.sale import Sale
+
+from stoqserver.lib.diskcache import DiskCache
+from stoqserver.lib.documentcache import RenderedDocumentCache, get_te_time
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return RenderedDocumentCache(DiskCache(str(tmp_path)))
+
+
+def test_get_or_render(cache):
+    render = mock.Mock(return_value=('image', 'image/png'))
+
+    assert cache.get_or_render('coupon', 'id', 1, render) == ('image', 'image/png')
+    # Cached documents come back as they are stored in json
+    assert cache.get_or_render('coupon', 'id', 1, render) == ['image', 'image/png']
+    assert render.call_count == 1
+
+    # Other versions, ids and kinds are rendered again
+    cache.get_or_render('coupon', 'id', 2, render)
+    cache.get_or_render('coupon', 'other-id', 2, render)
+    cache.get_or_render('receipt', 'id', 2, render)
+    assert render.call_count == 4
+
+
+def test_get_or_render_without_version(cache):
+    render = mock.Mock(return_value='image')
+    cache.get_or_render('coupon', 'id', None, render)
+    cache.get_or_render('coupon', 'id', None, render)
+    assert render.call_count == 2
+
+
+@pytest.mark.parametrize('document', (None, b'not serializable'))
+def test_get_or_render_not_cached(cache, document):
+    render = mock.Mock(return_value=document)
+    assert cache.get_or_render('coupon', 'id', 1, render) == document
+    assert cache.get_or_render('coupon', 'id', 1, render) == document
+    assert render.call_count == 2
+
+
+def test_get_te_time(store, example_creator):
+    sale = example_creator.create_sale()
+    assert get_te_time(store, Sale, sale.id) == sale.te.te_time
+    assert get_te_time(store, Sale, None) is None
+
+    sale.te.te_time = sale.te.te_time + datetime.timedelta(seconds=1)
+    assert get_te_time(store, Sale, sale.id) == sale.te.te_time
@@ -0,0 +1,101 @@
+import http.server
+import threading
+from unittest import mock
+
+import pytest
+import requests
+
+from stoqserver.lib import httpclient
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.server.received.append((self.path, self.rfile.read(length)))
+        status, body = self.server.responses.get(self.path, (200, b'ok'))
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = http.server.HTTPServer(('127.0.0.1', 0), StubHandler)
+    server.received = []
+    server.responses = {}
+    server.url = 'http://127.0.0.1:%d' % server.server_port
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_post(stub_server):
+    response = httpclient.post(stub_server.url + '/sms', data={'To': '123'})
+
+    assert response.status_code == 200
+    assert response.text == 'ok'
+    assert stub_server.received == [('/sms', b'To=123')]
+
+
+def test_post_reuses_connections(stub_server):
+    assert httpclient.get_session() is httpclient.get_session()
+
+    httpclient.post(stub_server.url + '/a')
+    with mock.patch('urllib3.connectionpool.HTTPConnectionPool._new_conn') as mock_new_conn:
+        httpclient.post(stub_server.url + '/b')
+    mock_new_conn.assert_not_called()
+
+
+def test_post_timeout(stub_server):
+    with mock.patch.object(StubHandler, 'do_POST', lambda self: threading.Event().wait(1)):
+        with pytest.raises(requests.Timeout):
+            httpclient.post(stub_server.url + '/slow', timeout=0.1)
+
+
+@mock.patch('stoqserver.lib.httpclient.EventStream.add_station_event')
+def test_dispatch(mock_add_event, stub_server):
+    station = mock.Mock(is_api=False)
+
+    dispatch_id = httpclient.dispatch(station, 'sms', httpclient.post,
+                                      stub_server.url + '/sms', data={'To': '123'})
+    assert httpclient.wait_dispatches(timeout=5)
+
+    mock_add_event.assert_called_once_with(station.id, {
+        'type': 'OUTBOUND_REQUEST_STATUS',
+        'data': {
+            'id': dispatch_id,
+            'kind': 'sms',
+            'status': 'delivered',
+            'status_code': 200,
+            'response': 'ok',
+        },
+    })
+
+
+@mock.patch('stoqserver.lib.httpclient.EventStream.add_station_event')
+def test_dispatch_failed(mock_add_event, stub_server):
+    stub_server.responses['/sms'] = (503, b'unavailable')
+
+    httpclient.dispatch(mock.Mock(is_api=False), 'sms', httpclient.post,
+                        stub_server.url + '/sms')
+    assert httpclient.wait_dispatches(timeout=5)
+
+    status = mock_add_event.call_args[0][1]['data']
+    assert status['status'] == 'failed'
+    assert status['status_code'] == 503
+
+
+@mock.patch('stoqserver.lib.httpclient.EventStream.add_station_event')
+def test_dispatch_api_station(mock_add_event, stub_server):
+    httpclient.dispatch(mock.Mock(is_api=True), 'sms', httpclient.post,
+                        stub_server.url + '/sms')
+    assert httpclient.wait_dispatches(timeout=5)
+
+    assert len(stub_server.received) == 1
+    mock_add_event.assert_not_called()
@@ -0,0 +1,91 @@
+import datetime
+import io
+from unittest import mock
+
+import pytest
+from PIL import Image as PILImage
+from stoqlib.domain.image import Image
+
+from stoqserver.lib.diskcache import DiskCache
+from stoqserver.lib.imagecache import ImageCache, get_image_hash, make_thumbnail
+
+
+def _create_png(width=300, height=150):
+    output = io.BytesIO()
+    PILImage.new('RGB', (width, height)).save(output, format='PNG')
+    return output.getvalue()
+
+
+@pytest.fixture
+def image_cache(tmp_path):
+    return ImageCache(DiskCache(str(tmp_path)))
+
+
+@pytest.fixture
+def image(store, example_creator):
+    sellable = example_creator.create_sellable()
+    return Image(store=store, sellable=sellable, image=_create_png(), is_main=True)
+
+
+def test_make_thumbnail():
+    thumbnail = PILImage.open(io.BytesIO(make_thumbnail(io.BytesIO(_create_png()), 64)))
+    assert thumbnail.size == (64, 32)
+
+
+def test_image_cache_get_image(store, image_cache, image):
+    path, etag = image_cache.get_image(store, image.sellable_id)
+    assert etag == get_image_hash(image.image)
+    with open(path, 'rb') as f:
+        assert f.read() == image.image
+
+    # The image is served from the disk now
+    with mock.patch.object(store, 'using') as mock_using:
+        assert image_cache.get_image(store, image.sellable_id) == (path, etag)
+    mock_using.assert_not_called()
+
+
+def test_image_cache_get_thumbnail(store, image_cache, image):
+    path, etag = image_cache.get_image(store, image.sellable_id, size=128)
+    assert etag == '%s-128' % get_image_hash(image.image)
+    with open(path, 'rb') as f:
+        assert PILImage.open(f).size == (128, 64)
+
+
+def test_image_cache_image_not_found(store, image_cache, image):
+    assert image_cache.get_image(store, image.sellable_id, keyword='foo') is None
+    assert image_cache.get_image(store, image.sellable_id, is_main=False) is None
+
+
+def test_image_cache_image_changed(store, image_cache, image):
+    image_cache = ImageCache(image_cache.disk_cache, lookup_ttl=0)
+    _, etag = image_cache.get_image(store, image.sellable_id)
+    assert etag == get_image_hash(image.image)
+
+    image.image = _create_png(10, 10)
+    image.te.te_time = image.te.te_time + datetime.timedelta(seconds=1)
+    _, new_etag = image_cache.get_image(store, image.sellable_id)
+    assert new_etag != etag
+    assert new_etag == get_image_hash(image.image)
+
+
+def test_image_cache_get_images(store, image_cache, image, example_creator):
+    other_image = Image(store=store, sellable=example_creator.create_sellable(),
+                        image=_create_png(), is_main=True)
+    without_image = example_creator.create_sellable()
+    sellable_ids = [image.sellable_id, other_image.sellable_id, without_image.id]
+
+    with mock.patch.object(store, 'using', wraps=store.using) as mock_using:
+        images = image_cache.get_images(store, sellable_ids, is_main=True, size=64)
+    assert mock_using.call_count == 1
+
+    assert set(images) == {image.sellable_id, other_image.sellable_id}
+    assert images[image.sellable_id][1] == '%s-64' % get_image_hash(image.image)
+
+
+def test_image_cache_stream_big_image(store, image_cache, image):
+    with mock.patch('stoqserver.lib.imagecache.STREAM_CHUNK_SIZE', 100):
+        path, etag = image_cache.get_image(store, image.sellable_id)
+
+    assert etag == get_image_hash(image.image)
+    with open(path, 'rb') as f:
+        assert f.read() == image.image
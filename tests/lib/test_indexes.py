@@ -0,0 +1,58 @@
+from unittest import mock
+
+from stoqserver.lib.indexes import INDEXES, create_indexes, get_nfe_key, index_exists
+
+
+def _mock_store(existing):
+    store = mock.Mock()
+
+    def execute(statement, params=None):
+        result = mock.Mock()
+        if params is not None:
+            result.get_one.return_value = (params[0] if params[0] in existing else None, )
+        return result
+
+    store.execute.side_effect = execute
+    # The pending changes Storm's rollback goes through
+    store._dirty = {}
+
+    # The connection is closed after each index, and connected again when needed
+    raw_connection = mock.Mock()
+
+    def ensure_connected():
+        store._connection._raw_connection = raw_connection
+
+    store._connection._ensure_connected.side_effect = ensure_connected
+    return store, raw_connection
+
+
+def test_get_nfe_key():
+    assert get_nfe_key('nfe_purchase').expr.startswith(
+        "substring(CAST((xpath('//nfe:infNFe/@Id', nfe_purchase.xml, ")
+
+
+def test_create_indexes():
+    store, raw_connection = _mock_store(existing={table for table, name, columns in INDEXES})
+
+    assert create_indexes(store) == [name for table, name, columns in INDEXES]
+    assert store.commit.call_count == len(INDEXES)
+    store.execute.assert_any_call(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS imported_nfe_cnpj_document_type_te_id_idx "
+        "ON imported_nfe (cnpj, (left(CAST(xml AS text), 8)), te_id)")
+    # The indexes are built outside of a transaction
+    raw_connection.set_isolation_level.assert_called_with(0)
+    assert store._connection._raw_connection is None
+
+
+def test_create_indexes_skip_existing():
+    store, _ = _mock_store(existing={'nfe_purchase', 'nfe_purchase_cnpj_key_idx'})
+
+    # Only the nfe_purchase table exists and its index is already there
+    assert create_indexes(store) == []
+    store.commit.assert_not_called()
+
+
+def test_index_exists():
+    store, _ = _mock_store(existing={'nfe_purchase_cnpj_key_idx'})
+    assert index_exists(store, 'nfe_purchase_cnpj_key_idx')
+    assert not index_exists(store, 'company_cnpj_digits_idx')
@@ -0,0 +1,131 @@
+import json
+from unittest import mock
+
+import pytest
+
+from stoqserver.lib import ingestion
+from stoqserver.lib.eventstream import redis_server
+from stoqserver.signals import WebhookEvent
+
+
+@pytest.fixture(autouse=True)
+def clean_redis():
+    def _clean():
+        keys = redis_server.keys('webhook-*')
+        if keys:
+            redis_server.delete(*keys)
+
+    _clean()
+    with mock.patch('stoqserver.lib.ingestion.start_workers'):
+        yield
+    _clean()
+
+
+@pytest.fixture
+def receiver():
+    receiver = mock.Mock()
+    WebhookEvent.connect(receiver)
+    yield receiver
+    WebhookEvent.disconnect(receiver)
+
+
+def _ingest(data):
+    return ingestion.ingest_event(json.dumps(data).encode())
+
+
+def test_get_event_id():
+    assert ingestion.get_event_id({'id': 1}, b'') == '1'
+    assert ingestion.get_event_id({'event_id': 'abc'}, b'') == 'abc'
+    assert ingestion.get_event_id({'foo': 'bar'}, b'{"foo": "bar"}') == (
+        ingestion.get_event_id([], b'{"foo": "bar"}'))
+
+
+def test_ingest_event(receiver):
+    assert _ingest({'id': 'e1', 'source': 'ifood'}) == ('e1', True)
+    # Retried by the sender
+    assert _ingest({'id': 'e1', 'source': 'ifood'}) == ('e1', False)
+    assert _ingest({'foo': 'bar'})[1]
+    # The same id from another source is a different event
+    assert _ingest({'id': 'e1'}) == ('e1', True)
+
+    assert ingestion.get_status() == {
+        'default': {'pending': 2, 'dead': 0, 'attempts': 0, 'next_attempt': None,
+                    'last_error': None},
+        'ifood': {'pending': 1, 'dead': 0, 'attempts': 0, 'next_attempt': None,
+                  'last_error': None},
+    }
+    # The events are only processed in the background
+    receiver.assert_not_called()
+
+
+def test_ingest_invalid_event():
+    with pytest.raises(ValueError):
+        ingestion.ingest_event(b'not json')
+
+
+def test_process_next_event(receiver):
+    _ingest({'id': 'e1', 'source': 'ifood'})
+    _ingest({'id': 'e2', 'source': 'ifood'})
+
+    assert ingestion.process_next_event('ifood')
+    assert ingestion.process_next_event('ifood')
+    assert not ingestion.process_next_event('ifood')
+
+    assert receiver.call_args_list == [
+        mock.call({'id': 'e1', 'source': 'ifood'}),
+        mock.call({'id': 'e2', 'source': 'ifood'}),
+    ]
+    assert ingestion.get_status()['ifood']['pending'] == 0
+
+
+def test_process_next_event_locked(receiver):
+    _ingest({'id': 'e1', 'source': 'ifood'})
+    redis_server.set('webhook-lock-ifood', 'other worker')
+
+    assert not ingestion.process_next_event('ifood')
+    receiver.assert_not_called()
+
+
+@mock.patch('stoqserver.lib.ingestion.MAX_ATTEMPTS', 2)
+@mock.patch('stoqserver.lib.redisqueue.time.time')
+def test_process_next_event_failed(mock_time, receiver):
+    mock_time.return_value = 1000
+    receiver.side_effect = Exception('Order not found')
+    _ingest({'id': 'e1', 'source': 'ifood'})
+    _ingest({'id': 'e2', 'source': 'ifood'})
+
+    assert not ingestion.process_next_event('ifood')
+    assert ingestion.get_status()['ifood'] == {
+        'pending': 2, 'dead': 0, 'attempts': 1, 'next_attempt': '1970-01-01T00:16:45',
+        'last_error': 'Order not found'}
+
+    # The next event waits for the failed one to be retried
+    assert not ingestion.process_next_event('ifood')
+    assert receiver.call_count == 1
+
+    mock_time.return_value = 2000
+    assert not ingestion.process_next_event('ifood')
+    assert ingestion.get_status()['ifood'] == {
+        'pending': 1, 'dead': 1, 'attempts': 0, 'next_attempt': None, 'last_error': None}
+
+    receiver.side_effect = None
+    assert ingestion.process_next_event('ifood')
+    receiver.assert_called_with({'id': 'e2', 'source': 'ifood'})
+
+    failed_events = ingestion.get_failed_events('ifood')
+    assert [(e['id'], e['data'], e['error'], e['attempts']) for e in failed_events] == [
+        ('e1', {'id': 'e1', 'source': 'ifood'}, 'Order not found', 2)]
+
+
+def test_requeue_failed_events(receiver):
+    _ingest({'id': 'e1', 'source': 'ifood'})
+    event = json.loads(redis_server.lpop('webhook-queue-ifood'))
+    event.update(error='Order not found', attempts=5, failed_at='2021-01-01T00:00:00')
+    redis_server.rpush('webhook-dead-ifood', json.dumps(event))
+
+    assert ingestion.requeue_failed_events('ifood') == 1
+    assert ingestion.requeue_failed_events('ifood') == 0
+    assert ingestion.get_failed_events('ifood') == []
+
+    assert ingestion.process_next_event('ifood')
+    receiver.assert_called_once_with({'id': 'e1', 'source': 'ifood'})
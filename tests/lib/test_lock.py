@@ -0,0 +1,59 @@
+import uuid
+from unittest import mock
+
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from stoqserver.lib.baseresource import BaseResource
+from stoqserver.lib.lock import (LockFailedException, STATION_LOCK_NAMESPACE,
+                                 get_station_lock_key, lock_station)
+
+
+def test_get_station_lock_key():
+    station_id = uuid.uuid4()
+
+    key = get_station_lock_key(station_id)
+    assert -2 ** 31 <= key < 2 ** 31
+    assert get_station_lock_key(str(station_id)) == key
+
+
+@mock.patch('stoqserver.lib.lock.gevent.sleep')
+def test_lock_station(mock_sleep):
+    store = mock.Mock()
+    station = mock.Mock(id=uuid.uuid4())
+    store.execute.return_value.get_one.side_effect = [(False, ), (True, )]
+
+    lock_station(store, station)
+
+    assert mock_sleep.call_count == 1
+    store.execute.assert_called_with('SELECT pg_try_advisory_xact_lock(?, ?)',
+                                     (STATION_LOCK_NAMESPACE, get_station_lock_key(station.id)))
+
+
+@mock.patch('stoqserver.lib.lock.gevent.sleep')
+def test_lock_station_timeout(mock_sleep):
+    store = mock.Mock()
+    store.execute.return_value.get_one.return_value = (False, )
+
+    with pytest.raises(LockFailedException):
+        lock_station(store, mock.Mock(id=uuid.uuid4()), timeout=0)
+
+
+def test_lock_station_in_database(store, current_station, example_creator):
+    other_station = example_creator.create_station()
+
+    lock_station(store, current_station)
+    # It is reentrant in the same transaction
+    lock_station(store, current_station)
+    # And other stations are not affected
+    lock_station(store, other_station)
+
+
+def test_lock_current_station_without_station():
+    resource = BaseResource()
+    store = mock.Mock()
+
+    with mock.patch.object(resource, 'get_current_station', return_value=None):
+        with pytest.raises(BadRequest):
+            resource.lock_current_station(store)
+    store.execute.assert_not_called()
@@ -0,0 +1,65 @@
+from unittest import mock
+
+import pytest
+from stoqlib.domain.overrides import SellableBranchOverride
+
+from stoqserver.lib import restful
+from stoqserver.lib.overrides import (cache_overrides, get_branch_overrides,
+                                      invalidate_overrides, prefetch_overrides)
+
+# Sellable.default_sale_cfop is patched by restful
+restful
+
+
+@pytest.fixture
+def sellables(example_creator):
+    return [example_creator.create_sellable() for i in range(3)]
+
+
+@pytest.fixture
+def sellable_override(store, example_creator, current_branch, sellables):
+    return SellableBranchOverride(store=store, sellable=sellables[0], branch=current_branch,
+                                  default_sale_cfop=example_creator.create_cfop_data())
+
+
+def test_prefetch_overrides(store, current_branch, sellables, sellable_override):
+    with cache_overrides(store), mock.patch.object(store, 'find', wraps=store.find) as mock_find:
+        prefetch_overrides(store, sellables)
+        assert mock_find.call_count == 1
+
+        assert sellables[0].default_sale_cfop == sellable_override.default_sale_cfop
+        assert sellables[1].default_sale_cfop == sellables[1].__default_sale_cfop
+        assert get_branch_overrides(store).get(sellables[2]) is None
+        # Everything was resolved by the prefetch
+        assert mock_find.call_count == 1
+
+    # Outside the context, the overrides are not kept anymore
+    assert get_branch_overrides(store) is None
+
+
+def test_overrides_not_cached(store, current_branch, sellables, sellable_override):
+    with mock.patch.object(store, 'find', wraps=store.find) as mock_find:
+        prefetch_overrides(store, sellables)
+        mock_find.assert_not_called()
+
+        assert sellables[0].default_sale_cfop == sellable_override.default_sale_cfop
+        assert sellables[0].default_sale_cfop == sellable_override.default_sale_cfop
+        # Each access queried the override
+        assert mock_find.call_count == 2
+
+
+def test_branch_overrides_get(store, current_branch, example_creator, sellables,
+                              sellable_override):
+    with cache_overrides(store):
+        overrides = get_branch_overrides(store)
+        assert overrides.get(sellables[0]) is sellable_override
+        assert overrides.get(sellables[0], branch=example_creator.create_branch()) is None
+
+        # The missing overrides are cached too
+        other_override = SellableBranchOverride(store=store, sellable=sellables[1],
+                                                branch=current_branch)
+        assert overrides.get(sellables[1]) is None
+
+        invalidate_overrides(store)
+        assert get_branch_overrides(store) is not overrides
+        assert get_branch_overrides(store).get(sellables[1]) is other_override
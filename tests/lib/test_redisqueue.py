@@ -0,0 +1,78 @@
+import json
+from unittest import mock
+
+import pytest
+
+from stoqserver.lib import redisqueue
+from stoqserver.lib.eventstream import redis_server
+
+
+@pytest.fixture
+def queue():
+    queue = redisqueue.RedisQueue('test', 'q', max_attempts=2)
+    keys = [queue.queue_key, queue.dead_key, queue.state_key, queue.lock_key]
+    redis_server.delete(*keys)
+    yield queue
+    redis_server.delete(*keys)
+
+
+def _push(queue, *ids):
+    for event_id in ids:
+        redis_server.rpush(queue.queue_key, json.dumps({'id': event_id}))
+
+
+def test_get_retry_delay():
+    assert redisqueue.get_retry_delay(1) == redisqueue.RETRY_DELAY
+    assert redisqueue.get_retry_delay(3) == redisqueue.RETRY_DELAY * 4
+    assert redisqueue.get_retry_delay(100) == redisqueue.MAX_RETRY_DELAY
+
+
+def test_process(queue):
+    _push(queue, 'e1', 'e2', 'e3')
+    handler = mock.Mock()
+
+    assert queue.process(handler, count=2) == 2
+    handler.assert_called_once_with([{'id': 'e1'}, {'id': 'e2'}])
+    assert queue.process(handler, count=2) == 1
+    assert queue.process(handler, count=2) == 0
+    assert queue.get_status()['pending'] == 0
+
+
+def test_process_locked(queue):
+    _push(queue, 'e1')
+    redis_server.set(queue.lock_key, 'other worker')
+    handler = mock.Mock()
+
+    assert queue.process(handler) == 0
+    handler.assert_not_called()
+
+
+@mock.patch('stoqserver.lib.redisqueue.time.time')
+def test_process_failed(mock_time, queue):
+    mock_time.return_value = 1000
+    _push(queue, 'e1', 'e2')
+    handler = mock.Mock(side_effect=Exception('Timeout'))
+
+    assert queue.process(handler) == 0
+    assert queue.get_status() == {
+        'pending': 2, 'dead': 0, 'attempts': 1, 'next_attempt': '1970-01-01T00:16:45',
+        'last_error': 'Timeout'}
+    # It is not retried before the delay
+    assert queue.process(handler) == 0
+    assert handler.call_count == 1
+
+    mock_time.return_value = 2000
+    assert queue.process(handler) == 0
+    assert queue.get_status()['dead'] == 1
+    dead_letters = queue.get_dead_letters()
+    assert [(e['id'], e['error'], e['attempts']) for e in dead_letters] == [('e1', 'Timeout', 2)]
+
+    # The next event is not held by the failed one anymore
+    handler.side_effect = None
+    assert queue.process(handler) == 1
+    handler.assert_called_with([{'id': 'e2'}])
+
+    assert queue.requeue_dead_letters() == 1
+    assert queue.get_dead_letters() == []
+    assert queue.process(handler) == 1
+    handler.assert_called_with([{'id': 'e1'}])
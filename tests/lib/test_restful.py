@@ -1,16 +1,27 @@
+import base64
+import datetime
+import json
+import os
+import sys
 from decimal import Decimal
 from unittest import mock
 
 import pytest
 import requests
+from blinker import signal
 from stoqifood.domain import ExternalOrder
+from stoqlib.domain.image import Image
 from stoqlib.domain.overrides import ProductBranchOverride
 from stoqlib.domain.person import Individual
 from stoqlib.domain.sale import Sale
 from stoqlib.domain.till import Till
 from storm.expr import Desc
+from werkzeug.formparser import parse_form_data
+from werkzeug.test import EnvironBuilder
 
 from stoqserver.lib import restful
+from stoqserver.lib.diskcache import DiskCache
+from stoqserver.lib.imagecache import ImageCache, get_image_hash
 
 # We must import restful if we want to run some tests individually. Otherwise, only patches that
 # mock stoqlib.lib.restful work when running pytest with -k
@@ -880,3 +891,236 @@ def test_get_credit_providers_from_conf(get_config_mock, client, sale_payload):
 
     assert response.status_code == 200
     assert response.json['scrollable_list'] == credit_providers
+
+
+def test_data_resource_category_prices(example_creator, current_station, store, sellable):
+    category = example_creator.create_client_category()
+    example_creator.create_client_category_price(category=category, sellable=sellable,
+                                                 price=8)
+    # Not in the station's catalog
+    closed_sellable = example_creator.create_sellable()
+    closed_sellable.status = closed_sellable.STATUS_CLOSED
+    example_creator.create_client_category_price(category=category, sellable=closed_sellable,
+                                                 price=5)
+
+    resource = restful.DataResource()
+    prices = resource._get_category_prices(store, current_station, [sellable.id])
+    assert prices == {sellable.id: {category.id: '8.00'}}
+
+    with mock.patch.object(store, 'using', wraps=store.using) as mock_using:
+        assert resource._get_category_prices(
+            store, current_station, [sellable.id]) is prices
+    # Only the version of the prices was checked
+    mock_using.assert_not_called()
+
+    other_category = example_creator.create_client_category()
+    example_creator.create_client_category_price(category=other_category, sellable=sellable,
+                                                 price=7)
+    prices = resource._get_category_prices(store, current_station, [sellable.id])
+    assert prices == {sellable.id: {category.id: '8.00', other_category.id: '7.00'}}
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_image_resource(client, store, sellable, tmp_path):
+    Image(store=store, sellable=sellable, image=b'image data', is_main=True)
+    image_cache = ImageCache(DiskCache(str(tmp_path)))
+
+    with mock.patch('stoqserver.lib.restful.get_image_cache', return_value=image_cache):
+        response = client.get('/image/{}'.format(sellable.id))
+        assert response.status_code == 200
+        assert response.data == b'image data'
+        assert response.mimetype == 'image/png'
+        assert response.headers['ETag'] == '"{}"'.format(get_image_hash(b'image data'))
+        assert 'max-age' in response.headers['Cache-Control']
+
+        response = client.get('/image/{}'.format(sellable.id),
+                              headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+        response = client.get('/image/{}'.format(sellable.id), query_string={'size': 100})
+        assert response.status_code == 400
+        assert response.json['message'] == "'size' must be one of: 64, 128, 256, 512"
+
+        response = client.get('/image/{}'.format(sellable.id), query_string={'keyword': 'foo'})
+        assert response.status_code == 404
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_image_resource_evicted(client, store, sellable, tmp_path):
+    Image(store=store, sellable=sellable, image=b'image data', is_main=True)
+    image_cache = ImageCache(DiskCache(str(tmp_path)))
+    get_image = image_cache.get_image
+
+    def _get_image_and_evict(*args, **kwargs):
+        path, etag = get_image(*args, **kwargs)
+        # Evicted by another process before being sent
+        if _get_image_and_evict.evict:
+            _get_image_and_evict.evict = False
+            os.unlink(path)
+        return path, etag
+
+    _get_image_and_evict.evict = True
+    with mock.patch('stoqserver.lib.restful.get_image_cache', return_value=image_cache), \
+            mock.patch.object(image_cache, 'get_image', _get_image_and_evict):
+        response = client.get('/image/{}'.format(sellable.id))
+
+    assert response.status_code == 200
+    assert response.data == b'image data'
+
+
+@pytest.mark.usefixtures('mock_new_store')
+def test_image_bundle_resource(client, store, sellable, example_creator, tmp_path):
+    Image(store=store, sellable=sellable, image=b'image data', is_main=True)
+    other_sellable = example_creator.create_sellable()
+    Image(store=store, sellable=other_sellable, image=b'other image data', is_main=True)
+    without_image = example_creator.create_sellable()
+    image_cache = ImageCache(DiskCache(str(tmp_path)))
+    etag = get_image_hash(b'image data')
+    other_etag = get_image_hash(b'other image data')
+
+    payload = {
+        'sellable_ids': [sellable.id, other_sellable.id, without_image.id],
+        # The client already has the first image
+        'etags': {sellable.id: etag},
+    }
+    with mock.patch('stoqserver.lib.restful.get_image_cache', return_value=image_cache):
+        response = client.post('/image/bundle', json=payload)
+
+    assert response.status_code == 200
+    assert response.mimetype == 'multipart/form-data'
+    environ = EnvironBuilder(method='POST', data=response.data,
+                             content_type=response.headers['Content-Type']).get_environ()
+    _, form, files = parse_form_data(environ)
+    assert json.loads(form['index']) == {
+        sellable.id: etag,
+        other_sellable.id: other_etag,
+        without_image.id: None,
+    }
+    assert list(files) == [other_sellable.id]
+    assert files[other_sellable.id].filename == '{}.png'.format(other_etag)
+    assert files[other_sellable.id].read() == b'other image data'
+
+
+@pytest.mark.usefixtures('mock_new_store')
+@pytest.mark.parametrize('payload, message', [
+    ({}, "'sellable_ids' must be a non empty list"),
+    ({'sellable_ids': 'foo'}, "'sellable_ids' must be a non empty list"),
+    ({'sellable_ids': ['foo'] * 1001}, "Bundles can't have more than 1000 images"),
+    ({'sellable_ids': ['foo'], 'size': 100}, "'size' must be one of: 64, 128, 256, 512"),
+    ({'sellable_ids': ['foo']}, "Invalid sellable id: foo"),
+])
+def test_image_bundle_resource_invalid_payload(client, payload, message):
+    response = client.post('/image/bundle', json=payload)
+    assert response.status_code == 400
+    assert response.json['message'] == message
+
+
+@mock.patch('stoqserver.lib.restful.GenerateInvoicePictureEvent.send')
+@pytest.mark.usefixtures('mock_new_store')
+def test_sale_coupon_download_danfe(mock_generate_invoice, client, example_creator):
+    sale = example_creator.create_sale()
+    pdf = b'%PDF-1.4' + os.urandom(200 * 1024)
+    mock_generate_invoice.return_value = [(None, (base64.b64encode(pdf).decode(),
+                                                  'application/pdf'))]
+
+    response = client.get('/sale/{}/coupon'.format(sale.id), query_string={'download': 1})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+    assert response.content_length == len(pdf)
+    assert response.data == pdf
+
+
+@pytest.fixture
+def coupon_transmitted():
+    receiver = mock.Mock(return_value=True)
+    signal('CheckCouponTransmittedEvent').connect(receiver, weak=False)
+    yield receiver
+    signal('CheckCouponTransmittedEvent').disconnect(receiver)
+
+
+@mock.patch('stoqserver.lib.restful.GenerateInvoicePictureEvent.send')
+@pytest.mark.usefixtures('mock_new_store', 'coupon_transmitted')
+def test_sale_coupon_image_is_cached(mock_generate_invoice, client, example_creator):
+    sale = example_creator.create_sale()
+    mock_generate_invoice.return_value = [(None, ('image', 'image/png'))]
+
+    for i in range(2):
+        response = client.get('/sale/{}/coupon'.format(sale.id))
+        assert response.status_code == 200
+        assert response.json == {'image': 'image', 'mimetype': 'image/png'}
+    assert mock_generate_invoice.call_count == 1
+
+    # The coupon must be rendered again when the sale changes
+    sale.te.te_time = sale.te.te_time + datetime.timedelta(seconds=1)
+    client.get('/sale/{}/coupon'.format(sale.id))
+    assert mock_generate_invoice.call_count == 2
+
+
+@mock.patch('stoqserver.lib.restful.GenerateInvoicePictureEvent.send')
+@pytest.mark.usefixtures('mock_new_store')
+def test_sale_coupon_image_not_transmitted(mock_generate_invoice, client, example_creator,
+                                           coupon_transmitted):
+    sale = example_creator.create_sale()
+    mock_generate_invoice.return_value = [(None, ('image', 'image/png'))]
+    # e.g. emitted in contingency
+    coupon_transmitted.return_value = False
+
+    for i in range(2):
+        response = client.get('/sale/{}/coupon'.format(sale.id))
+        assert response.status_code == 200
+    assert mock_generate_invoice.call_count == 2
+
+
+@mock.patch('stoqserver.lib.restful.GenerateExternalOrderReceiptImageEvent.send')
+@pytest.mark.usefixtures('mock_new_store')
+def test_external_order_receipt_without_ifood(mock_generate_receipt, client):
+    mock_generate_receipt.return_value = [(None, 'image')]
+
+    # Without the plugin, the receipt is rendered every time
+    with mock.patch.dict(sys.modules, {'stoqifood.domain': None}):
+        for i in range(2):
+            response = client.get('/external_order/123/receipt')
+            assert response.status_code == 200
+            assert response.json == {'id': '123', 'image': 'image'}
+    assert mock_generate_receipt.call_count == 2
+
+
+@pytest.mark.usefixtures('mock_get_default_store', 'mock_new_store')
+def test_till_get_summary(client, open_till):
+    open_till.add_credit_entry(Decimal(10), 'Supply')
+
+    response = client.get('/till')
+    assert response.status_code == 200
+    assert response.json['entry_types'] == [
+        {'method': 'money', 'provider': None, 'card_type': None, 'system_value': '10.00'},
+    ]
+
+    # The entries created after the summary was read are added to it
+    open_till.add_debit_entry(Decimal(3), 'Removal')
+    response = client.get('/till')
+    assert response.json['entry_types'][0]['system_value'] == '7.00'
+
+
+@mock.patch('stoqserver.lib.restful.httpclient.post')
+@pytest.mark.usefixtures('mock_new_store')
+def test_locker_post(mock_post, client):
+    mock_post.return_value.text = 'opened'
+
+    response = client.post('/locker', json={'lockerNumber': 1, 'lockerMac': 'mac'})
+
+    assert response.status_code == 200
+    assert response.json == 'opened'
+
+
+@mock.patch('stoqserver.lib.restful.httpclient.dispatch')
+@pytest.mark.usefixtures('mock_new_store')
+def test_locker_post_async(mock_dispatch, client, current_station):
+    mock_dispatch.return_value = 'dispatch-id'
+
+    response = client.post('/locker', json={'lockerNumber': 1, 'lockerMac': 'mac',
+                                            'async': True})
+
+    assert response.status_code == 202
+    assert response.json == {'id': 'dispatch-id', 'status': 'queued'}
+    mock_dispatch.assert_called_once_with(current_station, 'locker', mock.ANY, 1, 'mac')
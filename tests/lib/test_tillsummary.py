@@ -0,0 +1,108 @@
+import datetime
+from decimal import Decimal
+from unittest import mock
+
+from stoqserver.lib.tillsummary import RunningTillSummary, TillSummaryCache
+
+T0 = datetime.datetime(2021, 1, 1, 10)
+T1 = datetime.datetime(2021, 1, 1, 11)
+T2 = datetime.datetime(2021, 1, 1, 12)
+
+
+def test_running_till_summary_add_entries():
+    summary = RunningTillSummary()
+    assert summary.add_entries([
+        ('e1', T0, Decimal(10), None, None, None),
+        ('e2', T1, Decimal(20), 'card', 'VISA', 'credit'),
+        ('e3', T1, Decimal(5), 'money', None, None),
+    ])
+
+    assert summary.values == {
+        ('money', None, None): Decimal(15),
+        ('card', 'VISA', 'credit'): Decimal(20),
+    }
+    assert summary.version == (3, T1)
+
+    # The entries that are already summarized are skipped
+    assert summary.add_entries([
+        ('e3', T1, Decimal(5), 'money', None, None),
+        ('e4', T2, Decimal(1), 'card', 'VISA', 'credit'),
+    ])
+    assert summary.values[('card', 'VISA', 'credit')] == Decimal(21)
+    assert summary.version == (4, T2)
+
+
+def test_running_till_summary_changed_entry():
+    summary = RunningTillSummary()
+    summary.add_entries([('e1', T0, Decimal(10), None, None, None)])
+
+    assert not summary.add_entries([('e1', T1, Decimal(12), None, None, None)])
+
+
+@mock.patch('stoqserver.lib.tillsummary._find_entries')
+@mock.patch('stoqserver.lib.tillsummary.get_entries_version')
+def test_till_summary_cache(mock_get_version, mock_find_entries):
+    store = mock.Mock()
+    cache = TillSummaryCache()
+
+    mock_get_version.return_value = (1, T0)
+    mock_find_entries.return_value = [('e1', T0, Decimal(10), None, None, None)]
+    assert cache.get(store, 't1') == {('money', None, None): Decimal(10)}
+    mock_find_entries.assert_called_once_with(store, 't1')
+
+    # Nothing changed
+    mock_find_entries.reset_mock()
+    assert cache.get(store, 't1') == {('money', None, None): Decimal(10)}
+    mock_find_entries.assert_not_called()
+
+    # Only the new entries are fetched
+    mock_get_version.return_value = (2, T1)
+    mock_find_entries.return_value = [('e2', T1, Decimal(3), 'card', 'VISA', 'debit')]
+    assert cache.get(store, 't1') == {
+        ('money', None, None): Decimal(10),
+        ('card', 'VISA', 'debit'): Decimal(3),
+    }
+    mock_find_entries.assert_called_once_with(store, 't1', since=T0)
+
+
+@mock.patch('stoqserver.lib.tillsummary._find_entries')
+@mock.patch('stoqserver.lib.tillsummary.get_entries_version')
+def test_till_summary_cache_missed_entry(mock_get_version, mock_find_entries):
+    store = mock.Mock()
+    cache = TillSummaryCache()
+
+    mock_get_version.return_value = (1, T1)
+    mock_find_entries.return_value = [('e1', T1, Decimal(10), None, None, None)]
+    cache.get(store, 't1')
+
+    # e2 was committed after e1, but with an older modification time
+    mock_get_version.return_value = (2, T1)
+    mock_find_entries.side_effect = [
+        [('e1', T1, Decimal(10), None, None, None)],
+        [('e2', T0, Decimal(5), None, None, None), ('e1', T1, Decimal(10), None, None, None)],
+    ]
+    assert cache.get(store, 't1') == {('money', None, None): Decimal(15)}
+    assert mock_find_entries.call_args_list[-1] == mock.call(store, 't1')
+
+
+@mock.patch('stoqserver.lib.tillsummary._find_entries')
+@mock.patch('stoqserver.lib.tillsummary.get_entries_version')
+def test_till_summary_cache_changed_payment(mock_get_version, mock_find_entries):
+    store = mock.Mock()
+    cache = TillSummaryCache()
+
+    mock_get_version.return_value = (1, T0)
+    mock_find_entries.return_value = [('e1', T0, Decimal(10), 'card', 'VISA', 'debit')]
+    cache.get(store, 't1')
+
+    # The card type of the payment was fixed. Its modification time is the entry's now
+    mock_get_version.return_value = (1, T1)
+    mock_find_entries.side_effect = [
+        [('e1', T1, Decimal(10), 'card', 'VISA', 'credit')],
+        [('e1', T1, Decimal(10), 'card', 'VISA', 'credit')],
+    ]
+    assert cache.get(store, 't1') == {
+        ('money', None, None): Decimal(0),
+        ('card', 'VISA', 'credit'): Decimal(10),
+    }
+    assert mock_find_entries.call_args_list[-1] == mock.call(store, 't1')
@@ -0,0 +1,21 @@
+from unittest import mock
+
+from stoqserver import gunicorn_config
+
+
+@mock.patch('stoqserver.main.reinit_after_fork')
+def test_post_fork(mock_reinit):
+    server = mock.Mock()
+    server.cfg.preload_app = True
+
+    gunicorn_config.post_fork(server, mock.Mock())
+    mock_reinit.assert_called_once_with()
+
+
+@mock.patch('stoqserver.main.reinit_after_fork')
+def test_post_fork_without_preload(mock_reinit):
+    server = mock.Mock()
+    server.cfg.preload_app = False
+
+    gunicorn_config.post_fork(server, mock.Mock())
+    mock_reinit.assert_not_called()
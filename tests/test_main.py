@@ -0,0 +1,26 @@
+from unittest import mock
+
+from stoqserver import main
+
+
+@mock.patch('stoqserver.main.gc')
+@mock.patch('stoqserver.lib.eventstream.redis_server')
+@mock.patch('stoqserver.lib.database.disconnect_store')
+@mock.patch('stoqserver.main.api')
+def test_prepare_for_fork(mock_api, mock_disconnect_store, mock_redis_server, mock_gc):
+    main.prepare_for_fork()
+
+    mock_disconnect_store.assert_called_once_with(mock_api.get_default_store.return_value)
+    mock_redis_server.connection_pool.disconnect.assert_called_once_with()
+    mock_gc.collect.assert_called_once_with()
+    mock_gc.freeze.assert_called_once_with()
+
+
+@mock.patch('stoqserver.lib.eventstream.redis_server')
+@mock.patch('stoqserver.main.api')
+def test_reinit_after_fork(mock_api, mock_redis_server):
+    main.reinit_after_fork()
+
+    mock_redis_server.connection_pool.reset.assert_called_once_with()
+    # So the worker's pid is shown in pg_stat_activity
+    mock_api.get_default_store.return_value._setup_application_name.assert_called_once_with()
@@ -0,0 +1,18 @@
+import base64
+import os
+
+import pytest
+
+from stoqserver.utils import get_base64_decoded_length, iter_base64_decode
+
+
+@pytest.mark.parametrize('size', (0, 1, 2, 3, 1000, 10001))
+@pytest.mark.parametrize('encode', (base64.b64encode, base64.encodebytes))
+def test_iter_base64_decode(size, encode):
+    data = os.urandom(size)
+    encoded = encode(data).decode()
+
+    chunks = list(iter_base64_decode(encoded, chunk_size=300))
+    assert b''.join(chunks) == data
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    assert get_base64_decoded_length(encoded) == size